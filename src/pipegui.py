@@ -21,6 +21,7 @@ from plugins.util import custom_qt_items as cqt
 from plugins import set_coordinate_system as scs
 import traceback
 from plugins.util import constants
+from plugins.util import project_functions as pfs
 
 APPNAME = 'Mesoscale Brain Explorer'
 VERSION = open('../VERSION').read()
@@ -325,6 +326,13 @@ class MainWindow(QMainWindow):
     a.setStatusTip('This is useful if you experience JSON-related issues allowing for a clean slate')
     a.triggered.connect(self.reset_all_params)
     m.addAction(a)
+    a = QAction("Keep &Pixel-Major Copies of Image Stacks", self)
+    a.setStatusTip('Store a time-course ordered copy next to each saved image stack. Speeds up per-pixel '
+                   'processing such as SPC maps at the cost of disk space')
+    a.setCheckable(True)
+    a.toggled[bool].connect(self.set_pixel_major_sidecars)
+    m.addAction(a)
+    self.pixel_major_action = a
     self.project_menu = m
 
     help_menu = self.menu.addMenu('&Help')
@@ -381,6 +389,12 @@ class MainWindow(QMainWindow):
     if self.current_plugin in self.plugins.keys():
         self.plugins[self.current_plugin].widget.view.update()
 
+  def set_pixel_major_sidecars(self, checked):
+    if not self.project:
+      return
+    self.project[constants.PIXEL_MAJOR_SIDECARS] = checked
+    self.project.save()
+
   def create_project(self):
     project = self.project_manager.new_project()
     if project:
@@ -392,6 +406,7 @@ class MainWindow(QMainWindow):
     self.setWindowTitle(APPNAME + ' - ' + project.name)
     self.enable(True)
     self.project_menu.setEnabled(True)
+    self.pixel_major_action.setChecked(pfs.pixel_major_enabled(project))
     QSettings().setValue('path_of_last_project', project.path)
 
     pipeline = []
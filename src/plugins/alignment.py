@@ -16,6 +16,7 @@ from scipy import ndimage
 
 from .util import file_io
 from .util import project_functions as pfs
+from .util import registration
 from .util.custom_qt_items import ImageStackListView
 from .util.custom_qt_items import MyTableWidget
 from .util.plugin import PluginDefault
@@ -23,9 +24,14 @@ from .util.plugin import WidgetDefault
 
 
 class Widget(QWidget, WidgetDefault):
+    run_methods = ('execute_primary_function', 'compute_ref_frame')
+
     class Labels(WidgetDefault.Labels):
         kernal_size_label = "Kernel Size"
         crop_percentage_sb_label = "Crop Percentage"
+        pyramid_levels_label = "Pyramid Levels"
+        alignment_mode_label = "Alignment Mode"
+        frames_per_shift_label = "Frames Averaged per Shift"
         shift_table_col1 = "1) "
         window_name = "Crop Window"
 
@@ -40,6 +46,10 @@ class Widget(QWidget, WidgetDefault):
         rotation_shift_default = 0.0
         scale_shift_default = 1.0
         crop_percentage_sb_default = 20
+        pyramid_levels_default = 0
+        alignment_modes = ['One shift per file', 'Per-frame motion correction']
+        alignment_mode_default = 0
+        frames_per_shift_default = 1
 
     def __init__(self, project, plugin_position, parent=None):
         super(Widget, self).__init__(parent=parent)
@@ -57,6 +67,9 @@ class Widget(QWidget, WidgetDefault):
         self.ref_no = QSpinBox()
         self.rotation_checkbox = QCheckBox("Apply Rotation")
         self.scaling_checkbox = QCheckBox("Apply Scaling")
+        self.pyramid_levels_sb = QSpinBox()
+        self.alignment_mode_cb = QComboBox()
+        self.frames_per_shift_sb = QSpinBox()
         self.shift_btn = QPushButton('Compute &Shift')
 
         self.list_to_apply_shifts_to = ImageStackListView()
@@ -125,6 +138,15 @@ class Widget(QWidget, WidgetDefault):
         self.rotation_checkbox.setChecked(True)
         hbox.addWidget(self.rotation_checkbox)
         self.vbox.addLayout(hbox)
+        self.vbox.addWidget(QLabel(self.Labels.pyramid_levels_label))
+        self.pyramid_levels_sb.setRange(0, 4)
+        self.vbox.addWidget(self.pyramid_levels_sb)
+        self.vbox.addWidget(QLabel(self.Labels.alignment_mode_label))
+        self.alignment_mode_cb.addItems(self.Defaults.alignment_modes)
+        self.vbox.addWidget(self.alignment_mode_cb)
+        self.vbox.addWidget(QLabel(self.Labels.frames_per_shift_label))
+        self.frames_per_shift_sb.setRange(1, 10000)
+        self.vbox.addWidget(self.frames_per_shift_sb)
 
         self.list_to_apply_shifts_to.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.list_to_apply_shifts_to.setEditTriggers(QAbstractItemView.NoEditTriggers)
@@ -168,6 +190,7 @@ class Widget(QWidget, WidgetDefault):
         self.crop_percentage_sb.valueChanged[int].connect(self.update_crop_border)
         self.ref_button.clicked.connect(self.compute_ref_frame)
         self.align_btn.clicked.connect(self.execute_primary_function)
+        self.alignment_mode_cb.currentIndexChanged[int].connect(self.alignment_mode_changed)
         # self.main_button.clicked.connect(self.execute_primary_function)
         # self.ref_button.clicked.connect(self.compute_ref_frame)
         # self.shift_btn.clicked.connect(self.set_shifts)
@@ -177,6 +200,15 @@ class Widget(QWidget, WidgetDefault):
         if len(self.params) == 1 or reset:
             self.update_plugin_params(self.Labels.crop_percentage_sb_label, self.Defaults.crop_percentage_sb_default)
         self.crop_percentage_sb.setValue(self.params[self.Labels.crop_percentage_sb_label])
+        if self.Labels.pyramid_levels_label not in self.params or reset:
+            self.update_plugin_params(self.Labels.pyramid_levels_label, self.Defaults.pyramid_levels_default)
+        self.pyramid_levels_sb.setValue(self.params[self.Labels.pyramid_levels_label])
+        if self.Labels.alignment_mode_label not in self.params or reset:
+            self.update_plugin_params(self.Labels.alignment_mode_label, self.Defaults.alignment_mode_default)
+            self.update_plugin_params(self.Labels.frames_per_shift_label, self.Defaults.frames_per_shift_default)
+        self.alignment_mode_cb.setCurrentIndex(self.params[self.Labels.alignment_mode_label])
+        self.frames_per_shift_sb.setValue(self.params[self.Labels.frames_per_shift_label])
+        self.alignment_mode_changed()
         #     self.update_plugin_params(self.Labels.apply_rotation_label, self.Defaults.apply_rotation_default)
         #     self.update_plugin_params(self.Labels.apply_scaling_label, self.Defaults.apply_scaling_default)
         # self.rotation_checkbox.setChecked(self.params[self.Labels.apply_rotation_label])
@@ -186,6 +218,17 @@ class Widget(QWidget, WidgetDefault):
         super().setup_param_signals()
         self.crop_percentage_sb.valueChanged[int].connect(functools.partial(self.update_plugin_params,
                                                                             self.Labels.crop_percentage_sb_label))
+        self.pyramid_levels_sb.valueChanged[int].connect(functools.partial(self.update_plugin_params,
+                                                                           self.Labels.pyramid_levels_label))
+        self.alignment_mode_cb.currentIndexChanged[int].connect(functools.partial(self.update_plugin_params,
+                                                                                  self.Labels.alignment_mode_label))
+        self.frames_per_shift_sb.valueChanged[int].connect(functools.partial(self.update_plugin_params,
+                                                                             self.Labels.frames_per_shift_label))
+
+    def alignment_mode_changed(self):
+        per_frame = self.alignment_mode_cb.currentIndex() == 1
+        self.ref_no.setEnabled(not per_frame)
+        self.frames_per_shift_sb.setEnabled(per_frame)
         # self.rotation_checkbox.stateChanged[int].connect(functools.partial(self.update_plugin_params,
         #                                                                    self.Labels.apply_rotation_label))
         # self.scaling_checkbox.stateChanged[int].connect(functools.partial(self.update_plugin_params,
@@ -389,21 +432,11 @@ class Widget(QWidget, WidgetDefault):
         return [reference_frame, not_reference_frames]
 
 
-    def apply_shifts(self, frames, shift, progress_callback):
-        # shifted_frames = []
-        tvec = shift["tvec"]
-        angle = shift["angle"]
-        if "scale" in shift.keys():
-            scale = shift["scale"]
-        else:
-            scale = 1.0
-        for frame_no, frame in enumerate(frames):
-            progress_callback(frame_no / float(len(frames)))
-            # frame = frames[frame_no]
-            # shifted_frames.append(ird.transform_img(frame, tvec=tvec, angle=angle, scale=scale))
-            frames[frame_no] = ird.transform_img(frame, tvec=tvec, angle=angle, scale=scale)
+    def apply_shifts(self, filename, path, shifts, progress_callback):
+        """Write filename transformed by one shift, or one per frame, into a new stack at path"""
+        registration.apply_shifts(filename, path, shifts, progress_callback)
         progress_callback(1)
-        return frames
+        return path
 
     def execute_primary_function(self, input_paths=None):
         """Return filenames of generated videos"""
@@ -419,39 +452,37 @@ class Widget(QWidget, WidgetDefault):
             QApplication.processEvents()
         callback_global(0)
         progress_global.canceled.connect(functools.partial(self.cancel_progress_dialog, progress_global))
+        if self.alignment_mode_cb.currentIndex() == 1:
+            ret_filenames = self.motion_correct(reference_frame, to_align_paths, callback_global)
+            callback_global(1)
+            return ret_filenames
+
+        # the frame of every file matched with the reference, filtered like the reference, registered in batches
+        # against the reference's spectrum which is only computed once
+        to_align_frames = np.array([file_io.open_stack(filename)[self.ref_no.value()] for filename in to_align_paths])
+        to_align_frames = self.crop_border(self.spatial_filter(to_align_frames))
+        progress_shifts = QProgressDialog('Finding best shifts', 'Abort', 0, 100, self)
+        progress_shifts.setAutoClose(True)
+        progress_shifts.setMinimumDuration(0)
+        def callback_shifts(x):
+            progress_shifts.setValue(x * 100)
+            QApplication.processEvents()
+        progress_shifts.canceled.connect(functools.partial(self.cancel_progress_dialog, progress_shifts))
+        reference = registration.Reference(reference_frame, self.pyramid_levels_sb.value())
+        similarity = self.scaling_checkbox.isChecked() or self.rotation_checkbox.isChecked()
+        found_shifts = reference.register(to_align_frames, similarity, callback_shifts)
+        callback_shifts(1)
 
         ret_filenames = []
         shifts = {}
         for i, filename in enumerate(to_align_paths):
             callback_global(i / float(len(to_align_paths)))
-            progress_shifts = QProgressDialog('Finding best shifts for ' + filename, 'Abort', 0, 100, self)
-            progress_shifts.setAutoClose(True)
-            progress_shifts.setMinimumDuration(0)
-            progress_shifts.canceled.connect(functools.partial(self.cancel_progress_dialog, progress_shifts))
-
-            progress_load = QProgressDialog('Loading ' + filename, 'Abort', 0, 100, self)
-            progress_load.setAutoClose(True)
-            progress_load.setMinimumDuration(0)
-            def callback_load(x):
-                progress_load.setValue(x * 100)
-                QApplication.processEvents()
-            frames = file_io.load_file(filename, callback_load)
-            callback_load(1)
-
-            to_align_frame = frames[self.ref_no.value()]
-            frame_no, h, w = frames.shape
-            to_align_frame = np.reshape(to_align_frame, (1, h, w))
-            to_align_frame = self.crop_border(self.spatial_filter(to_align_frame))[0]
-            # to_align_frame = to_align_frame[0]
-
-            if self.scaling_checkbox.isChecked() or self.rotation_checkbox.isChecked():
-                shift = ird.similarity(reference_frame, to_align_frame)
+            shift = found_shifts[i]
+            if similarity:
                 if not self.rotation_checkbox.isChecked():
                     shift['angle'] = 0.0
                 if not self.scaling_checkbox.isChecked():
                     shift['scale'] = 1.0
-            else:
-                shift = ird.translation(reference_frame, to_align_frame)
             # if not self.use_shift_checkbox.isChecked():
             # else:
             #     shift = {'tvec': [self.tvec_y_sb.value(), self.tvec_x_sb.value()], 'angle': self.rotation_sb.value(),
@@ -462,9 +493,6 @@ class Widget(QWidget, WidgetDefault):
             for col_key in self.shift_table_data.keys():
                 # i = row
                 filename = os.path.normpath(os.path.join(self.project.path, self.shift_table_data[col_key][i])) + '.npy'
-                frames = file_io.load_file(filename, callback_load)
-                callback_load(1)
-
                 progress_apply = QProgressDialog('Applying shifts for ' + filename, 'Abort', 0, 100, self)
                 progress_apply.setAutoClose(True)
                 progress_apply.setMinimumDuration(0)
@@ -473,8 +501,9 @@ class Widget(QWidget, WidgetDefault):
                     QApplication.processEvents()
                 progress_apply.canceled.connect(functools.partial(self.cancel_progress_dialog, progress_apply))
 
-                shifted_frames = self.apply_shifts(frames, shift, callback_apply)
-                path = pfs.save_project(filename, self.project, shifted_frames, self.Defaults.manip, 'video')
+                self.apply_shifts(filename, pfs.get_output_path(filename, self.project, self.Defaults.manip), shift,
+                                  callback_apply)
+                path = pfs.save_project(filename, self.project, None, self.Defaults.manip, 'video')
                 pfs.refresh_list(self.project, self.video_list, [],
                                  self.Defaults.list_display_type, self.toolbutton_values)
                 ret_filenames.append(path)
@@ -540,6 +569,49 @@ class Widget(QWidget, WidgetDefault):
         return ret_filenames
 
 
+    def motion_correct(self, reference_frame, to_align_paths, callback_global):
+        """Register every frame (or average of frames) of each file to the reference and apply its shift trace to
+        every stack in that file's row of the shift table. The trace is saved next to each output"""
+        ret_filenames = []
+        similarity = self.scaling_checkbox.isChecked() or self.rotation_checkbox.isChecked()
+        for i, filename in enumerate(to_align_paths):
+            callback_global(i / float(len(to_align_paths)))
+            progress_shifts = QProgressDialog('Finding per-frame shifts for ' + filename, 'Abort', 0, 100, self)
+            progress_shifts.setAutoClose(True)
+            progress_shifts.setMinimumDuration(0)
+            def callback_shifts(x):
+                progress_shifts.setValue(x * 100)
+                QApplication.processEvents()
+            progress_shifts.canceled.connect(functools.partial(self.cancel_progress_dialog, progress_shifts))
+            shifts = registration.motion_shifts(filename, reference_frame, similarity, self.pyramid_levels_sb.value(),
+                                                self.frames_per_shift_sb.value(), self.kernal_size.value(),
+                                                self.crop_percentage_sb.value() / 100, callback_shifts)
+            callback_shifts(1)
+            for shift in shifts:
+                if not self.rotation_checkbox.isChecked():
+                    shift['angle'] = 0.0
+                if not self.scaling_checkbox.isChecked():
+                    shift['scale'] = 1.0
+
+            # Apply the found shifts (row i) to all stacks in row i
+            for col_key in self.shift_table_data.keys():
+                filename = os.path.normpath(os.path.join(self.project.path, self.shift_table_data[col_key][i])) + '.npy'
+                progress_apply = QProgressDialog('Applying shifts for ' + filename, 'Abort', 0, 100, self)
+                progress_apply.setAutoClose(True)
+                progress_apply.setMinimumDuration(0)
+                def callback_apply(x):
+                    progress_apply.setValue(x * 100)
+                    QApplication.processEvents()
+                progress_apply.canceled.connect(functools.partial(self.cancel_progress_dialog, progress_apply))
+                path = self.apply_shifts(filename, pfs.get_output_path(filename, self.project, self.Defaults.manip),
+                                         shifts, callback_apply)
+                registration.save_shift_trace(path, shifts)
+                path = pfs.save_project(filename, self.project, None, self.Defaults.manip, 'video')
+                pfs.refresh_list(self.project, self.video_list, [],
+                                 self.Defaults.list_display_type, self.toolbutton_values)
+                ret_filenames.append(path)
+        return ret_filenames
+
     # def get_alignment_inputs(self, input_files=None):
     #     if not input_files:
     #         filenames = self.selected_videos
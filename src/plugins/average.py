@@ -5,6 +5,7 @@ import sys
 import numpy as np
 from PyQt5.QtGui import *
 
+from .util import file_io
 from .util import project_functions as pfs
 from .util.plugin import PluginDefault
 from .util.plugin import WidgetDefault
@@ -47,7 +48,11 @@ class Widget(QWidget, WidgetDefault):
       for i, video_path in enumerate(selected_videos):
           # find size, assuming all files in project have the same size
           frames_mmap = np.load(video_path, mmap_mode='c')
-          frame = np.mean(frames_mmap, axis=0, dtype=np.float32)
+          statistics = file_io.load_statistics(video_path)
+          if statistics is not None:
+              frame = np.array(statistics['mean_frame'], dtype=np.float32)
+          else:
+              frame = np.mean(frames_mmap, axis=0, dtype=np.float32)
           frame_no, h, w = frames_mmap.shape
           frame = np.reshape(frame, (1, h, w))
           pfs.save_project(video_path, self.project, frame, 'avg', 'video')
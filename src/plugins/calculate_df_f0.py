@@ -1,24 +1,98 @@
 #!/usr/bin/env python3
 
+import functools
 import os
 import sys
-import time
 
 import numpy as np
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
+from scipy import ndimage
 
 from .util import file_io
 from .util import project_functions as pfs
 from .util.plugin import PluginDefault
 from .util.plugin import WidgetDefault
 
+
+def mean_frame(frames, callback=None):
+    """Mean over time of every pixel, accumulated one block of frames at a time. Given the path of a stack, the
+    mean frame of its statistics sidecar is used when there is an up to date one"""
+    if isinstance(frames, str):
+        statistics = file_io.load_statistics(frames)
+        if statistics is not None:
+            return np.array(statistics['mean_frame'], dtype=np.float32)
+        frames = file_io.open_stack(frames)
+    frames = file_io.as_stack(frames)
+    total = np.zeros(frames.shape[1:], dtype=np.float64)
+    for start, stop, block in frames.frame_blocks(np.float32):
+        total += np.sum(block, axis=0, dtype=np.float64)
+        if callback:
+            callback(stop / len(frames))
+    return np.array(total / len(frames), dtype=np.float32)
+
+def df_f0_block(block, baseline):
+    """(block - baseline) / baseline in place. Pixels with a zero baseline and NaNs are set to 0"""
+    nonzero = baseline != 0
+    np.subtract(block, baseline, out=block)
+    np.divide(block, baseline, out=block, where=nonzero)
+    np.copyto(block, 0, where=~nonzero)
+    np.copyto(block, 0, where=np.isnan(block))
+    return block
+
+def df_f0(frames_in, frames_out, baseline, callback=None, statistics=None):
+    """Write dF/F0 of frames_in into the float32 frames_out (usually memory-mapped) in one fused pass over
+    blocks of frames, so peak memory stays close to a single block. Blocks are added to statistics if given"""
+    frames_in = file_io.as_stack(frames_in)
+    for start, stop, block in frames_in.frame_blocks(np.float32):
+        frames_out[start:stop] = df_f0_block(block, baseline)
+        if statistics is not None:
+            statistics.update(block, start)
+        if callback:
+            callback(stop / len(frames_in))
+    return frames_out
+
+def sliding_baseline(traces, window, percentile):
+    """Running percentile of each column of a (frames, pixels) block over a centred window of frames.
+    The 0th percentile is a running minimum (van Herk/Gil-Werman, constant time per frame). Other percentiles
+    filter each pixel's 1-D time course, which scipy ranks with a double heap in O(log window) per frame. A single
+    (window, 1) filter over the block gives the same result but takes scipy's much slower N-D path"""
+    if percentile == 0:
+        return ndimage.minimum_filter1d(traces, window, axis=0, mode='nearest')
+    baseline = np.empty_like(traces)
+    for i in range(traces.shape[1]):
+        baseline[:, i] = ndimage.percentile_filter(traces[:, i], percentile, size=window, mode='nearest')
+    return baseline
+
+def sliding_df_f0_pixels(traces, window, percentile):
+    """dF/F0 of a (frames, pixels) block against its sliding baseline"""
+    return df_f0_block(traces, sliding_baseline(traces, window, percentile))
+
+def sliding_df_f0(video_path, output_path, window, percentile, callback=None, processes=None,
+                  memory_budget=file_io.CHUNK_BYTES):
+    """Write dF/F0 of video_path into a float32 stack at output_path using a per-pixel sliding-window percentile
+    as F0. Pixel time courses are read and written through pixel-major copies by file_io.map_pixels across a
+    process pool"""
+    window = min(window, len(file_io.open_stack(video_path)))
+    # each worker holds a block, its baseline and the filter's working copy
+    return file_io.map_pixels(video_path, output_path, sliding_df_f0_pixels, (window, percentile), callback,
+                              processes, memory_budget, copies=3)
+
 class Widget(QWidget, WidgetDefault):
+    reads_virtual_stacks = True
+
     class Labels(WidgetDefault.Labels):
         f0_source_index_label = 'f0 Source Index'
+        baseline_mode_label = 'Baseline (F0)'
+        baseline_window_label = 'Baseline window (frames)'
+        baseline_percentile_label = 'Baseline percentile (0 = running minimum)'
 
     class Defaults(WidgetDefault.Defaults):
         f0_source_index_default = []
+        baseline_modes = ['Mean of stack', 'Sliding-window percentile']
+        baseline_mode_default = 0
+        baseline_window_default = 300
+        baseline_percentile_default = 10.0
         manip = 'df-f0'
 
     def __init__(self, project, plugin_position, parent=None):
@@ -30,6 +104,9 @@ class Widget(QWidget, WidgetDefault):
         self.project = project
         self.video_list2 = QListView()
         self.df_d0_pb = QPushButton('&Compute df over f0')
+        self.baseline_mode_cb = QComboBox()
+        self.baseline_window_sb = QSpinBox()
+        self.baseline_percentile_sb = QDoubleSpinBox()
         self.temp_filter_pb = QPushButton('&Apply Filter')
         self.video_list2_vidpath = ''
         self.video_list2_index = None
@@ -54,6 +131,17 @@ class Widget(QWidget, WidgetDefault):
         self.video_list2.setStyleSheet('QListView::item { height: 26px; }')
         self.video_list2.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.vbox.addWidget(self.video_list2)
+        self.vbox.addWidget(QLabel(self.Labels.baseline_mode_label))
+        self.baseline_mode_cb.addItems(self.Defaults.baseline_modes)
+        self.vbox.addWidget(self.baseline_mode_cb)
+        self.vbox.addWidget(QLabel(self.Labels.baseline_window_label))
+        self.baseline_window_sb.setMinimum(1)
+        self.baseline_window_sb.setMaximum(1000000)
+        self.vbox.addWidget(self.baseline_window_sb)
+        self.vbox.addWidget(QLabel(self.Labels.baseline_percentile_label))
+        self.baseline_percentile_sb.setMinimum(0.0)
+        self.baseline_percentile_sb.setMaximum(100.0)
+        self.vbox.addWidget(self.baseline_percentile_sb)
         self.vbox.addWidget(self.df_d0_pb)
 
     def setup_signals(self):
@@ -62,11 +150,21 @@ class Widget(QWidget, WidgetDefault):
                                                           QItemSelection].connect(self.selected_f0_video_changed)
         self.video_list2.doubleClicked.connect(self.video_list2.clearSelection)
         self.df_d0_pb.clicked.connect(self.execute_primary_function)
+        self.baseline_mode_cb.currentIndexChanged[int].connect(self.baseline_mode_changed)
 
     def setup_params(self, reset=False):
         super().setup_params(reset)
         if len(self.params) == 1 or reset:
             self.update_plugin_params(self.Labels.f0_source_index_label, self.Defaults.f0_source_index_default)
+        if self.Labels.baseline_mode_label not in self.params or reset:
+            self.update_plugin_params(self.Labels.baseline_mode_label, self.Defaults.baseline_mode_default)
+            self.update_plugin_params(self.Labels.baseline_window_label, self.Defaults.baseline_window_default)
+            self.update_plugin_params(self.Labels.baseline_percentile_label,
+                                      self.Defaults.baseline_percentile_default)
+        self.baseline_mode_cb.setCurrentIndex(self.params[self.Labels.baseline_mode_label])
+        self.baseline_window_sb.setValue(self.params[self.Labels.baseline_window_label])
+        self.baseline_percentile_sb.setValue(self.params[self.Labels.baseline_percentile_label])
+        self.baseline_mode_changed(self.params[self.Labels.baseline_mode_label])
         self.video_list2_index = self.params[self.Labels.f0_source_index_label]
         pfs.refresh_list(self.project, self.video_list2, self.video_list2_index,
                          self.Defaults.list_display_type, self.toolbutton_values)
@@ -74,6 +172,18 @@ class Widget(QWidget, WidgetDefault):
     def setup_param_signals(self):
         super().setup_param_signals()
         self.video_list2.selectionModel().selectionChanged.connect(self.prepare_video_list2_for_update)
+        self.baseline_mode_cb.currentIndexChanged[int].connect(functools.partial(self.update_plugin_params,
+                                                                                 self.Labels.baseline_mode_label))
+        self.baseline_window_sb.valueChanged[int].connect(functools.partial(self.update_plugin_params,
+                                                                            self.Labels.baseline_window_label))
+        self.baseline_percentile_sb.valueChanged[float].connect(functools.partial(
+            self.update_plugin_params, self.Labels.baseline_percentile_label))
+
+    def baseline_mode_changed(self, index):
+        sliding = index == 1
+        self.baseline_window_sb.setEnabled(sliding)
+        self.baseline_percentile_sb.setEnabled(sliding)
+        self.video_list2.setEnabled(not sliding)
 
     def prepare_video_list2_for_update(self, selected, deselected):
         val = [v.row() for v in self.video_list2.selectedIndexes()]
@@ -120,43 +230,31 @@ class Widget(QWidget, WidgetDefault):
                 QApplication.processEvents()
                 print(self.progress.wasCanceled())
 
-            start = time.time()
-            frames = file_io.load_file(video_path)
-            elapsed_fileloader = (time.time() - start)
-            time.time()
             callback(0.01)
-            if len(self.video_list2.selectedIndexes()) == 0:
-                start = time.time()
-                baseline = np.mean(frames, axis=0, dtype=np.float32)
-                elapsed_mean = (time.time() - start)
+            path = pfs.get_output_path(video_path, self.project, self.Defaults.manip)
+            if self.baseline_mode_cb.currentIndex() == 1:
+                sliding_df_f0(video_path, path, self.baseline_window_sb.value(),
+                              self.baseline_percentile_sb.value(), lambda x: callback(0.01 + x * 0.98))
             else:
-                start = time.time()
-                baseline = np.mean(file_io.load_file(self.video_list2_vidpath), axis=0, dtype=np.float32)
-                elapsed_mean = (time.time() - start)
-            callback(0.05)
-            start = time.time()
-            frames = np.divide(np.subtract(frames, baseline), baseline)
-            elapsed_divide = (time.time() - start)
-            callback(0.15)
-            start = time.time()
-            where_are_NaNs = np.isnan(frames)
-            elapsed_NaN = (time.time() - start)
-            callback(0.19)
-            start = time.time()
-            frames[where_are_NaNs] = 0
-            elapsed_where_are_NaNs = (time.time() - start)
-            callback(0.2)
-            start = time.time()
-            path = pfs.save_project(video_path, self.project, frames, self.Defaults.manip, 'video')
+                frames = file_io.open_stack(video_path)
+                if len(self.video_list2.selectedIndexes()) == 0:
+                    baseline = mean_frame(video_path, lambda x: callback(0.01 + x * 0.29))
+                else:
+                    baseline = mean_frame(self.video_list2_vidpath, lambda x: callback(0.01 + x * 0.29))
+                callback(0.3)
+                frames_out = file_io.create_stack(path, frames.shape, np.float32)
+                statistics = file_io.StackStatistics(frames.shape[1:], np.float32)
+                df_f0(frames, frames_out, baseline, lambda x: callback(0.3 + x * 0.69), statistics)
+                frames_out.flush()
+                del frames_out
+                statistics.save(path)
+            path = pfs.save_project(video_path, self.project, None, self.Defaults.manip, 'video')
             output_paths = output_paths + [path]
-            elapsed_save_project = (time.time() - start)
             callback(0.99)
-            start = time.time()
             pfs.refresh_list(self.project, self.video_list,
                              self.params[self.Labels.video_list_indices_label],
                              self.Defaults.list_display_type,
                              self.params[self.Labels.last_manips_to_display_label])
-            elapsed_refresh_all_list = (time.time() - start)
             callback(1)
         global_callback(1)
         return output_paths
@@ -172,6 +270,14 @@ class Widget(QWidget, WidgetDefault):
                                    "averaged baseline from the second list. If no image stack is selected in the "
                                    "second list then the averaged baseline is computed using each individual image "
                                    "stack selected in the first list")
+        self.baseline_mode_cb.setWhatsThis("Choose how F0 is computed. 'Mean of stack' uses one averaged baseline per "
+                                           "pixel. 'Sliding-window percentile' uses a baseline that follows slow "
+                                           "drift: for every frame, F0 is the chosen percentile of that pixel over "
+                                           "a window of frames centred on it. The f0 source list is not used in "
+                                           "this mode")
+        self.baseline_window_sb.setWhatsThis("Number of frames in the sliding window used to compute F0")
+        self.baseline_percentile_sb.setWhatsThis("Percentile of the window used as F0. 0 gives a running minimum, "
+                                                 "which is the fastest to compute")
 
 class MyPlugin(PluginDefault):
     def __init__(self, project=None, plugin_position=None):
@@ -1,24 +1,30 @@
 #!/usr/bin/env python3
 
 from .temporal_filter import *
+from .util import channel_expression
 from .util import custom_qt_items as cqt
+from .util.custom_qt_items import MyProgressDialog
 import qtutil
-import psutil
 from .util.plugin import PluginDefault
 from .util.plugin import WidgetDefault
 
 class Widget(QWidget, WidgetDefault):
+    reads_virtual_stacks = True
+
     class Labels(WidgetDefault.Labels):
-        pass
+        expression_label = 'Expression'
 
     class Defaults(WidgetDefault.Defaults):
-        pass
+        manip = 'channel_div'
+        expression_default = 'A/B'
 
     def __init__(self, project, plugin_position, parent=None):
         super(Widget, self).__init__(parent=parent)
 
         if not project or not isinstance(plugin_position, int):
             return
+        self.expression_edit = QLineEdit()
+        self.apply_butt = QPushButton('Apply expression')
         WidgetDefault.__init__(self, project=project, plugin_position=plugin_position)
 
     def setup_ui(self):
@@ -31,50 +37,78 @@ class Widget(QWidget, WidgetDefault):
         self.video_list.setDefaultDropAction(Qt.MoveAction)
         self.video_list.setDragDropOverwriteMode(False)
         self.video_list.setStyleSheet('QListView::item { height: 26px; }')
-        self.vbox.addWidget(cqt.InfoWidget('Press Ctrl or shift and then select your numerator first followed by '
-                                           'denominator. Files can be dragged in the video list for convenience '
-                                           'but the order does not determine which is the numerator and which the '
-                                           'denominator.'))
+        self.vbox.addWidget(cqt.InfoWidget('Press Ctrl or shift and select your image stacks. In the expression A is '
+                                           'the first stack selected, B the second and so on, e.g. A/B or '
+                                           '(A-B)/(A+B). Files can be dragged in the video list for convenience '
+                                           'but the order does not determine which stack is which letter.'))
+        self.vbox.addWidget(QLabel(self.Labels.expression_label))
+        self.vbox.addWidget(self.expression_edit)
         hhbox = QHBoxLayout()
-        div_butt = QPushButton('Divide first by second')
-        hhbox.addWidget(div_butt)
+        hhbox.addWidget(self.apply_butt)
         self.vbox.addLayout(hhbox)
         self.vbox.addStretch()
-        div_butt.clicked.connect(self.div_clicked)
 
-    def div_clicked(self):
-        summed_filesize = 0
-        for path in self.selected_videos:
-            summed_filesize = summed_filesize + os.path.getsize(path)
-        available = list(psutil.virtual_memory())[1]
-        if summed_filesize > available:
-            qtutil.critical("Not enough memory. Total is of size "+str(summed_filesize) +\
-               " and available memory is: " + str(available))
-            raise MemoryError("Not enough memory. Total is of size "+str(summed_filesize) +\
-               " and available memory is: " + str(available))
+    def setup_signals(self):
+        super().setup_signals()
+        self.apply_butt.clicked.connect(self.expression_clicked)
+
+    def setup_params(self, reset=False):
+        super().setup_params(reset)
+        if self.Labels.expression_label not in self.params or reset:
+            self.update_plugin_params(self.Labels.expression_label, self.Defaults.expression_default)
+        self.expression_edit.setText(self.params[self.Labels.expression_label])
 
+    def setup_param_signals(self):
+        super().setup_param_signals()
+        self.expression_edit.textChanged[str].connect(functools.partial(self.update_plugin_params,
+                                                                        self.Labels.expression_label))
 
+    def expression_clicked(self):
         paths = self.selected_videos
-        if len(paths) != 2:
-            qtutil.warning('Select 2 files to divide.')
+        expression = self.params[self.Labels.expression_label]
+        try:
+            tree = channel_expression.check(expression, len(paths))
+        except channel_expression.ExpressionError as e:
+            qtutil.critical(str(e))
             return
-        frames = [file_io.load_file(f) for f in paths]
-        min_len = min([len(f) for f in frames])
-        frames = np.divide(np.array(frames[0][0:min_len], dtype=np.float32),
-                           np.array(frames[1][0:min_len], dtype=np.float32))
-        if np.isinf(frames).any():
-            qtutil.critical("Infinite values detected. Are you sure you are dividing appropriate image stacks?")
-            qtutil.critical('Output will appear blank. Output is too small when scaled against infinite')
-        frames[np.isnan(frames)] = 0  # todo: is this okay?
-        frames = np.array(frames, dtype=np.float32)
+        used = channel_expression.channels(tree)
+        if not used:
+            qtutil.warning('The expression has to use at least one image stack.')
+            return
+        stacks = [file_io.open_stack(f) for f in paths]
+        if len(set(stacks[i].shape[1:] for i in used)) > 1:
+            qtutil.critical('All image stacks in the expression must have frames of the same size.')
+            return
+        min_len = min([len(stacks[i]) for i in used])
+        progress = MyProgressDialog('Channel Math', 'Evaluating ' + expression + '...', self)
+        progress.show()
+        def callback(x):
+            progress.setValue(x * 100)
+            QApplication.processEvents()
+        callback(0.01)
 
         # First one has to take the name otherwise pfs.save_projects doesn't work
-        manip = 'channel_div'
-        pfs.save_project(paths[0], self.project, frames, manip, 'video')
+        manip = self.Defaults.manip
+        path = pfs.get_output_path(paths[0], self.project, manip)
+        frames_out = file_io.create_stack(path, (min_len,) + stacks[used[0]].shape[1:], np.float32)
+        statistics = file_io.StackStatistics(frames_out.shape[1:], np.float32)
+        infinite = channel_expression.evaluate_expression(expression, stacks, frames_out,
+                                                          lambda x: callback(0.01 + x * 0.98),
+                                                          statistics=statistics)
+        frames_out.flush()
+        del frames_out
+        statistics.save(path)
+        if infinite:
+            qtutil.critical('Infinite values detected. Check that ' + expression + ' does not divide by zero or '
+                            'overflow for the selected image stacks.')
+            qtutil.critical('Output will appear blank. Output is too small when scaled against infinite')
+        output_path = pfs.save_project(paths[0], self.project, None, manip, 'video')
+        pfs.annotate_file(self.project, output_path, expression=expression)
         pfs.refresh_list(self.project, self.video_list,
                          self.params[self.Labels.video_list_indices_label],
                          self.Defaults.list_display_type,
                          self.params[self.Labels.last_manips_to_display_label])
+        callback(1)
 
 class MyPlugin(PluginDefault):
     def __init__(self, project, plugin_position):
@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 
-import psutil
 import qtutil
 
 from .temporal_filter import *
@@ -11,6 +10,8 @@ from .util.custom_qt_items import MyProgressDialog
 
 
 class Widget(QWidget, WidgetDefault):
+    reads_virtual_stacks = True
+
     class Labels(WidgetDefault.Labels):
         pass
 
@@ -33,8 +34,7 @@ class Widget(QWidget, WidgetDefault):
         self.video_list.setDragDropMode(QAbstractItemView.InternalMove)
         self.video_list.setDefaultDropAction(Qt.MoveAction)
         self.video_list.setDragDropOverwriteMode(False)
-        self.vbox.addWidget(cqt.InfoWidget('Note that there is no explicit progress bar. '
-                                           'Note that videos can be dragged and dropped in the list but that the order '
+        self.vbox.addWidget(cqt.InfoWidget('Note that videos can be dragged and dropped in the list but that the order '
                                            'in which they are *selected* determines concatenation order. The '
                                            'dragging and dropping is for convenience so you can organize your desired '
                                            'order and then shift select them from top to bottom to concatenate '
@@ -58,30 +58,25 @@ class Widget(QWidget, WidgetDefault):
         else:
             selected_videos = input_paths
 
-        summed_filesize = 0
-        for path in self.selected_videos:
-            summed_filesize = summed_filesize + os.path.getsize(path)
-        available = list(psutil.virtual_memory())[1]
-        if summed_filesize > available:
-            qtutil.critical("Not enough memory. Concatenated file is of size ~"+str(summed_filesize) +\
-               " and available memory is: " + str(available))
-            raise MemoryError("Not enough memory. Concatenated file is of size ~"+str(summed_filesize) +\
-               " and available memory is: " + str(available))
-
         paths = selected_videos
         if len(paths) < 2:
             qtutil.warning('Select multiple files to concatenate.')
             return
-        frames = [file_io.load_file(f) for f in paths]
+        stacks = [file_io.open_stack(f) for f in paths]
+        if len(set(stack.shape[1:] for stack in stacks)) > 1:
+            qtutil.critical('All files to concatenate must have frames of the same size.')
+            return
         progress = MyProgressDialog('Concatenation', 'Concatenating files...', self)
         progress.show()
         progress.setValue(1)
-        frames = np.concatenate(frames)
-        progress.setValue(99)
         # First one has to take the name otherwise pfs.save_projects doesn't work
         filenames = [os.path.basename(path) for path in paths]
         manip = 'concat-'+str(len(filenames))
-        output_path = pfs.save_project(paths[0], self.project, frames, manip, 'video')
+        # the concatenation is a virtual stack reading each input in turn
+        path = pfs.get_output_path(paths[0], self.project, manip)
+        file_io.save_virtual_stack(path, [source for f in paths for source in file_io.stack_sources(f)])
+        progress.setValue(99)
+        output_path = pfs.save_project(paths[0], self.project, None, manip, 'video')
         pfs.refresh_list(self.project, self.video_list,
                          self.params[self.Labels.video_list_indices_label],
                          self.Defaults.list_display_type,
@@ -97,20 +92,14 @@ class MyPlugin(PluginDefault):
         super().__init__(self.widget, self.widget.Labels, self.name)
 
     def check_ready_for_automation(self, expected_input_number):
-        self.summed_filesize = 0
-        for path in self.widget.selected_videos:
-            self.summed_filesize = self.summed_filesize + os.path.getsize(path)
-        self.available = list(psutil.virtual_memory())[1]
-        if self.summed_filesize > self.available:
-            return False
+        # the output is virtual, so the inputs' total size doesn't have to fit in memory
         return True
 
     def output_number_expected(self, expected_input_number=None):
         return 1
 
     def automation_error_message(self):
-        return "Not enough memory. Concatenated file is of size ~"+str(self.summed_filesize) +\
-               " and available memory is: " + str(self.available)
+        return "YOU SHOULD NOT BE ABLE TO SEE THIS"
 
 
 if __name__ == '__main__':
@@ -148,6 +148,8 @@ class DockWindowMat(DockWindow):
 
 
 class Widget(QWidget, WidgetDefault):
+    run_methods = ('connectivity_triggered',)
+
     class Labels(WidgetDefault.Labels):
         colormap_index_label = "Choose Colormap:"
         sb_min_label = "Min colormap range"
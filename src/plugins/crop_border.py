@@ -12,13 +12,43 @@ from .util import project_functions as pfs
 from .util.plugin import PluginDefault
 from .util.plugin import WidgetDefault
 
+def border_widths(frame_shape, percentage):
+    return round(percentage * frame_shape[0]), round(percentage * frame_shape[1])
+
+def crop_border_block(frames, cropped_y, cropped_x):
+    """Zero the border of a block of frames in place. Rows y < cropped_y or y > height - cropped_y and
+    columns x < cropped_x or x > width - cropped_x are zeroed"""
+    height, width = frames.shape[1:]
+    frames[:, :cropped_y] = 0
+    frames[:, height - cropped_y + 1:] = 0
+    frames[:, :, :cropped_x] = 0
+    frames[:, :, width - cropped_x + 1:] = 0
+    return frames
+
+def crop_border(frames_in, frames_out, percentage, callback=None, statistics=None):
+    """Copy frames_in to frames_out (typically both memory-mapped) one block of frames at a time,
+    zeroing the border of each block on the way and adding it to statistics if given"""
+    frames_in = file_io.as_stack(frames_in)
+    cropped_y, cropped_x = border_widths(frames_in.shape[1:], percentage)
+    for start, stop, block in frames_in.frame_blocks():
+        block = crop_border_block(block, cropped_y, cropped_x)
+        frames_out[start:stop] = block
+        if statistics is not None:
+            statistics.update(block, start)
+        if callback:
+            callback(stop / len(frames_in))
+    return frames_out
+
 
 class Widget(QWidget, WidgetDefault):
+  reads_virtual_stacks = True
+
   class Labels(WidgetDefault.Labels):
     crop_percentage_sb_label = "Crop Percentage"
 
   class Defaults(WidgetDefault.Defaults):
       crop_percentage_sb_default = 25
+      manip = 'crop-border'
 
   def __init__(self, project, plugin_position, parent=None):
     super(Widget, self).__init__(parent=parent)
@@ -84,38 +114,51 @@ class Widget(QWidget, WidgetDefault):
               selected_videos = self.selected_videos
       else:
           selected_videos = input_paths
-      # def crop_center(img, cropx, cropy):
-      #     """Function to crop center of an image file. Output is of size (cropx, cropy)"""
-      #     y, x = img.shape
-      #     startx = x // 2 - (cropx // 2)
-      #     starty = y // 2 - (cropy // 2)
-      #     return img[starty:starty + cropy, startx:startx + cropx]
+
+      global_progress = QProgressDialog('Total Progress Cropping Selection', 'Abort', 0, 100, self)
+      global_progress.setAutoClose(True)
+      global_progress.setMinimumDuration(0)
+      def global_callback(x):
+          global_progress.setValue(x * 100)
+          QApplication.processEvents()
       output_paths = []
-      for path in selected_videos:
-          frames = file_io.load_file(path, segment=[self.left_frame_range.value(), self.right_frame_range.value()])
+      total = len(selected_videos)
+      for i, video_path in enumerate(selected_videos):
+          global_callback(i / total)
+          progress = QProgressDialog('Cropping border of ' + video_path, 'Abort', 0, 100, self)
+          progress.setAutoClose(True)
+          progress.setMinimumDuration(0)
+          def callback(x):
+              progress.setValue(x * 100)
+              QApplication.processEvents()
+          frames_mmap = file_io.open_stack(video_path, segment=[self.left_frame_range.value(),
+                                                                self.right_frame_range.value()])
           percentage = self.crop_percentage_sb.value() / 100
-          # frames_cropped = np.empty((frames.shape[0], frames.shape[1], frames.shape[2]),
-          #               dtype=frames.dtype)
-          cropped_y = round(percentage * frames.shape[1])
-          cropped_x = round(percentage * frames.shape[2])
-          for frame_no in range(len(frames)):
-              for y in range(len(frames[frame_no])):
-                  for x in range(len(frames[frame_no][y])):
-                      if (x < cropped_x or x > frames.shape[2] - cropped_x) or\
-                              (y < cropped_y or y > frames.shape[1] - cropped_y):
-                          frames[frame_no][y][x] = 0
+
+          path = pfs.get_output_path(video_path, self.project, self.Defaults.manip)
+          frames = file_io.create_stack(path, frames_mmap.shape, frames_mmap.dtype)
+          statistics = file_io.StackStatistics(frames_mmap.shape[1:], frames_mmap.dtype)
+          crop_border(frames_mmap, frames, percentage, callback, statistics)
+          frames.flush()
+          del frames
+          statistics.save(path)
+          path = pfs.save_project(video_path, self.project, None, self.Defaults.manip, 'video')
           output_paths = output_paths + [path]
-          pfs.save_project(path, self.project, frames, 'crop-border', 'video')
           pfs.refresh_list(self.project, self.video_list,
                            self.params[self.Labels.video_list_indices_label],
                            self.Defaults.list_display_type,
                            self.params[self.Labels.last_manips_to_display_label])
+          callback(1)
+      global_callback(1)
       return output_paths
 
   def setup_whats_this(self):
       '''Setup custom help messages'''
-      # todo: setup custom help messages to aid the user, each tied to one of your UI components.
       super().setup_whats_this()
+      self.crop_percentage_sb.setWhatsThis("Percentage of the frame height and width zeroed along each edge of every "
+                                           "frame")
+      self.main_button.setWhatsThis("Zero the border of each selected image stack over the chosen range of frames. "
+                                    "Only frames within the range are saved")
 
 class MyPlugin(PluginDefault):
   def __init__(self, project, plugin_position):
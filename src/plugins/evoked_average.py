@@ -1,38 +1,268 @@
 #!/usr/bin/env python3
 
+import csv
+import functools
 import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 
 import numpy as np
-import psutil
 import qtutil
+from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 
+from .util import file_io
 from .util import project_functions as pfs
 from .util.plugin import PluginDefault
 from .util.plugin import WidgetDefault
 
 
+def accumulate_trials(trials, start, stop):
+    """float64 sum and sum of squares of frames start:stop over a group of trials"""
+    total = None
+    for trial in trials:
+        block = np.array(trial[start:stop], dtype=np.float64)
+        if total is None:
+            total, total_sq = block, np.square(block)
+        else:
+            total += block
+            total_sq += np.square(block)
+    return total, total_sq
+
+def evoked_averages(groups, outputs, callback=None, threads=None, memory_budget=file_io.CHUNK_BYTES,
+                    statistics=None):
+    """Mean and standard error across the trials of each group, in one sweep over blocks of frames shared by all
+    groups. groups maps a name to a list of (frames, width, height) trials at least as long as the outputs and
+    outputs maps the same names to float32 (usually memory-mapped) (mean_out, sem_out) pairs, sem_out may be None.
+    Trials are read in contiguous blocks of frames; each thread sums its own share of a group's trials in float64 and
+    the partial sums are added per block. statistics may map the names to (mean, sem) StackStatistics the written
+    blocks are added to"""
+    threads = max(1, threads or cpu_count())
+    tasks = []
+    for name, trials in groups.items():
+        group_threads = max(1, min(threads, len(trials)))
+        tasks = tasks + [(name, trials[i::group_threads]) for i in range(group_threads)]
+    first_mean_out = list(outputs.values())[0][0]
+    # each thread holds a sum, a sum of squares and a squared block in float64
+    stack = file_io.ChunkedStack(first_mean_out, memory_budget // (len(tasks) * 3 + 2))
+    with ThreadPoolExecutor(threads) as executor:
+        for start, stop in stack.frame_ranges(np.float64):
+            sums = {}
+            for (name, trials), partial in zip(tasks, executor.map(
+                    lambda task: accumulate_trials(task[1], start, stop), tasks)):
+                if name not in sums:
+                    sums[name] = partial
+                else:
+                    total, total_sq = sums[name]
+                    total += partial[0]
+                    total_sq += partial[1]
+            for name, (total, total_sq) in sums.items():
+                n = len(groups[name])
+                mean_out, sem_out = outputs[name]
+                mean = total / n
+                blocks = [mean.astype(np.float32)]
+                if sem_out is not None:
+                    # sample variance from the running sums, clipped at 0 against rounding
+                    variance = np.maximum(total_sq - total * mean, 0) / max(1, n - 1)
+                    blocks = blocks + [np.sqrt(variance / n).astype(np.float32)]
+                for i, block in enumerate(blocks):
+                    outputs[name][i][start:stop] = block
+                    if statistics is not None:
+                        statistics[name][i].update(block, start)
+            if callback:
+                callback(stop / len(first_mean_out))
+    return outputs
+
+def evoked_average(trials, mean_out, sem_out=None, callback=None, threads=None, memory_budget=file_io.CHUNK_BYTES):
+    """Mean and standard error across trials of every frame, written into the float32 (usually memory-mapped)
+    mean_out and sem_out. See evoked_averages"""
+    evoked_averages({None: trials}, {None: (mean_out, sem_out)}, callback, threads, memory_budget)
+    return mean_out, sem_out
+
+def read_events(csv_path, frame_rate=None):
+    """(frame, condition) of every event in a CSV whose first column is the event's frame index, or its time in
+    seconds when frame_rate is given, and whose optional second column is its condition. Rows whose first column
+    isn't a number, such as a header, are skipped"""
+    events = []
+    with open(csv_path, 'rt') as csvfile:
+        for row in csv.reader(csvfile):
+            if not row:
+                continue
+            try:
+                value = float(row[0])
+            except ValueError:
+                continue
+            frame = int(round(value * frame_rate)) if frame_rate else int(round(value))
+            condition = row[1].strip() if len(row) > 1 and row[1].strip() else 'all'
+            events.append((frame, condition))
+    return events
+
+def epochs(recording, events, pre, post):
+    """Group events by condition into epochs of recording: views of frames frame - pre to frame + post. No frames
+    are copied. Events whose window runs off either end of the recording are left out"""
+    groups = OrderedDict()
+    for frame, condition in events:
+        if frame - pre < 0 or frame + post > len(recording):
+            continue
+        groups.setdefault(condition, []).append(recording[frame - pre:frame + post])
+    return groups
+
 class Widget(QWidget, WidgetDefault):
+    run_methods = ('execute_primary_function', 'generate_epoch_averages')
+
     class Labels(WidgetDefault.Labels):
-        pass
+        events_path_label = 'Event file'
+        event_times_label = 'Event times in seconds'
+        frame_rate_label = 'Frame rate (Hz)'
+        pre_frames_label = 'Frames before event'
+        post_frames_label = 'Frames from event on'
 
     class Defaults(WidgetDefault.Defaults):
         manip = 'evoked-avg'
+        sem_manip = 'evoked-sem'
+        epoch_manip = 'epoch-avg'
+        epoch_sem_manip = 'epoch-sem'
+        events_path_default = ''
+        event_times_default = False
+        frame_rate_default = 30.0
+        pre_frames_default = 10
+        post_frames_default = 30
 
     def __init__(self, project, plugin_position, parent=None):
         super(Widget, self).__init__(parent=parent)
         if not project or not isinstance(plugin_position, int):
             return
         self.avg_button = QPushButton('Generate Evoked Average')
+        self.events_button = QPushButton('Choose event CSV...')
+        self.events_path_label = QLabel()
+        self.event_times_checkbox = QCheckBox(self.Labels.event_times_label)
+        self.frame_rate_sb = QDoubleSpinBox()
+        self.pre_frames_sb = QSpinBox()
+        self.post_frames_sb = QSpinBox()
+        self.epoch_button = QPushButton('Generate Epoch Averages')
         WidgetDefault.__init__(self, project=project, plugin_position=plugin_position)
 
     def setup_ui(self):
         super().setup_ui()
         self.vbox.addWidget(self.avg_button)
+        self.vbox.addWidget(QLabel('Epochs of a continuous recording'))
+        self.vbox.addWidget(self.events_button)
+        self.vbox.addWidget(self.events_path_label)
+        self.vbox.addWidget(self.event_times_checkbox)
+        self.vbox.addWidget(QLabel(self.Labels.frame_rate_label))
+        self.frame_rate_sb.setRange(0.001, 100000)
+        self.frame_rate_sb.setDecimals(3)
+        self.vbox.addWidget(self.frame_rate_sb)
+        self.vbox.addWidget(QLabel(self.Labels.pre_frames_label))
+        self.pre_frames_sb.setRange(0, 1000000)
+        self.vbox.addWidget(self.pre_frames_sb)
+        self.vbox.addWidget(QLabel(self.Labels.post_frames_label))
+        self.post_frames_sb.setRange(1, 1000000)
+        self.vbox.addWidget(self.post_frames_sb)
+        self.vbox.addWidget(self.epoch_button)
 
     def setup_signals(self):
         super().setup_signals()
         self.avg_button.clicked.connect(self.execute_primary_function)
+        self.events_button.clicked.connect(self.choose_events_file)
+        self.event_times_checkbox.stateChanged.connect(self.event_times_changed)
+        self.epoch_button.clicked.connect(self.generate_epoch_averages)
+
+    def setup_params(self, reset=False):
+        super().setup_params(reset)
+        if self.Labels.pre_frames_label not in self.params or reset:
+            self.update_plugin_params(self.Labels.events_path_label, self.Defaults.events_path_default)
+            self.update_plugin_params(self.Labels.event_times_label, self.Defaults.event_times_default)
+            self.update_plugin_params(self.Labels.frame_rate_label, self.Defaults.frame_rate_default)
+            self.update_plugin_params(self.Labels.pre_frames_label, self.Defaults.pre_frames_default)
+            self.update_plugin_params(self.Labels.post_frames_label, self.Defaults.post_frames_default)
+        self.events_path_label.setText(self.params[self.Labels.events_path_label])
+        self.event_times_checkbox.setChecked(self.params[self.Labels.event_times_label])
+        self.frame_rate_sb.setValue(self.params[self.Labels.frame_rate_label])
+        self.pre_frames_sb.setValue(self.params[self.Labels.pre_frames_label])
+        self.post_frames_sb.setValue(self.params[self.Labels.post_frames_label])
+        self.event_times_changed()
+
+    def setup_param_signals(self):
+        super().setup_param_signals()
+        self.event_times_checkbox.stateChanged[int].connect(functools.partial(self.update_plugin_params,
+                                                                              self.Labels.event_times_label))
+        self.frame_rate_sb.valueChanged[float].connect(functools.partial(self.update_plugin_params,
+                                                                         self.Labels.frame_rate_label))
+        self.pre_frames_sb.valueChanged[int].connect(functools.partial(self.update_plugin_params,
+                                                                       self.Labels.pre_frames_label))
+        self.post_frames_sb.valueChanged[int].connect(functools.partial(self.update_plugin_params,
+                                                                        self.Labels.post_frames_label))
+
+    def event_times_changed(self):
+        self.frame_rate_sb.setEnabled(self.event_times_checkbox.isChecked())
+
+    def choose_events_file(self):
+        events_path = QFileDialog.getOpenFileName(
+            self, 'Load event file', QSettings().value('last_load_text_path'), 'Event files (*.csv *.txt)')[0]
+        if not events_path:
+            return
+        QSettings().setValue('last_load_text_path', os.path.dirname(events_path))
+        self.events_path_label.setText(events_path)
+        self.update_plugin_params(self.Labels.events_path_label, events_path)
+
+    def generate_epoch_averages(self, input_paths=None):
+        """Average the epochs of every condition in the event file around its events in each selected recording"""
+        selected_videos = input_paths or self.selected_videos
+        events_path = self.params[self.Labels.events_path_label]
+        if not selected_videos or not events_path:
+            qtutil.warning('Select a recording and an event file.')
+            return
+        frame_rate = self.frame_rate_sb.value() if self.event_times_checkbox.isChecked() else None
+        events = read_events(events_path, frame_rate)
+        pre, post = self.pre_frames_sb.value(), self.post_frames_sb.value()
+
+        progress_global = QProgressDialog('Creating epoch averages...', 'Abort', 0, 100, self)
+        progress_global.setAutoClose(True)
+        progress_global.setMinimumDuration(0)
+        def global_callback(x):
+            progress_global.setValue(x * 100)
+            QApplication.processEvents()
+
+        output_paths = []
+        for i, video_path in enumerate(selected_videos):
+            recording = file_io.open_stack(video_path).frames
+            groups = epochs(recording, events, pre, post)
+            if not groups:
+                qtutil.warning('No events of ' + events_path + ' have a whole epoch within ' + video_path)
+                continue
+            shape = (pre + post,) + recording.shape[1:]
+            manips = OrderedDict()
+            outputs = OrderedDict()
+            statistics = OrderedDict()
+            for condition, trials in groups.items():
+                suffix = '_' + re.sub(r'[^\w-]', '-', condition) + '_' + str(len(trials))
+                manips[condition] = (self.Defaults.epoch_manip + suffix, self.Defaults.epoch_sem_manip + suffix)
+                outputs[condition] = tuple(
+                    file_io.create_stack(pfs.get_output_path(video_path, self.project, manip), shape, np.float32)
+                    for manip in manips[condition])
+                statistics[condition] = tuple(file_io.StackStatistics(shape[1:], np.float32)
+                                              for manip in manips[condition])
+            evoked_averages(groups, {condition: (mean_out.frames, sem_out.frames)
+                                     for condition, (mean_out, sem_out) in outputs.items()},
+                            lambda x: global_callback((i + x) / len(selected_videos)), statistics=statistics)
+            for condition in outputs:
+                for stack, manip, stack_statistics in zip(outputs[condition], manips[condition],
+                                                          statistics[condition]):
+                    stack.flush()
+                    stack_statistics.save(pfs.get_output_path(video_path, self.project, manip))
+            del outputs
+            for condition, (manip, sem_manip) in manips.items():
+                output_paths = output_paths + [pfs.save_project(video_path, self.project, None, manip, 'video')]
+                pfs.save_project(video_path, self.project, None, sem_manip, 'video')
+        global_callback(1)
+        pfs.refresh_list(self.project, self.video_list,
+                         self.params[self.Labels.video_list_indices_label],
+                         self.Defaults.list_display_type,
+                         self.params[self.Labels.last_manips_to_display_label])
+        return output_paths
 
     def execute_primary_function(self, input_paths=None):
         if not input_paths:
@@ -54,24 +284,27 @@ class Widget(QWidget, WidgetDefault):
         if len(filenames) < 2:
             qtutil.warning('Select multiple files to average.')
             return
-        stacks = [np.load(f, mmap_mode='r') for f in filenames]
-        lens = [len(stacks[x]) for x in range(len(stacks))]
-        min_lens = np.min(lens)
-
-        breadth = stacks[0].shape[1]
-        length = stacks[0].shape[2]
-
-        trig_avg = np.empty((min_lens, length, breadth), np.load(filenames[0], mmap_mode='r').dtype)
-        for frame_index in range(min_lens):
-            global_callback(frame_index / min_lens)
-            frames_to_avg = [stacks[stack_index][frame_index]
-                             for stack_index in range(len(stacks))]
-            frames_to_avg = np.array(frames_to_avg, dtype=np.float32)
-            avg = np.mean(frames_to_avg, axis=0, dtype=np.float32)
-            trig_avg[frame_index] = avg
-        global_callback(1)
+        stacks = [file_io.open_stack(f) for f in filenames]
+        min_lens = np.min([len(stack) for stack in stacks])
+        shape = (min_lens,) + stacks[0].shape[1:]
+
         manip = self.Defaults.manip + '_' + str(len(filenames))
-        output_path = pfs.save_project(filenames[0], self.project, trig_avg, manip, 'video')
+        sem_manip = self.Defaults.sem_manip + '_' + str(len(filenames))
+        mean_path = pfs.get_output_path(filenames[0], self.project, manip)
+        sem_path = pfs.get_output_path(filenames[0], self.project, sem_manip)
+        mean_out = file_io.create_stack(mean_path, shape, np.float32)
+        sem_out = file_io.create_stack(sem_path, shape, np.float32)
+        statistics = tuple(file_io.StackStatistics(shape[1:], np.float32) for path in (mean_path, sem_path))
+        evoked_averages({None: [stack.frames for stack in stacks]}, {None: (mean_out.frames, sem_out.frames)},
+                        global_callback, statistics={None: statistics})
+        mean_out.flush()
+        sem_out.flush()
+        del mean_out, sem_out
+        statistics[0].save(mean_path)
+        statistics[1].save(sem_path)
+        global_callback(1)
+        output_path = pfs.save_project(filenames[0], self.project, None, manip, 'video')
+        pfs.save_project(filenames[0], self.project, None, sem_manip, 'video')
         pfs.refresh_list(self.project, self.video_list,
                          self.params[self.Labels.video_list_indices_label],
                          self.Defaults.list_display_type,
@@ -82,7 +315,18 @@ class Widget(QWidget, WidgetDefault):
     def setup_whats_this(self):
         super().setup_whats_this()
         self.avg_button.setWhatsThis("Generate evoked average for selected image stacks where each frame is averaged "
-                                     "across image stacks for each frame")
+                                     "across image stacks for each frame. A stack of the standard error of the mean "
+                                     "across image stacks is saved alongside it")
+        self.events_button.setWhatsThis("Choose a CSV with one event per row for averaging epochs of a single "
+                                        "continuous recording. The first column is the frame the event happened on, "
+                                        "or its time in seconds if 'Event times in seconds' is checked. An optional "
+                                        "second column names the event's condition; each condition is averaged "
+                                        "separately. Rows that don't start with a number, like headers, are ignored")
+        self.epoch_button.setWhatsThis("For each selected recording, average the frames around every event of each "
+                                       "condition, from 'Frames before event' before it up to 'Frames from event on' "
+                                       "after it. Epochs are read straight from the recording and all conditions are "
+                                       "averaged in one pass. Events too close to either end of the recording are "
+                                       "skipped. A mean and a standard error stack are saved per condition")
 
 class MyPlugin(PluginDefault):
     def __init__(self, project, plugin_position):
@@ -91,15 +335,9 @@ class MyPlugin(PluginDefault):
         super().__init__(self.widget, self.widget.Labels, self.name)
 
     def check_ready_for_automation(self, expected_input_number):
-        self.summed_filesize = 0
-        for path in self.widget.selected_videos:
-            self.summed_filesize = self.summed_filesize + os.path.getsize(path)
-        self.available = list(psutil.virtual_memory())[1]
-        if self.summed_filesize > self.available:
-            return False
+        # trials are streamed from disk, so their total size no longer has to fit in memory
         return True
 
     def automation_error_message(self):
-        return "Not enough memory. All files to be averaged together are of size ~"+str(self.summed_filesize) +\
-               " and available memory is: " + str(self.available)
+        return "YOU SHOULD NOT BE ABLE TO SEE THIS"
 
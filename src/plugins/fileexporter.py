@@ -62,6 +62,8 @@ class Exporter(QWidget):
                                    'This fixes this issue in most cases.', self)
 
 class Widget(QWidget, WidgetDefault):
+  run_methods = ('export_clicked', 'export_bulk_clicked')
+
   class Labels(WidgetDefault.Labels):
     export_dtype_label = 'export_dtype_label'
     export_framerate_label = 'Export Framerate'
@@ -6,17 +6,16 @@ import sys
 import traceback
 from shutil import copyfile
 
-import numpy as np
 import psutil
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 
 sys.path.append('..')
 import qtutil
-import tifffile as tiff
 from .util.plugin import PluginDefault
 
 from .util import file_io, fileconverter
+from .util import project_functions as pfs
 from .util import custom_qt_items as cqt
 
 class NotConvertedError(Exception):
@@ -34,6 +33,8 @@ class Widget(QWidget):
     height_label = "Height"
     no_channels_label = "Number of channels"
     dtype_label = "dtype"
+    all_channels_label = "Import all channels"
+    temporal_bin_label = "Temporal binning"
 
   class Defaults:
     scale_factor_default = 1.00
@@ -42,6 +43,8 @@ class Widget(QWidget):
     height_default = 256
     no_channels_default = 3
     dtype_default = 0
+    all_channels_default = False
+    temporal_bin_default = 1
 
   def __init__(self, project, plugin_position, parent=None):
     super(Widget, self).__init__(parent=parent)
@@ -79,6 +82,12 @@ class Widget(QWidget):
     self.sb_height.setValue(self.params[self.Labels.height_label])
     self.sb_channel.setValue(self.params[self.Labels.no_channels_label])
     self.cb_dtype.setCurrentIndex(self.params[self.Labels.dtype_label])
+    if self.Labels.all_channels_label not in self.params:
+        self.update_plugin_params(self.Labels.all_channels_label, self.Defaults.all_channels_default)
+    self.all_channels_cb.setChecked(self.params[self.Labels.all_channels_label])
+    if self.Labels.temporal_bin_label not in self.params:
+        self.update_plugin_params(self.Labels.temporal_bin_label, self.Defaults.temporal_bin_default)
+    self.temporal_bin_sb.setValue(self.params[self.Labels.temporal_bin_label])
 
   def setup_ui(self):
     vbox = QVBoxLayout()
@@ -95,55 +104,63 @@ class Widget(QWidget):
     self.scale_factor.setMaximum(1.00)
     self.scale_factor.setValue(1.0)
     grid.addWidget(self.scale_factor, 1, 1)
+    grid.addWidget(QLabel('Temporal binning (frames averaged):'), 2, 0)
+    self.temporal_bin_sb = QSpinBox()
+    self.temporal_bin_sb.setMinimum(1)
+    self.temporal_bin_sb.setMaximum(100)
+    self.temporal_bin_sb.setValue(1)
+    grid.addWidget(self.temporal_bin_sb, 2, 1)
 
-    grid.addWidget(qtutil.separator(), 2, 0)
-    grid.addWidget(qtutil.separator(), 2, 1)
+    grid.addWidget(qtutil.separator(), 3, 0)
+    grid.addWidget(qtutil.separator(), 3, 1)
 
-    grid.addWidget(QLabel('This section only applies to imported raw files.'), 3, 0)
-    grid.addWidget(QLabel('All imported raws will also be rescaled using the above value'), 4, 0)
+    grid.addWidget(QLabel('This section only applies to imported raw files.'), 4, 0)
+    grid.addWidget(QLabel('All imported raws will also be rescaled using the above value'), 5, 0)
 
-    grid.addWidget(QLabel('Width:'), 5, 0)
+    grid.addWidget(QLabel('Width:'), 6, 0)
     self.sb_width = QSpinBox()
     self.sb_width.setMinimum(1)
     self.sb_width.setMaximum(1024)
     self.sb_width.setValue(256)
-    grid.addWidget(self.sb_width, 5, 1)
-    grid.addWidget(QLabel('Height:'), 6, 0)
+    grid.addWidget(self.sb_width, 6, 1)
+    grid.addWidget(QLabel('Height:'), 7, 0)
     self.sb_height = QSpinBox()
     self.sb_height.setMinimum(1)
     self.sb_height.setMaximum(1024)
     self.sb_height.setValue(256)
-    grid.addWidget(self.sb_height, 6, 1)
-    grid.addWidget(QLabel('Number of channels in raw:'), 7, 0)
+    grid.addWidget(self.sb_height, 7, 1)
+    grid.addWidget(QLabel('Number of channels in raw:'), 8, 0)
     self.sb_channel = QSpinBox()
     self.sb_channel.setMinimum(1)
     self.sb_channel.setMaximum(3)
     self.sb_channel.setValue(3)
-    grid.addWidget(self.sb_channel, 7, 1)
+    grid.addWidget(self.sb_channel, 8, 1)
 
-    grid.addWidget(QLabel('Channel in raw to be imported:'), 8, 0)
+    grid.addWidget(QLabel('Channel in raw to be imported:'), 9, 0)
     self.channel = QSpinBox()
     self.channel.setMinimum(1)
     self.channel.setMaximum(3)
     self.channel.setValue(2)
-    grid.addWidget(self.channel, 8, 1)
+    grid.addWidget(self.channel, 9, 1)
+    self.all_channels_cb = QCheckBox('Import all channels in raw, one file each')
+    self.all_channels_cb.toggled[bool].connect(self.channel.setDisabled)
+    grid.addWidget(self.all_channels_cb, 10, 0)
 
-    grid.addWidget(QLabel('Raw dtype:'), 9, 0)
+    grid.addWidget(QLabel('Raw dtype:'), 11, 0)
     self.cb_dtype = QComboBox()
     for t in 'uint8', 'float32', 'float64':
       self.cb_dtype.addItem(t)
-    grid.addWidget(self.cb_dtype, 9, 1)
-    grid.addWidget(qtutil.separator(), 10, 0)
-    grid.addWidget(qtutil.separator(), 10, 1)
+    grid.addWidget(self.cb_dtype, 11, 1)
+    grid.addWidget(qtutil.separator(), 12, 0)
+    grid.addWidget(qtutil.separator(), 12, 1)
     vbox.addLayout(grid)
 
     self.setLayout(vbox)
     self.resize(400, 220)
 
-    vbox.addWidget(cqt.WarningWidget('Warning. This application has not been memory optimized for conversion.'
-                                     ' We advise you only import raw or tiff files no larger than 1/4 of your memory. '
-                                     'e.g. If you have 8GB RAM then we recommend not importing a raw or tiff larger '
-                                     'than 2GB. It may or may not freeze your system otherwise.'
+    vbox.addWidget(cqt.WarningWidget('Raw and tiff files are converted and binned block by block, so files larger '
+                                     'than your memory can be imported. Make sure the project folder has enough '
+                                     'free disk space for the converted image stacks.'
                                      '\n \n'
                                      'Press the button below to proceed once all parameters above have been set.'))
     pb = QPushButton('Import Image Stack(s)')
@@ -168,6 +185,10 @@ class Widget(QWidget):
                                                                   self.Labels.no_channels_label))
       self.cb_dtype.currentIndexChanged[int].connect(functools.partial(self.update_plugin_params,
                                                                        self.Labels.dtype_label))
+      self.all_channels_cb.toggled[bool].connect(functools.partial(self.update_plugin_params,
+                                                                   self.Labels.all_channels_label))
+      self.temporal_bin_sb.valueChanged[int].connect(functools.partial(self.update_plugin_params,
+                                                                       self.Labels.temporal_bin_label))
 
   def update_plugin_params(self, key, val):
       self.params[key] = val
@@ -175,29 +196,35 @@ class Widget(QWidget):
       self.project.save()
 
 
+  def npy_path(self, filename, suffix=''):
+    """Path in the project for the .npy converted from filename, numbered so no existing file is overwritten"""
+    new_filename = os.path.basename(filename)[:-4] + suffix
+    new_filename = os.path.join(self.project.path, new_filename) + '.npy'
+    if not os.path.isfile(new_filename):
+        return new_filename
+    i = 1
+    path_after = new_filename
+    while os.path.isfile(path_after):
+        name_after = new_filename[:-4] + '(' + str(i) + ')' + '.npy'
+        path_after = os.path.join(self.project.path, name_after)
+        i = i + 1
+    return path_after
+
   def convert_raw(self, filename):
     rescale_value = float(self.scale_factor.value())
+    temporal_bin = int(self.temporal_bin_sb.value())
     dtype = str(self.cb_dtype.currentText())
     height = int(self.sb_width.value())
     width = int(self.sb_height.value())
-    rescale_width = int(width * rescale_value)
-    rescale_height = int(height * rescale_value)
     channels = int(self.sb_channel.value())
     channel = int(self.channel.value())
-    # todo: figure out whether channel goes in path name or somehow in
-    new_filename = os.path.basename(filename)[:-4]
-    new_filename = os.path.join(self.project.path, new_filename) + '.npy'
-    if os.path.isfile(new_filename):
-        i = 1
-        path_after = new_filename
-        while os.path.isfile(path_after):
-            name_after = new_filename[:-4] + '(' + str(i) + ')' + '.npy'
-            path_after = os.path.join(self.project.path, name_after)
-            i = i + 1
-        path = path_after
+    # one output per imported channel, None for the channels left out
+    paths = [None] * channels
+    if self.all_channels_cb.isChecked():
+        for channel in range(1, channels + 1):
+            paths[channel - 1] = self.npy_path(filename, '_channel' + str(channel))
     else:
-        path = os.path.splitext(os.path.basename(filename))[0] + '.npy'
-        path = os.path.join(self.project.path, path)
+        paths[channel - 1] = self.npy_path(filename)
 
     progress = QProgressDialog('Converting raw to npy...', 'Abort', 0, 100, self)
     progress.setAutoClose(True)
@@ -209,15 +236,17 @@ class Widget(QWidget):
       QApplication.processEvents()
 
     try:
-        fileconverter.raw2npy(filename, path, dtype, width, height, channels, channel, callback)
+        fileconverter.raw2npy_channels(filename, paths, dtype, width, height, channels, callback,
+                                       scale_factor=rescale_value, temporal_bin=temporal_bin)
     except:
       warn_msg = "Continue trying to convert raw to npy despite problems? Your data might be corrupt."
       reply = QMessageBox.question(self, 'Import Issues Detected',
                                    warn_msg, QMessageBox.Yes | QMessageBox.No)
       if reply == QMessageBox.Yes:
           try:
-              fileconverter.raw2npy(filename, path, dtype, width, height, channels, channel, callback,
-                                    ignore_shape_error=True)
+              fileconverter.raw2npy_channels(filename, paths, dtype, width, height, channels, callback,
+                                             ignore_shape_error=True, scale_factor=rescale_value,
+                                             temporal_bin=temporal_bin)
           except:
               qtutil.critical('Converting raw to npy still fails.')
               progress.close()
@@ -225,37 +254,12 @@ class Widget(QWidget):
       if reply == QMessageBox.No:
           return
 
-    ret_filename = path
-    if rescale_value != 1.00:
-      unscaled = np.load(path)
-      no_frames = len(unscaled)
-      try:
-        scaled = self.bin_ndarray(unscaled, (no_frames, rescale_height,
-                                    rescale_width), callback, operation='mean')
-        np.save(path, scaled)
-      except:
-        qtutil.critical("Rebinning raw failed. Please check your scale factor. Use the Help -> 'Whats this' feature"
-                        " on the scale factor for more info.")
-        progress.close()
-    return ret_filename
+    return [path for path in paths if path is not None]
 
   def convert_tif(self, filename):
     rescale_value = float(self.scale_factor.value())
-    channel = int(self.channel.value())
-
-    new_filename = os.path.basename(filename)[:-4]
-    new_filename = os.path.join(self.project.path, new_filename) + '.npy'
-    if os.path.isfile(new_filename):
-        i = 1
-        path_after = new_filename
-        while os.path.isfile(path_after):
-            name_after = new_filename[:-4] + '(' + str(i) + ')' + '.npy'
-            path_after = os.path.join(self.project.path, name_after)
-            i = i + 1
-        path = path_after
-    else:
-        path = os.path.splitext(os.path.basename(filename))[0] + '.npy'
-        path = os.path.join(self.project.path, path)
+    temporal_bin = int(self.temporal_bin_sb.value())
+    path = self.npy_path(filename)
 
     progress = QProgressDialog('Converting tif to npy...', 'Abort', 0, 100, self)
     progress.setAutoClose(True)
@@ -267,45 +271,32 @@ class Widget(QWidget):
       QApplication.processEvents()
 
     try:
-      fileconverter.tif2npy(filename, path, callback)
+      fileconverter.tif2npy(filename, path, callback, scale_factor=rescale_value, temporal_bin=temporal_bin)
     except:
       tb = traceback.format_exc()
       qtutil.critical('Converting tiff to npy failed. Reason:\n' + str(tb))
       progress.close()
-    else:
-      ret_filename = path
-      with tiff.TiffFile(filename) as tif:
-        if rescale_value != 1.00:
-          w, h = tif[0].shape
-          rescale_width = int(w * rescale_value)
-          rescale_height = int(h * rescale_value)
-          no_frames = len(tif)
-          unscaled = np.load(path)
-          try:
-            scaled = self.bin_ndarray(unscaled, (no_frames, rescale_height,
-                                        rescale_width), callback, operation='mean')
-            np.save(path, scaled)
-          except:
-            qtutil.critical('Rebinning tiff failed. We can only scale down from larger sized files to preserve data')
-            progress.close()
-    return ret_filename
+      return None
+    return path
 
   def to_npy(self, filename):
+    """Convert a raw or tif into the project, returning the paths of the .npy files made from it"""
     if filename.endswith('.raw'):
-      filename = self.convert_raw(filename)
+      filenames = self.convert_raw(filename)
     elif filename.endswith('.tif'):
-      filename = self.convert_tif(filename)
+      filenames = [self.convert_tif(filename)]
     else:
       raise file_io.UnknownFileFormatError()
-    return filename
+    return filenames
 
   def import_file(self, filename):
+    """Import filename into the project, returning the paths of the project files added for it. Raws imported with
+    all their channels add one file per channel"""
     if not filename.endswith('.npy'):
-      new_filename = self.to_npy(filename)
-      if not new_filename:
+      new_filenames = self.to_npy(filename)
+      if not new_filenames or None in new_filenames:
         raise NotConvertedError()
-      else:
-        filename = new_filename
+      return [self.add_file(new_filename) for new_filename in new_filenames]
     else:
       new_filename = os.path.basename(filename)
       new_filename = os.path.join(self.project.path, new_filename)
@@ -322,16 +313,20 @@ class Widget(QWidget):
               QApplication.processEvents()
           callback(0.0)
           if copyfile_progress.wasCanceled():
-              return
+              return []
           copyfile(filename, new_filename)
           if copyfile_progress.wasCanceled():
-              return
+              return []
           callback(1.0)
       filename = new_filename
+    return [self.add_file(filename)]
 
+  def add_file(self, filename):
     if filename in [f['path'] for f in self.project.files]:
       return filename
       # raise FileAlreadyInProjectError(filename)
+    if file_io.load_statistics(filename) is None:
+      pfs.save_statistics(filename)
 
     name, ext = os.path.splitext(os.path.basename(filename))
 
@@ -350,15 +345,16 @@ class Widget(QWidget):
       if filename in [f['path'] for f in self.project.files]:
         continue
       try:
-        imported_path = self.import_file(filename)
+        new_imported_paths = self.import_file(filename)
       except NotConvertedError:
         qtutil.warning('Skipping file \'{}\' since not converted.'.format(filename))
       except:
         qtutil.critical('Import of \'{}\' failed:\n'.format(filename) +\
           traceback.format_exc())
       else:
-        self.listview.model().appendRow(QStandardItem(imported_path))
-        imported_paths = imported_paths + [imported_path]
+        for imported_path in new_imported_paths:
+          self.listview.model().appendRow(QStandardItem(imported_path))
+        imported_paths = imported_paths + new_imported_paths
     return imported_paths
 
   def execute_primary_function(self, input_paths=None):
@@ -392,54 +388,20 @@ class Widget(QWidget):
       QSettings().setValue('last_load_data_path', os.path.dirname(filenames[0]))
       return filenames
 
-  def bin_ndarray(self, ndarray, new_shape, progress_callback, operation='sum'):
-    """
-    Bins an ndarray in all axes based on the target shape, by summing or
-        averaging.
-
-    Number of output dimensions must match number of input dimensions and
-        new axes must divide old ones.
-
-    Example
-    -------
-    #>>> m = np.arange(0,100,1).reshape((10,10))
-    #>>> n = bin_ndarray(m, new_shape=(5,5), operation='sum')
-    #>>> print(n)
-
-    [[ 22  30  38  46  54]
-     [102 110 118 126 134]
-     [182 190 198 206 214]
-     [262 270 278 286 294]
-     [342 350 358 366 374]]
-
-    """
-    operation = operation.lower()
-    if not operation in ['sum', 'mean']:
-      raise ValueError("Operation not supported.")
-    if ndarray.ndim != len(new_shape):
-      raise ValueError("Shape mismatch: {} -> {}".format(ndarray.shape,
-                                                         new_shape))
-    compression_pairs = [(d, c // d) for d, c in zip(new_shape,
-                                                     ndarray.shape)]
-    flattened = [l for p in compression_pairs for l in p]
-    ndarray = ndarray.reshape(flattened)
-    for i in range(len(new_shape)):
-      progress_callback(i / len(new_shape))
-      op = getattr(ndarray, operation)
-      ndarray = op(-1 * (i + 1))
-    progress_callback(1)
-    return ndarray
-
   def setup_whats_this(self):
       self.scale_factor.setWhatsThis("Scales the imported image stack down by this factor. e.g a 256x256 image stack "
-                                     "will be 128x128 with this set to 0.5. Note that import values that don't "
-                                     "scale your image stack down to a height and width where both are integers you "
-                                     "will receive an error. e.g you cannot scale a 128x128 by 0.6 as this will "
-                                     "attempt to create a 76.8x76.8 file which is not possible as we cannot have"
-                                     "'0.6' of a pixel.")
+                                     "will be 128x128 with this set to 0.5. Each new pixel is the average of the "
+                                     "pixels it covers, so factors that don't divide the image size evenly, e.g. "
+                                     "0.6 of 128x128 giving 76x76, are resampled without aliasing. Scaled stacks "
+                                     "are stored as float32")
+      self.temporal_bin_sb.setWhatsThis("Average every this many consecutive frames into one while importing. A last "
+                                        "shorter group of frames is averaged over the frames it has")
       self.channel.setWhatsThis("Set which channel is imported from your raw. Only one channel imports are "
                                 "currently supported for tiff files a npy files. Please separate your multi-channel"
                                 "tiff image stacks into separate files one per channel to import all the channels")
+      self.all_channels_cb.setWhatsThis("Import every channel of a raw in one pass over the file. Each channel is "
+                                        "saved and added to the project as its own file, named after the raw with "
+                                        "_channel1, _channel2, ... appended")
       self.sb_width.setWhatsThis("Raw files lack headers so file shape needs to be specified manually")
       self.sb_height.setWhatsThis("Raw files lack headers so file shape needs to be specified manually")
       self.sb_channel.setWhatsThis("Set how many channel the raw has since raw files do not have headers specifying "
@@ -9,31 +9,48 @@ from .util.plugin import PluginDefault
 from .util.plugin import WidgetDefault
 
 
-def gsr(frames, width, height, progress_callback):
-    frames[np.isnan(frames)] = 0
-    progress_callback(0.2)
-    # Reshape into time and space
-    frames = np.reshape(frames, (frames.shape[0], width*height))
-    progress_callback(0.3)
-    mean_g = np.mean(frames, axis=1, dtype=np.float32)
-    progress_callback(0.4)
-    g_plus = np.squeeze(np.linalg.pinv([mean_g]))
-    progress_callback(0.5)
-    beta_g = np.dot(g_plus, frames)
-    progress_callback(0.6)
-    # print('mean_g = '+str(np.shape(mean_g)))
-    # print('beta_g = '+str(np.shape(beta_g)))
-    global_signal = np.dot(np.asarray([mean_g]).T, [beta_g])
-    progress_callback(0.7)
-    frames = frames - global_signal
-    progress_callback(0.8)
-    frames = np.reshape(frames, (frames.shape[0], width, height))
-    progress_callback(0.9)
-    return frames
-
+def global_signal(frames, callback=None):
+    """First pass: the global mean trace g (NaNs counted as 0) and, per pixel, the numerator g . f of its
+    regression coefficient. Both only depend on the frames seen so far, so one pass over blocks of frames is enough"""
+    frames = file_io.as_stack(frames)
+    mean_g = np.zeros(len(frames), dtype=np.float64)
+    g_dot_f = np.zeros(frames.num_pixels, dtype=np.float64)
+    for start, stop, block in frames.frame_blocks(np.float32):
+        block = np.reshape(block, (stop - start, frames.num_pixels))
+        block[np.isnan(block)] = 0
+        mean_g[start:stop] = np.mean(block, axis=1, dtype=np.float64)
+        g_dot_f += np.dot(mean_g[start:stop], block)
+        if callback:
+            callback(stop / len(frames))
+    return mean_g, g_dot_f
+
+def gsr(frames_in, frames_out, callback=None, statistics=None):
+    """Regress the global mean trace out of every pixel of frames_in, writing the residuals into the float32
+    frames_out (usually memory-mapped). Two passes over blocks of frames: the global trace and betas, then the
+    subtraction of each block's part of the global signal, so the (frames, pixels) global signal is only ever formed
+    one block at a time. Residual blocks are added to statistics if given"""
+    frames_in = file_io.as_stack(frames_in)
+    mean_g, g_dot_f = global_signal(frames_in, lambda x: callback(x * 0.5) if callback else None)
+    # pinv of the single regressor g is g / (g . g)
+    g_dot_g = np.dot(mean_g, mean_g)
+    beta_g = (g_dot_f / g_dot_g if g_dot_g else np.zeros_like(g_dot_f)).astype(np.float32)
+    mean_g = mean_g.astype(np.float32)
+    for start, stop, block in frames_in.frame_blocks(np.float32):
+        block = np.reshape(block, (stop - start, frames_in.num_pixels))
+        block[np.isnan(block)] = 0
+        block -= np.outer(mean_g[start:stop], beta_g)
+        block = np.reshape(block, (stop - start,) + frames_in.shape[1:])
+        frames_out[start:stop] = block
+        if statistics is not None:
+            statistics.update(block, start)
+        if callback:
+            callback(0.5 + 0.5 * stop / len(frames_in))
+    return frames_out
 
 
 class Widget(QWidget, WidgetDefault):
+  reads_virtual_stacks = True
+
   class Labels(WidgetDefault.Labels):
     pass
 
@@ -84,12 +101,15 @@ class Widget(QWidget, WidgetDefault):
             progress.setValue(x * 100)
             QApplication.processEvents()
         callback(0.01)
-        frames = file_io.load_file(video_path)
-        callback(0.1)
-        width = frames.shape[1]
-        height = frames.shape[2]
-        frames = gsr(frames, width, height, callback)
-        path = pfs.save_project(video_path, self.project, frames, self.Defaults.manip, 'video')
+        frames = file_io.open_stack(video_path)
+        path = pfs.get_output_path(video_path, self.project, self.Defaults.manip)
+        frames_out = file_io.create_stack(path, frames.shape, np.float32)
+        statistics = file_io.StackStatistics(frames.shape[1:], np.float32)
+        gsr(frames, frames_out, lambda x: callback(0.01 + x * 0.98), statistics)
+        frames_out.flush()
+        del frames_out
+        statistics.save(path)
+        path = pfs.save_project(video_path, self.project, None, self.Defaults.manip, 'video')
         output_paths = output_paths + [path]
         pfs.refresh_list(self.project, self.video_list,
                          self.params[self.Labels.video_list_indices_label],
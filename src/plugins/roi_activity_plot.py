@@ -415,6 +415,8 @@ class DockWindowPlot(DockWindow):
 
 
 class Widget(QWidget, WidgetDefault):
+  run_methods = ('plot_triggered',)
+
   class Labels(WidgetDefault.Labels):
     window_type = 'activity_plot_window'
 
@@ -3,11 +3,9 @@
 import ast
 import os
 import sys
-import traceback
 from os import listdir
 from os.path import isfile, join
 
-import numpy as np
 from PyQt5 import QtGui
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
@@ -15,18 +13,10 @@ from PyQt5.QtGui import *
 sys.path.append('..')
 import qtutil
 from project import Project
-import imreg_dft as ird
 
 from .util.mygraphicsview import MyGraphicsView
 from .util import project_functions as pfs
-from .util import file_io
-
-class NotConvertedError(Exception):
-  pass
-
-class FileAlreadyInProjectError(Exception):
-  def __init__(self, filename):
-    self.filename = filename
+from .util import registration
 
 class Widget(QWidget):
   def __init__(self, project, parent=None):
@@ -177,29 +167,16 @@ class Widget(QWidget):
               progress.setValue(x * 100)
               QApplication.processEvents()
           project_from = Project(os.path.dirname(self.selected_videos[i]))
-          frames = file_io.load_file(video_path)
           [x_shift_from, y_shift_from] = project_from['origin']
           x_shift = self.x - x_shift_from
           y_shift = y_shift_from - self.y
           shift = [y_shift, x_shift]
-          shifted_frames = self.apply_shift(frames, shift, callback)
-          # and save to project
-          pre_shifted_basename = os.path.splitext(os.path.basename(video_path))[0]
-          manip = '_shift_from_' + project_from.name
+          # shifted straight into the output in this project, then registered through the shared save path
+          manip = 'shift_from_' + project_from.name
           manips = manips + [manip]
-          path_after = str(os.path.join(self.project.path, pre_shifted_basename+manip) + '.npy')
-          file_io.save_file(path_after, shifted_frames)
-          name_after = os.path.splitext(os.path.basename(path_after))[0]
-          if path_after in [f['path'] for f in self.project.files]:
-              raise FileAlreadyInProjectError(path_after)
-          self.project.files.append({
-              'name': name_after,
-              'path': path_after,
-              'type': 'video',
-              'manipulations': str([manip])
-          })
-          self.project.save()
-          # self.save_project(path_after, self.project, shifted_frames, manip, 'video')
+          path_after = pfs.get_output_path(video_path, self.project, manip)
+          self.apply_shift(video_path, path_after, shift, callback)
+          pfs.save_project(video_path, self.project, None, manip, 'video', project_from)
           self.refresh_all_list(self.project, self.list_shifted, manips)
       callback_global(1)
 
@@ -219,59 +196,12 @@ class Widget(QWidget):
                   video_list.model().appendRow(QStandardItem(f['name']))
       # video_list.setCurrentIndex(video_list.model().index(0, 0))
 
-  def save_project(self, video_path, project, frames, manip, file_type):
-      name_before, ext = os.path.splitext(os.path.basename(video_path))
-      file_before = [files for files in project.files if files['name'] == name_before]
-      assert (len(file_before) == 1)
-      file_before = file_before[0]
-
-      name_after = str(name_before + '_' + manip)
-      path = str(os.path.join(project.path, name_after) + '.npy')
-      if frames is not None:
-          if os.path.isfile(path):
-              os.remove(path)
-          np.save(path, frames)
-      if not file_before['manipulations'] == []:
-          project.files.append({
-              'path': path,
-              'type': file_type,
-              'source_video': video_path,
-              'manipulations': str(ast.literal_eval(file_before['manipulations']) + [manip]),
-              'name': name_after
-          })
-      else:
-          project.files.append({
-              'path': path,
-              'type': file_type,
-              'source_video': video_path,
-              'manipulations': str([manip]),
-              'name': name_after
-          })
-      project.save()
-
-  def apply_shift(self, frames, shift, progress_callback):
-      shifted_frames = []
-      for frame_no, frame in enumerate(frames):
-          progress_callback(frame_no / float(len(frames)))
-          shifted_frames.append(ird.transform_img(frame, tvec=shift))
+  def apply_shift(self, video_path, path_after, shift, progress_callback):
+      """Translate every frame of video_path by shift (Y, X) into a new stack at path_after, block by block across
+      worker processes so memory use doesn't grow with the stack"""
+      registration.apply_shifts(video_path, path_after, dict(tvec=shift, angle=0.0), progress_callback)
       progress_callback(1)
-      return np.array(shifted_frames)
-
-  def import_files(self, filenames):
-    for filename in filenames:
-        if filename in [f['path'] for f in self.project.files]:
-            continue
-        try:
-            filename = self.import_file(filename)
-        except NotConvertedError:
-            qtutil.warning('Skipping file \'{}\' since not converted.'.format(filename))
-        except FileAlreadyInProjectError as e:
-            qtutil.warning('Skipping file \'{}\' since already in project.'.format(e.filename))
-        except:
-            qtutil.critical('Import of \'{}\' failed:\n'.format(filename) + \
-                            traceback.format_exc())
-        else:
-            self.listview.model().appendRow(QStandardItem(filename))
+      return path_after
 
   def setup_whats_this(self):
       self.new_json_pb.setWhatsThis("Select the folder of another project to load all files in that project that can "
@@ -3,11 +3,11 @@
 import functools
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 
 import PyQt5
 import numpy as np
-import psutil
-import qtutil
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from scipy import ndimage
@@ -18,7 +18,50 @@ from .util.plugin import PluginDefault
 from .util.plugin import WidgetDefault
 
 
+def box_filter(frames, size, output=None):
+    """Mean over the size x size neighbourhood of every pixel of a block of frames, zero-padded at the edges.
+    Equivalent to convolving each frame with a mean kernel but built from separable running sums, so the
+    cost does not depend on size"""
+    # even kernels are centred like ndimage.convolve rather than ndimage.correlate
+    origin = -1 if size % 2 == 0 else 0
+    return ndimage.uniform_filter(frames, size=(1, size, size), output=output, mode='constant', cval=0.0,
+                                  origin=(0, origin, origin))
+
+def high_pass_block(frames_in, frames_out, start, stop, kernal_size):
+    """Write frames_in[start:stop] minus its box-filtered copy into frames_out[start:stop]. Returns the statistics
+    of the block"""
+    block = np.array(frames_in[start:stop], dtype=np.float32)
+    out = np.empty_like(block)
+    box_filter(block, kernal_size, out)
+    np.subtract(block, out, out=out)
+    frames_out[start:stop] = out
+    return file_io.BlockStatistics(out, start)
+
+def spatial_filter(frames_in, frames_out, kernal_size, callback=None, threads=None,
+                   memory_budget=file_io.CHUNK_BYTES, statistics=None):
+    """Spatially high-pass frames_in into the float32 frames_out (usually memory-mapped) in frame blocks
+    processed by a thread pool. ndimage releases the GIL so the blocks filter in parallel. The statistics of the
+    blocks are added to statistics if given"""
+    threads = threads or cpu_count()
+    frames_in = file_io.ChunkedStack(file_io.as_stack(frames_in).frames, memory_budget // (threads * 2))
+    done = 0
+    with ThreadPoolExecutor(threads) as executor:
+        ranges = frames_in.frame_ranges(np.float32)
+        futures = [executor.submit(high_pass_block, frames_in, frames_out, start, stop, kernal_size)
+                   for start, stop in ranges]
+        for (start, stop), future in zip(ranges, futures):
+            block_statistics = future.result()
+            if statistics is not None:
+                statistics.add_block(block_statistics)
+            done = done + stop - start
+            if callback:
+                callback(done / len(frames_in))
+    return frames_out
+
+
 class Widget(QWidget, WidgetDefault):
+    reads_virtual_stacks = True
+
     class Labels(WidgetDefault.Labels):
         kernal_size_label = "Kernel Size"
 
@@ -87,14 +130,8 @@ class Widget(QWidget, WidgetDefault):
         self.kernal_size.valueChanged[int].connect(functools.partial(self.update_plugin_params,
                                                                       self.Labels.kernal_size_label))
 
-    def generate_mean_filter_kernel(self, size):
-        kernel = 1.0 / (size * size) * np.array([[1] * size] * size)
-        return kernel
-
     def filter2_test_j(self, frame, kernal_size):
-        kernel = self.generate_mean_filter_kernel(kernal_size)
-        framek = ndimage.convolve(frame, kernel, mode='constant', cval=0.0)
-        return framek
+        return box_filter(np.asarray(frame, dtype=np.float32)[np.newaxis], kernal_size)[0]
 
     def execute_primary_function(self):
         global_progress = QProgressDialog('Total Progress Filtering Selection', 'Abort', 0, 100, self)
@@ -116,46 +153,36 @@ class Widget(QWidget, WidgetDefault):
                 progress.setValue(x * 100)
                 QApplication.processEvents()
 
-            frames_original = np.load(video_path,  mmap_mode='r')
+            frames_original = file_io.open_stack(video_path)
             frames_count = self.right_frame_range.value() - self.left_frame_range.value()
             if len(frames_original) > frames_count:
-                # 4 is for 32bit so it cant get any bigger
-                max_possible_size = (frames_original.nbytes/len(frames_original))*frames_count*4
-                available = list(psutil.virtual_memory())[1]
-                if available > max_possible_size:
-                    # fileloader.save_file(path, np.empty((num_frames, len(frames_mmap[0]), len(frames_mmap[1])),
-                    #                                     np.load(video_path, mmap_mode='r').dtype))
-                    # frames = np.load(path, mmap_mode='r+')
-                    # for i, frame in enumerate(frames_mmap[cut_off_start:len(frames_mmap) - cut_off_end]):
-                    #     callback(i / float(len(frames_mmap)))
-                    #     frames[i] = frame[:, :]
-                    frames_original = frames_original[self.left_frame_range.value():self.right_frame_range.value()]
-                else:
-                    qtutil.critical('Not enough memory. Range is of maximum size ' + str(max_possible_size) +
-                                    ' and available memory is: ' + str(available))
-                    raise MemoryError('Not enough memory. Range is of maximum size ' + str(max_possible_size) +
-                                      ' and available memory is: ' + str(available))
+                frames_original = frames_original.segment(self.left_frame_range.value(),
+                                                          self.right_frame_range.value())
+            self.kernal_size.setMaximum(np.sqrt(frames_original[0].size))
+
+            if not self.project:
+                path = PyQt5.QtGui.QFileDialog.getSaveFileName(self, 'Choose save location',
+                                                               str(QSettings().value('last_load_data_path')),
+                                                               filter='*.npy')[0]
+                if not path:
+                    continue
+                path = str(path)
             else:
-                frames_original = file_io.load_file(video_path)
-            frames = np.empty((frames_original.shape[0], frames_original.shape[1], frames_original.shape[2]),
-                              dtype=np.float32)
-            self.kernal_size.setMaximum(np.sqrt(frames[0].size))
-            for frame_no, frame_original in enumerate(frames_original):
-                frames[frame_no] = self.filter2_test_j(frame_original, kernal_size)
-                callback(frame_no / len(frames))
-            frames = frames_original - frames
+                path = pfs.get_output_path(video_path, self.project, 'spatial-filter')
+            frames = file_io.create_stack(path, frames_original.shape, np.float32)
+            statistics = file_io.StackStatistics(frames_original.shape[1:], np.float32)
+            spatial_filter(frames_original, frames, kernal_size, callback, statistics=statistics)
+            frames.flush()
+            del frames
+            statistics.save(path)
 
             if not self.project:
-                filename = PyQt5.QtGui.QFileDialog.getSaveFileName(self, 'Choose save location',
-                                                                   str(QSettings().value('last_load_data_path')),
-                                                                   filter='*.npy')[0]
-                np.save(str(filename), frames)
                 msgBox = PyQt5.QtGui.QMessageBox()
-                msgBox.setText(str(filename)+" saved")
+                msgBox.setText(path+" saved")
                 msgBox.addButton(PyQt5.QtGui.QMessageBox.Ok)
                 msgBox.exec_()
             else:
-                pfs.save_project(video_path, self.project, frames, 'spatial-filter', 'video')
+                pfs.save_project(video_path, self.project, None, 'spatial-filter', 'video')
                 pfs.refresh_list(self.project, self.video_list,
                                  self.params[self.Labels.video_list_indices_label],
                                  self.Defaults.list_display_type,
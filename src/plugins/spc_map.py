@@ -4,19 +4,19 @@ import csv
 import functools
 import os
 import pickle
+from collections import OrderedDict
 from itertools import cycle
-from multiprocessing import Pool
 
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
+import psutil
 import qtutil
 import scipy.misc
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from pyqtgraph.Qt import QtGui
 from pyqtgraph.dockarea import *
-from scipy.stats.stats import pearsonr
 
 from .util import custom_qt_items as cqt
 from .util import file_io
@@ -30,39 +30,40 @@ from .util.plugin import WidgetDefault
 from .util.visualization_window import DockWindow
 
 
-def corr(pixel, seed_pixel):
-    return pearsonr(pixel, seed_pixel)[0]
-
-def correlation_map(seed_x, seed_y, frames, progress):
-    seed_pixel = np.asarray(frames[:, seed_x, seed_y])
-    width = frames.shape[1]
-    height = frames.shape[2]
-    # Reshape into time and space
-    # frames[frames==0]=np.nan
-    frames = np.reshape(frames, (frames.shape[0], width*height))
-
-    total = float(width * height - 1)
-    cmap = []
-
-    with Pool() as pool:
-        #     for i, value in enumerate(parmap.imap(corr, frames.T, seed_pixel)):
-        for i, value in enumerate(pool.starmap(corr,
-                                               zip(frames.T,
-                                                   [seed_pixel for i in range(frames.T.shape[0])]
-                                                   ))):
-            progress.setValue(100 * i / total)
+# Normalized stacks too large for the cache budget are memory-mapped from a sidecar with this suffix
+SPC_SIDECAR_SUFFIX = '_spc_normalized.npy'
+
+def normalize_traces(traces):
+    """Mean-subtract each column of a (time, pixels) array and scale it to unit norm, in place if traces
+    is already float32. Columns with no variance become nan, matching pearsonr"""
+    traces = np.asarray(traces, dtype=np.float32)
+    traces -= np.mean(traces, axis=0, dtype=np.float32)
+    norms = np.sqrt(np.einsum('ij,ij->j', traces, traces))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        traces /= norms
+    return traces
+
+def correlation_maps(seeds, frames, progress=None):
+    """Pearson correlation of every pixel with each (seed_x, seed_y) seed in one sweep of frames.
+    Pixel blocks are normalized once and correlated with all seeds through a single matrix product"""
+    stack = file_io.as_stack(frames)
+    num_frames, width, height = stack.shape
+    if not seeds:
+        return []
+    seed_traces = normalize_traces(np.stack([stack[:, seed_x, seed_y] for seed_x, seed_y in seeds], axis=1))
+
+    cmaps = np.empty((len(seeds), width * height), dtype=np.float32)
+    for start, stop, block in stack.pixel_blocks(np.float32):
+        cmaps[:, start:stop] = np.dot(seed_traces.T, normalize_traces(block))
+        if progress:
+            progress.setValue(100 * stop / (width * height))
             QApplication.processEvents()
-            cmap.append(value)
+    return [np.reshape(cmap, (width, height)) for cmap in cmaps]
 
-    cmap = np.reshape(cmap, (width, height))
-    return cmap
-
-def calc_spc(frames, x, y, progress):
-    height, width = frames[0].shape
-    x = int(x)
-    y = int(height - y)
-    spc_map = correlation_map(y, x, frames, progress)
+def correlation_map(seed_x, seed_y, frames, progress):
+    return correlation_maps([(seed_x, seed_y)], frames, progress)[0]
 
+def mark_seed(spc_map, x, y):
     # Make the location of the roi - self.image[y,x] - blatantly obvious
     spc_map[y+1, x+1] = 1
     spc_map[y+1, x] = 1
@@ -74,6 +75,96 @@ def calc_spc(frames, x, y, progress):
     spc_map[y-1, x+1] = 1
     return spc_map
 
+def seed_to_numpy_coords(frame_shape, x, y):
+    height, width = frame_shape
+    return int(x), int(height - y)
+
+def calc_spcs(frames, coords, progress):
+    """SPC maps for several (x, y) view coordinates computed from one pass over frames"""
+    seeds = [seed_to_numpy_coords(frames.shape[1:], x, y) for x, y in coords]
+    spc_maps = correlation_maps([(y, x) for x, y in seeds], frames, progress)
+    return [mark_seed(spc_map, x, y) for spc_map, (x, y) in zip(spc_maps, seeds)]
+
+def calc_spc(frames, x, y, progress):
+    return calc_spcs(frames, [(x, y)], progress)[0]
+
+def normalize_stack(frames, out=None, progress=None):
+    """Pixel-major (width, height, time) copy of frames with every time course mean-subtracted and
+    scaled to unit norm, so that one dot product with a seed's time course gives its correlation map"""
+    stack = file_io.as_stack(frames)
+    num_frames, width, height = stack.shape
+    if out is None:
+        out = np.empty((width, height, num_frames), dtype=np.float32)
+    out_pixels = np.reshape(out, (width * height, num_frames))
+    for start, stop, block in stack.pixel_blocks(np.float32):
+        out_pixels[start:stop] = normalize_traces(block).T
+        if progress:
+            progress.setValue(100 * stop / (width * height))
+            QApplication.processEvents()
+    return out
+
+def calc_spc_normalized(normalized, x, y):
+    x, y = seed_to_numpy_coords(normalized.shape[:2], x, y)
+    spc_map = np.dot(normalized, normalized[y, x])
+    return mark_seed(spc_map, x, y)
+
+class NormalizedStackCache(object):
+    """LRU cache of normalize_stack results keyed by video path. Stacks are held in memory while they
+    fit the memory budget (half the available memory by default). Larger stacks are written once to a
+    sidecar next to the .npy and memory-mapped from there on"""
+    def __init__(self, memory_budget=None):
+        self.memory_budget = memory_budget
+        self.stacks = OrderedDict()
+
+    def budget(self):
+        if self.memory_budget is not None:
+            return self.memory_budget
+        return list(psutil.virtual_memory())[1] // 2 + self.cached_bytes()
+
+    def cached_bytes(self):
+        return sum(stack.nbytes for mtime, stack in self.stacks.values() if not isinstance(stack, np.memmap))
+
+    def get(self, video_path, progress=None):
+        key = os.path.normpath(video_path)
+        mtime = file_io.stack_mtime(key)
+        if key in self.stacks and self.stacks[key][0] == mtime:
+            self.stacks.move_to_end(key)
+            return self.stacks[key][1]
+        self.invalidate(key)
+
+        frames = file_io.open_stack(key)
+        num_frames, width, height = frames.shape
+        nbytes = num_frames * width * height * np.dtype(np.float32).itemsize
+        budget = self.budget()
+        if nbytes <= budget:
+            in_memory = [k for k, (m, stack) in self.stacks.items() if not isinstance(stack, np.memmap)]
+            for evict_key in in_memory:
+                if self.cached_bytes() + nbytes <= budget:
+                    break
+                del self.stacks[evict_key]
+            stack = normalize_stack(frames, progress=progress)
+        else:
+            stack = self.load_sidecar(key, frames, progress)
+        self.stacks[key] = (mtime, stack)
+        return stack
+
+    def load_sidecar(self, video_path, frames, progress=None):
+        sidecar_path = os.path.splitext(video_path)[0] + SPC_SIDECAR_SUFFIX
+        num_frames, width, height = frames.shape
+        if not os.path.isfile(sidecar_path) or os.path.getmtime(sidecar_path) < file_io.stack_mtime(video_path):
+            out = np.lib.format.open_memmap(sidecar_path, mode='w+', dtype=np.float32,
+                                            shape=(width, height, num_frames))
+            normalize_stack(frames, out, progress)
+            out.flush()
+            del out
+        return np.load(sidecar_path, mmap_mode='r')
+
+    def invalidate(self, video_path):
+        self.stacks.pop(os.path.normpath(video_path), None)
+
+# Shared by the SPC widget and every map dialog so repeated clicks on a stack reuse one normalization
+spc_cache = NormalizedStackCache()
+
 class DockWindowSPC(DockWindow):
     def __init__(self, video_path_to_plots_dict, parent, state=None, area=None, title=None):
         super(DockWindowSPC, self).__init__(None, area, title, parent)
@@ -170,6 +261,8 @@ class DockWindowSPC(DockWindow):
         self.parent.open_dialogs.remove(self)
 
 class Widget(QWidget, WidgetDefault):
+    run_methods = ('spc_triggered', 'vbc_clicked')
+
     class Labels(WidgetDefault.Labels):
         colormap_index_label = "Choose Colormap:"
         sb_min_label = "Min correlation value to display"
@@ -312,18 +405,15 @@ class Widget(QWidget, WidgetDefault):
         video_path_to_plots_dict = {}
         progress = MyProgressDialog('SPC Map', 'Generating correlation map...', self)
         for selected_vid_no, video_path in enumerate(selected_videos):
-            frames = file_io.load_file(video_path)
-            roi_activity_dict = {}
-            for i, roi_name in enumerate(roi_names):
-                if progress_load.wasCanceled():
-                    return
-                progress_load.setValue((selected_vid_no * i) / (len(selected_videos) * len(roi_names)) * 100)
-                if roi_name in rois_in_view:
-                    x = roi_coord_x[i]
-                    y = roi_coord_y[i]
-                    spc = calc_spc(frames, x, y, progress)
-                    roi_activity_dict[roi_name] = spc
-            video_path_to_plots_dict[video_path] = roi_activity_dict
+            if progress_load.wasCanceled():
+                return
+            progress_load.setValue(selected_vid_no / len(selected_videos) * 100)
+            frames = file_io.open_stack(video_path)
+            seed_indices = [i for i, roi_name in enumerate(roi_names) if roi_name in rois_in_view]
+            seed_names = [roi_names[i] for i in seed_indices]
+            seed_coords = [(roi_coord_x[i], roi_coord_y[i]) for i in seed_indices]
+            spcs = calc_spcs(frames, seed_coords, progress)
+            video_path_to_plots_dict[video_path] = dict(zip(seed_names, spcs))
             progress.close()
         progress_load.close()
         return video_path_to_plots_dict
@@ -495,9 +585,9 @@ class Widget(QWidget, WidgetDefault):
         progress = MyProgressDialog('SPC Map', 'Generating correlation map...', self)
         for i, selected in enumerate(self.selected_videos):
             progress_load.setValue((i / len(self.selected_videos)) * 100)
-            frames = file_io.load_npy(selected)
             progress.show()
-            spc = calc_spc(frames, x, y, progress)
+            normalized = spc_cache.get(selected, progress)
+            spc = calc_spc_normalized(normalized, x, y)
             progress.close()
             dialog = SPCMapDialog(self.project, selected, spc, self.cm_comboBox.currentText(),
                                   (round(self.min_sb.value(), 2), round(self.max_sb.value(), 2)))
@@ -584,8 +674,9 @@ class SPCMapDialog(QDialog):
         progress = MyProgressDialog('SPC Map', 'Recalculating...', self)
         progress.show()
         progress.setValue(0)
-        frames = file_io.load_npy(self.video_path)
-        self.spc = calc_spc(frames, x, y, progress)
+        normalized = spc_cache.get(self.video_path, progress)
+        self.spc = calc_spc_normalized(normalized, x, y)
+        progress.close()
         self.view.show(self.colorize_spc(self.spc))
 
     def colorize_spc(self, spc_map):
@@ -4,6 +4,7 @@ import os
 import pickle
 from itertools import cycle
 from math import log10, floor
+from multiprocessing import Pool, cpu_count
 
 import matplotlib
 import matplotlib.pyplot as plt
@@ -29,10 +30,74 @@ from .util.visualization_window import DockWindow
 def round_sig(x, sig=2):
     return round(x, sig-int(floor(log10(abs(x))))-1)
 
+# (key, display name) of the per-pixel maps produced by stack_statistics
+STATISTICS = [('stdev', 'Standard deviation'),
+              ('mean', 'Mean'),
+              ('variance', 'Variance'),
+              ('min', 'Minimum'),
+              ('max', 'Maximum'),
+              ('cv', 'Coefficient of variation')]
+
+def block_statistics(block):
+  """(count, mean, M2, min, max) over the frames of a block, M2 being the sum of squared deviations from the mean"""
+  mean = np.mean(block, axis=0, dtype=np.float64)
+  m2 = np.zeros_like(mean)
+  for frame in block:
+    m2 += np.square(frame - mean)
+  return len(block), mean, m2, np.min(block, axis=0), np.max(block, axis=0)
+
+def combine_statistics(a, b):
+  """Merge two (count, mean, M2, min, max) partial results (Chan et al.'s pairwise form of Welford's update)"""
+  if a is None:
+    return b
+  count_a, mean_a, m2_a, min_a, max_a = a
+  count_b, mean_b, m2_b, min_b, max_b = b
+  count = count_a + count_b
+  delta = mean_b - mean_a
+  mean = mean_a + delta * (count_b / count)
+  m2 = m2_a + m2_b + np.square(delta) * (count_a * count_b / count)
+  return count, mean, m2, np.minimum(min_a, min_b), np.maximum(max_a, max_b)
+
+def frame_range_statistics(task):
+  """Worker: partial statistics of frames start:stop of video_path, read one block at a time"""
+  video_path, start, stop, memory_budget = task
+  frames = file_io.open_stack(video_path, memory_budget=memory_budget, segment=(start, stop))
+  result = None
+  for block_start, block_stop, block in frames.frame_blocks(np.float32):
+    result = combine_statistics(result, block_statistics(block))
+  return result
+
+def stack_statistics(video_path, callback=None, processes=None, memory_budget=file_io.CHUNK_BYTES):
+  """Standard deviation, mean, variance, min, max and coefficient of variation maps of a stack in one sweep of
+  the memory-mapped file. Frame ranges are reduced in a process pool and the partial results combined"""
+  frames = file_io.open_stack(video_path)
+  processes = processes or cpu_count()
+  # each worker holds a float32 block and a float64 per-frame deviation
+  worker_budget = memory_budget // (processes * 3)
+  block_size = file_io.ChunkedStack(frames.frames, worker_budget).frame_block_size(np.float64)
+  # a few blocks per task so small stacks are still spread across workers
+  task_size = max(block_size, int(np.ceil(len(frames) / processes)))
+  tasks = [(video_path, start, min(start + task_size, len(frames)), worker_budget)
+           for start in range(0, len(frames), task_size)]
+  result = None
+  done = 0
+  with Pool(processes) as pool:
+    for partial in pool.imap_unordered(frame_range_statistics, tasks):
+      result = combine_statistics(result, partial)
+      done = done + partial[0]
+      if callback:
+        callback(done / len(frames))
+  count, mean, m2, minimum, maximum = result
+  variance = m2 / count
+  stdev = np.sqrt(variance)
+  cv = np.full_like(stdev, np.nan)
+  np.divide(stdev, mean, out=cv, where=mean != 0)
+  maps = {'stdev': stdev, 'mean': mean, 'variance': variance, 'min': minimum, 'max': maximum, 'cv': cv}
+  return {key: np.array(value, dtype=np.float32) for key, value in maps.items()}
+
 def calc_stddev(video_path, progress):
   progress.setValue(0)
-  frames = file_io.load_file(video_path)
-  stddev = np.std(frames, axis=0, dtype=np.float32)
+  stddev = stack_statistics(video_path, lambda x: progress.setValue(x * 100))['stdev']
   progress.setValue(100)
   return stddev
 
@@ -144,15 +209,19 @@ class DockWindowSTD(DockWindow):
         self.parent.open_dialogs.remove(self)
 
 class Widget(QWidget, WidgetDefault):
+  reads_virtual_stacks = True
+
   class Labels(WidgetDefault.Labels):
     colormap_index_label = "Choose Colormap:"
     max_checkbox_label = "Select maximum value of image stack as upper limit"
     colormap_upper_limit_label = "Choose upper limit of colormap:"
+    statistics_label = "Maps to generate:"
 
   class Defaults(WidgetDefault.Defaults):
     colormap_index_default = 1
     max_checkbox_default = True
     colormap_upper_limit_default = 1.0
+    statistics_default = ['stdev']
     manip = "stdev"
 
   def __init__(self, project, plugin_position, parent=None):
@@ -165,6 +234,7 @@ class Widget(QWidget, WidgetDefault):
     self.max_checkbox = QCheckBox("Select maximum value of image stack as upper limit")
     self.log_mode = QCheckBox("Use log scale")
     self.max_stdev_cb = QDoubleSpinBox(decimals=4)
+    self.statistic_checkboxes = [(key, QCheckBox(name)) for key, name in STATISTICS]
     self.execute_primary_function_button = QPushButton('Generate Std. Dev. Map')
     WidgetDefault.__init__(self, project=project, plugin_position=plugin_position)
 
@@ -187,6 +257,9 @@ class Widget(QWidget, WidgetDefault):
     self.max_stdev_cb.setMinimum(0.0000)
     self.max_stdev_cb.setValue(1.0000)
     self.vbox.addWidget(self.max_stdev_cb)
+    self.vbox.addWidget(QLabel(self.Labels.statistics_label))
+    for key, checkbox in self.statistic_checkboxes:
+        self.vbox.addWidget(checkbox)
     self.vbox.addWidget(self.execute_primary_function_button)
 
   def setup_signals(self):
@@ -200,7 +273,11 @@ class Widget(QWidget, WidgetDefault):
           self.update_plugin_params(self.Labels.colormap_index_label, self.Defaults.colormap_index_default)
           self.update_plugin_params(self.Labels.colormap_upper_limit_label, self.Defaults.colormap_upper_limit_default)
           self.update_plugin_params(self.Labels.max_checkbox_label, self.Defaults.max_checkbox_default)
+      if self.Labels.statistics_label not in self.params or reset:
+          self.update_plugin_params(self.Labels.statistics_label, self.Defaults.statistics_default)
       self.cm_comboBox.setCurrentIndex(self.params[self.Labels.colormap_index_label])
+      for key, checkbox in self.statistic_checkboxes:
+          checkbox.setChecked(key in self.params[self.Labels.statistics_label])
       self.max_checkbox.setChecked(self.params[self.Labels.max_checkbox_label])
       self.max_stdev_cb.setValue(self.params[self.Labels.colormap_upper_limit_label])
 
@@ -212,6 +289,12 @@ class Widget(QWidget, WidgetDefault):
                                                                 self.Labels.colormap_upper_limit_label))
       self.max_checkbox.stateChanged[int].connect(functools.partial(self.update_plugin_params,
                                                                       self.Labels.max_checkbox_label))
+      for key, checkbox in self.statistic_checkboxes:
+          checkbox.stateChanged[int].connect(self.statistics_changed)
+
+  def statistics_changed(self):
+      self.update_plugin_params(self.Labels.statistics_label,
+                                [key for key, checkbox in self.statistic_checkboxes if checkbox.isChecked()])
 
   def execute_primary_function(self, input_paths=None):
     cm_type = self.cm_comboBox.currentText()
@@ -222,35 +305,40 @@ class Widget(QWidget, WidgetDefault):
     def global_callback(x):
         global_progress.setValue(x * 100)
         QApplication.processEvents()
+    statistics = [(key, name) for key, name in STATISTICS if key in self.params[self.Labels.statistics_label]]
     total = len(self.selected_videos)
     for selected_vid_no, video_path in enumerate(self.selected_videos):
         global_callback(selected_vid_no / total)
         progress = MyProgressDialog('Standard Deviation Map', 'Generating map...', self)
-        stddev = calc_stddev(video_path, progress)
-        if self.log_mode.isChecked():
-            stddev = stddev + 1 # log10(1.0) = 0
-            stddev = np.log10(stddev)
-        if self.max_checkbox.isChecked():
-            max_val = str(np.max(stddev))
-            dialog = StdDevDialog(self.project, video_path, stddev, np.max(stddev), cm_type, self)
-            # stddev_col = dialog.colorized_spc
-        else:
-            max_val = str(self.max_stdev_cb.value())
-            dialog = StdDevDialog(self.project, video_path, stddev, self.max_stdev_cb.value(), cm_type, self)
-            dialog.setWhatsThis("Click and drag to move the map around and roll "
-                                "the mouse wheel to zoom in and out. Moving the map resets the position of the "
-                                "gradient legend. Right click to see further options. Use View All to reset the view. ")
-            # stddev_col = dialog.colorized_spc
-        self.stdev_to_file(max_val, video_path, dialog.colorized_spc, stddev)
-        dialog.show()
-        self.open_dialogs.append(dialog)
+        progress.setValue(0)
+        maps = stack_statistics(video_path, lambda x: progress.setValue(x * 100))
+        progress.setValue(100)
+        for key, name in statistics:
+            stat_map = maps[key]
+            if self.log_mode.isChecked():
+                stat_map = stat_map + 1 # log10(1.0) = 0
+                stat_map = np.log10(stat_map)
+            if self.max_checkbox.isChecked():
+                max_val = str(np.nanmax(stat_map))
+                dialog = StdDevDialog(self.project, video_path, stat_map, np.nanmax(stat_map), cm_type, self, name)
+            else:
+                max_val = str(self.max_stdev_cb.value())
+                dialog = StdDevDialog(self.project, video_path, stat_map, self.max_stdev_cb.value(), cm_type, self,
+                                      name)
+                dialog.setWhatsThis("Click and drag to move the map around and roll "
+                                    "the mouse wheel to zoom in and out. Moving the map resets the position of the "
+                                    "gradient legend. Right click to see further options. Use View All to reset the "
+                                    "view. ")
+            self.stdev_to_file(max_val, video_path, dialog.colorized_spc, stat_map, key)
+            dialog.show()
+            self.open_dialogs.append(dialog)
     global_callback(1)
 
-  def stdev_to_file(self, max_val, vid_path, stddev_col, stddev):
+  def stdev_to_file(self, max_val, vid_path, stddev_col, stddev, statistic='stdev'):
       assert self.selected_videos
       # define base name
       vid_name = os.path.basename(vid_path)
-      path_without_ext = os.path.join(self.project.path, vid_name + "_" + 'stdev_with_max_'+max_val)
+      path_without_ext = os.path.join(self.project.path, vid_name + "_" + statistic + '_with_max_'+max_val)
       # save to npy
       np.save(path_without_ext + '.npy', stddev)
       # Save as png and jpeg
@@ -270,9 +358,14 @@ class Widget(QWidget, WidgetDefault):
                                      "value will all have the same colour")
       self.execute_primary_function_button.setWhatsThis("Create standard deviation map of selected image stacks with "
                                                         "upper")
+      for key, checkbox in self.statistic_checkboxes:
+          checkbox.setWhatsThis("All checked maps are computed together in a single pass over each selected image "
+                                "stack. The coefficient of variation is the standard deviation divided by the mean "
+                                "and is left blank where the mean is 0")
 
 class StdDevDialog(QDialog):
-  def __init__(self, project, video_path, stddevmap, max_stdev, cm_type, parent=None):
+  def __init__(self, project, video_path, stddevmap, max_stdev, cm_type, parent=None,
+               statistic_name='Standard deviation'):
     super(StdDevDialog, self).__init__(parent)
     self.project = project
     self.display_name = os.path.basename(video_path)
@@ -280,10 +373,11 @@ class StdDevDialog(QDialog):
     self.stddev = stddevmap
     self.max_stdev = max_stdev
     self.cm_type = cm_type
+    self.statistic_name = statistic_name
     self.setup_ui()
     l = GradientLegend(0.0, max_stdev, cm_type)
     l.setParentItem(self.view.vb)
-    self.setWindowTitle('Standard Deviation Map')
+    self.setWindowTitle(statistic_name + ' Map')
     self.colorized_spc = self.colorize_spc(stddevmap)
     self.view.show(self.colorize_spc(stddevmap))
 
@@ -317,7 +411,7 @@ class StdDevDialog(QDialog):
         # value = str(stddev[int(x)+int(x_origin), int(y)+int(y_origin)])
     except:
         value = '-'
-    self.the_label.setText('Standard deviation at crosshair: {}'.format(value))
+    self.the_label.setText('{} at crosshair: {}'.format(self.statistic_name, value))
     self.coords_label.setText('(x,y): {}'.format(coords))
 
   # copy-pasted from spc_map
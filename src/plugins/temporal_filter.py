@@ -15,7 +15,34 @@ from .util import project_functions as pfs
 from .util.plugin import PluginDefault
 from .util.plugin import WidgetDefault
 
+
+def cheby_sos(low_limit, high_limit, frame_rate, order=4, rp=0.1):
+    """Chebyshev type I bandpass as float32 second-order sections. rp is the maximum allowable passband ripple"""
+    nyq = frame_rate / 2.0
+    Wn = [low_limit / nyq, high_limit / nyq]
+    return signal.cheby1(order, rp, Wn, 'bandpass', analog=False, output='sos').astype(np.float32)
+
+def filter_pixels(frames, sos):
+    """Forward-backward filter a (frames, pixels) block along time in float32, keeping each pixel's mean"""
+    frames = np.asarray(frames, dtype=np.float32)
+    avg_frames = np.mean(frames, axis=0, dtype=np.float32)
+    filtered = signal.sosfiltfilt(sos, frames, axis=0)
+    filtered += avg_frames
+    return filtered
+
+def temporal_filter(video_path, output_path, low_limit, high_limit, frame_rate, callback=None,
+                    processes=None, memory_budget=file_io.CHUNK_BYTES):
+    """Bandpass every pixel of video_path into a float32 stack at output_path. Pixel time courses are read and
+    written through pixel-major copies by file_io.map_pixels across a process pool, so peak memory stays close to
+    memory_budget and the stack is read front to back whatever its size"""
+    sos = cheby_sos(low_limit, high_limit, frame_rate)
+    # sosfiltfilt holds the padded block and its forward and backward passes at once
+    return file_io.map_pixels(video_path, output_path, filter_pixels, (sos,), callback, processes, memory_budget,
+                              copies=4)
+
 class Widget(QWidget, WidgetDefault):
+    reads_virtual_stacks = True
+
     class Labels(WidgetDefault.Labels):
         f_low_label = 'Low Bandpass (Hz)'
         f_high_label = 'High Bandpass (Hz)'
@@ -92,24 +119,10 @@ class Widget(QWidget, WidgetDefault):
                                                                       self.Labels.frame_rate_label))
 
     def cheby_filter(self, frames, low_limit, high_limit, frame_rate):
-        nyq = frame_rate / 2.0
-        low_limit = low_limit / nyq
-        high_limit = high_limit / nyq
-        order = 4
-        rp = 0.1 # Ripple in the passband. Maximum allowable ripple
-        Wn = [low_limit, high_limit]
-
-        b, a = signal.cheby1(order, rp, Wn, 'bandpass', analog=False)
-        print("Filtering...")
-        frames = np.array(signal.filtfilt(b, a, frames, axis=0), dtype=np.float32)
-        # non-working parallized version
-        # def filt(pixel, b, a):
-        #     return signal.filtfilt(b, a, pixel)
-        # frames = parmap.map(filt, frames.T, b, a)
-        # for i in range(frames.shape[-1]):
-        #    frames[:, i] = signal.filtfilt(b, a, frames[:, i])
-        print("Done!")
-        return frames
+        shape = frames.shape
+        frames = filter_pixels(np.reshape(frames, (shape[0], -1)),
+                               cheby_sos(low_limit, high_limit, frame_rate))
+        return np.reshape(frames, shape)
 
     def execute_primary_function(self, input_paths=None):
         if not input_paths:
@@ -142,24 +155,22 @@ class Widget(QWidget, WidgetDefault):
                 progress.setValue(x * 100)
                 QApplication.processEvents()
             callback(0.01)
-            frames = file_io.load_file(video_path)
-            callback(0.1)
-            avg_frames = np.mean(frames, axis=0, dtype=np.float32)
-            callback(0.2)
-            frames = self.cheby_filter(frames, f_low, f_high, frame_rate)
-            callback(0.9)
-            frames += avg_frames
             if not self.project:
-                filename = PyQt5.QtGui.QFileDialog.getSaveFileName(self, 'Choose save location',
-                                                                   str(QSettings().value('last_load_data_path')),
-                                                                   filter='*.npy')[0]
-                np.save(str(filename), frames)
+                path = PyQt5.QtGui.QFileDialog.getSaveFileName(self, 'Choose save location',
+                                                               str(QSettings().value('last_load_data_path')),
+                                                               filter='*.npy')[0]
+                if not path:
+                    continue
+                path = str(path)
+                temporal_filter(video_path, path, f_low, f_high, frame_rate, callback)
                 msgBox = PyQt5.QtGui.QMessageBox()
-                msgBox.setText(str(filename)+" saved")
+                msgBox.setText(path+" saved")
                 msgBox.addButton(PyQt5.QtGui.QMessageBox.Ok)
                 msgBox.exec_()
             else:
-                path = pfs.save_project(video_path, self.project, frames, 'temporal-filter', 'video')
+                path = pfs.get_output_path(video_path, self.project, self.Defaults.manip)
+                temporal_filter(video_path, path, f_low, f_high, frame_rate, callback)
+                path = pfs.save_project(video_path, self.project, None, self.Defaults.manip, 'video')
                 pfs.refresh_list(self.project, self.video_list,
                                  self.params[self.Labels.video_list_indices_label],
                                  self.Defaults.list_display_type,
@@ -1,9 +1,7 @@
 #!/usr/bin/env python3
 
 import functools
-import os
 
-import numpy as np
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 
@@ -14,6 +12,8 @@ from .util.plugin import WidgetDefault
 
 
 class Widget(QWidget, WidgetDefault):
+    reads_virtual_stacks = True
+
     class Labels(WidgetDefault.Labels):
         start_cut_off_label = 'Trim from start'
         end_cut_off_label = 'Trim from end'
@@ -87,30 +87,14 @@ class Widget(QWidget, WidgetDefault):
         total = len(selected_videos)
         for global_i, video_path in enumerate(selected_videos):
             global_callback(global_i / total)
-            frames_mmap = np.load(video_path, mmap_mode='c')
             cut_off_start = self.left_cut_off.value()
             cut_off_end = self.right_cut_off.value()
-
-            progress = QProgressDialog('Trimming Image Stack ' + video_path, 'Abort', 0, 100, self)
-            progress.setAutoClose(True)
-            progress.setMinimumDuration(0)
-
-            def callback(x):
-                progress.setValue(x * 100)
-                QApplication.processEvents()
-
-            num_frames = len(frames_mmap)-cut_off_end-cut_off_start
-            name_before, ext = os.path.splitext(os.path.basename(video_path))
-            name_after = file_io.get_name_after_no_overwrite(name_before, self.Defaults.manip, self.project)
-            path = str(os.path.join(self.project.path, name_after) + '.npy')
-            file_io.save_file(path, np.empty((num_frames, len(frames_mmap[0]), len(frames_mmap[1])),
-                                             np.load(video_path, mmap_mode='r').dtype))
-            frames = np.load(path, mmap_mode='r+')
-            for i, frame in enumerate(frames_mmap[cut_off_start:len(frames_mmap)-cut_off_end]):
-                callback(i / float(len(frames_mmap)))
-                frames[i] = frame[:, :]
-            callback(1)
-            # frames = np.array(frames_mmap[cut_off_start:len(frames_mmap)-cut_off_end])
+            sources = file_io.stack_sources(video_path)
+            num_frames = sum(source['frames'][1] - source['frames'][0] for source in sources)
+            # the trimmed stack is a virtual one reading the kept frames from the original
+            path = pfs.get_output_path(video_path, self.project, self.Defaults.manip)
+            file_io.save_virtual_stack(path, file_io.slice_sources(sources, (cut_off_start,
+                                                                            num_frames - cut_off_end)))
             path = pfs.save_project(video_path, self.project, None, self.Defaults.manip, 'video')
             output_paths = output_paths + [path]
             pfs.refresh_list(self.project, self.video_list,
@@ -131,6 +115,9 @@ class Widget(QWidget, WidgetDefault):
                                        "if artifacts (e.g. movement) occur near the start of most image stacks")
         self.right_cut_off.setWhatsThis("Number of frames to remove from the end of each image stack selected. Useful "
                                         "if artifacts (e.g. movement) occur near the end of most image stacks")
+        self.main_button.setWhatsThis("Trimmed image stacks are virtual: they read the kept frames from the original "
+                                      "and take no time or disk space to create. They are written out to a file of "
+                                      "their own when a plugin that needs one uses them or the original is deleted")
 
 
 class MyPlugin(PluginDefault):
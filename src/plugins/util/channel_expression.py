@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+import ast
+import string
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
+
+import numpy as np
+
+from . import file_io
+
+# Letters naming the selected stacks in an expression, in the order they were selected
+CHANNEL_NAMES = string.ascii_uppercase
+OPERATORS = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.divide,
+    ast.Pow: np.power
+}
+UNARY_OPERATORS = {
+    ast.USub: np.negative,
+    ast.UAdd: lambda operand: operand
+}
+
+
+class ExpressionError(Exception):
+    pass
+
+
+def number(node):
+    """Value of a numeric literal (ast.Num before Python 3.8, ast.Constant after), or None for any other node"""
+    if type(node).__name__ not in ('Num', 'Constant'):
+        return None
+    value = getattr(node, 'value', getattr(node, 'n', None))
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    return value
+
+def parse(expression):
+    """Syntax tree of an arithmetic expression over channels A, B, ... and numbers. Anything else, like function
+    calls or unknown names, raises ExpressionError"""
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError:
+        raise ExpressionError('Could not parse "' + expression + '"')
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Expression, ast.Load)) or type(node) in OPERATORS or type(node) in UNARY_OPERATORS:
+            continue
+        if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            continue
+        if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            continue
+        if number(node) is not None:
+            continue
+        if isinstance(node, ast.Name) and len(node.id) == 1 and node.id in CHANNEL_NAMES:
+            continue
+        raise ExpressionError('"' + expression + '" may only use + - * / ** ( ), numbers and the letters '
+                              'A, B, ... for the selected image stacks')
+    return tree
+
+def channels(tree):
+    """Indices of the stacks an expression uses"""
+    return sorted(set(CHANNEL_NAMES.index(node.id) for node in ast.walk(tree) if isinstance(node, ast.Name)))
+
+def check(expression, stack_number):
+    """Parse an expression, raising ExpressionError if it uses more channels than the stack_number selected"""
+    tree = parse(expression)
+    used = channels(tree)
+    if used and used[-1] >= stack_number:
+        raise ExpressionError('"' + expression + '" uses ' + CHANNEL_NAMES[used[-1]] + ' but only ' +
+                              str(stack_number) + ' image stacks are selected')
+    return tree
+
+def evaluate(node, blocks):
+    """Evaluate a parsed expression in float32 over the blocks of frames of each channel"""
+    if isinstance(node, ast.Expression):
+        return evaluate(node.body, blocks)
+    if isinstance(node, ast.BinOp):
+        return OPERATORS[type(node.op)](evaluate(node.left, blocks), evaluate(node.right, blocks))
+    if isinstance(node, ast.UnaryOp):
+        return UNARY_OPERATORS[type(node.op)](evaluate(node.operand, blocks))
+    if number(node) is not None:
+        return np.float32(number(node))
+    return blocks[CHANNEL_NAMES.index(node.id)]
+
+def evaluate_block(tree, stacks, frames_out, start, stop):
+    """Evaluate frames start:stop into frames_out. NaNs (e.g. 0/0) are set to 0. Returns the number of infinite
+    values and the statistics of the block"""
+    blocks = {i: np.array(stacks[i][start:stop], dtype=np.float32) for i in channels(tree)}
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        result = np.broadcast_to(evaluate(tree, blocks), (stop - start,) + frames_out.shape[1:])
+    result = np.array(result, dtype=np.float32)
+    result[np.isnan(result)] = 0
+    frames_out[start:stop] = result
+    return int(np.count_nonzero(np.isinf(result))), file_io.BlockStatistics(result, start)
+
+def evaluate_expression(expression, stacks, frames_out, callback=None, threads=None,
+                        memory_budget=file_io.CHUNK_BYTES, statistics=None):
+    """Evaluate an expression such as (A-B)/(A+B) over stacks, A being stacks[0], block by block into the float32
+    (usually memory-mapped) frames_out, as long as the shortest stack used. Blocks are spread across a thread pool
+    and their statistics added to statistics if given. Returns the number of infinite values written"""
+    tree = check(expression, len(stacks))
+    used = channels(tree)
+    threads = threads or cpu_count()
+    # each thread holds a float32 block per channel plus a few temporaries
+    stack = file_io.ChunkedStack(frames_out, memory_budget // (threads * (len(used) + 3)))
+    infinite = 0
+    with ThreadPoolExecutor(threads) as executor:
+        ranges = stack.frame_ranges(np.float32)
+        futures = [executor.submit(evaluate_block, tree, stacks, frames_out, start, stop) for start, stop in ranges]
+        for (start, stop), future in zip(ranges, futures):
+            block_infinite, block_statistics = future.result()
+            infinite = infinite + block_infinite
+            if statistics is not None:
+                statistics.add_block(block_statistics)
+            if callback:
+                callback(stop / len(frames_out))
+    return infinite
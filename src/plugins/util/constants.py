@@ -25,4 +25,6 @@ CMAPS = [('Perceptually Uniform Sequential',
                              'gnuplot', 'gnuplot2', 'gist_ncar',
                              'nipy_spectral', 'jet', 'rainbow',
                              'gist_rainbow', 'hsv', 'flag', 'prism'])]
-QSETTINGS_LABELS = ['path_of_last_project', 'last_vis_path']
\ No newline at end of file
+QSETTINGS_LABELS = ['path_of_last_project', 'last_vis_path']
+# Project attribute switching on pixel-major sidecars written by project_functions.save_project
+PIXEL_MAJOR_SIDECARS = 'pixel_major_sidecars'
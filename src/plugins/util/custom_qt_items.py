@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
 import os
+import threading
+import time
+from collections import OrderedDict
 
 import numpy as np
 from PyQt5 import QtGui, QtCore
@@ -12,6 +15,14 @@ from . import file_io
 from .mygraphicsview import MyGraphicsView
 import qtutil
 
+# Memory used by the frame cache of a PlayerDialog
+PLAYER_CACHE_BYTES = 256 * 1024 * 1024
+# Frames read ahead of the current position (and half as many behind it)
+PLAYER_READ_AHEAD = 64
+# Every n-th row and column is read for the stand-in shown while a frame the player skipped to is still loading
+PLAYER_DOWNSAMPLE = 4
+# Frames sampled to estimate the display range of a stack without a statistics sidecar
+PLAYER_RANGE_SAMPLE_FRAMES = 32
 
 class JSObjectModel(QAbstractTableModel):
   def __init__(self, data, parent=None):
@@ -369,6 +380,117 @@ class MyTableWidget(QTableWidget):
       if self.data is not None:
         self.setmydata()
 
+class FrameCache(object):
+  """Bounded LRU cache of (frame, full) pairs shared by a PlayerDialog and its FramePrefetcher. full is False for
+  a downsampled stand-in"""
+  def __init__(self, frame_bytes, memory_budget=PLAYER_CACHE_BYTES):
+    self.capacity = max(2, int(memory_budget // max(1, frame_bytes)))
+    self.frames = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, frame_num):
+    with self.lock:
+      entry = self.frames.get(frame_num)
+      if entry is not None:
+        self.frames.move_to_end(frame_num)
+      return entry
+
+  def has_full(self, frame_num):
+    with self.lock:
+      return frame_num in self.frames and self.frames[frame_num][1]
+
+  def put(self, frame_num, frame, full=True):
+    with self.lock:
+      self.frames[frame_num] = (frame, full)
+      self.frames.move_to_end(frame_num)
+      while len(self.frames) > self.capacity:
+        self.frames.popitem(last=False)
+
+class FramePrefetcher(QThread):
+  """Reads frames of a C-ordered .npy around the position requested by a PlayerDialog into its FrameCache, ahead
+  in the direction of travel first. Frames are read with plain file reads, which release the GIL, so the GUI thread
+  never waits on the disk. When hurried (playing or dragging the slider) a frame that isn't cached yet is first read
+  downsampled"""
+  frame_ready = pyqtSignal(int)
+
+  def __init__(self, filename, frames, cache, parent=None):
+    super(FramePrefetcher, self).__init__(parent)
+    self.filename = filename
+    self.num_frames = len(frames)
+    self.frame_shape = frames.shape[1:]
+    self.dtype = frames.dtype
+    self.offset = frames.offset
+    self.frame_bytes = frames[0].nbytes
+    self.cache = cache
+    self.read_ahead = max(1, min(PLAYER_READ_AHEAD, (cache.capacity - 1) * 2 // 3))
+    self.read_behind = max(0, min(PLAYER_READ_AHEAD // 2, cache.capacity - 1 - self.read_ahead))
+    self.position = 0
+    self.direction = 1
+    self.hurry = False
+    self.stopped = False
+    self.condition = threading.Condition()
+
+  def request(self, frame_num, hurry=False):
+    with self.condition:
+      if frame_num != self.position:
+        self.direction = 1 if frame_num > self.position else -1
+      self.position = frame_num
+      self.hurry = hurry
+      self.condition.notify()
+
+  def stop(self):
+    with self.condition:
+      self.stopped = True
+      self.condition.notify()
+    self.wait()
+
+  def next_read(self):
+    """(frame_num, full) of the next frame to read, or None when the window around the position is cached"""
+    position = self.position
+    if not self.cache.has_full(position):
+      downsample = self.hurry and self.cache.get(position) is None and self.frame_shape[0] >= PLAYER_DOWNSAMPLE
+      return position, not downsample
+    window = [position + self.direction * i for i in range(1, self.read_ahead + 1)] + \
+             [position - self.direction * i for i in range(1, self.read_behind + 1)]
+    for frame_num in window:
+      if 0 <= frame_num < self.num_frames and not self.cache.has_full(frame_num):
+        return frame_num, True
+    return None
+
+  def read_frame(self, file, frame_num):
+    frame = np.empty(self.frame_shape, self.dtype)
+    file.seek(self.offset + frame_num * self.frame_bytes)
+    file.readinto(frame)
+    return frame
+
+  def read_downsampled_frame(self, file, frame_num):
+    """Every PLAYER_DOWNSAMPLE-th row and column of a frame, blown back up to full size"""
+    rows = range(0, self.frame_shape[0], PLAYER_DOWNSAMPLE)
+    small = np.empty((len(rows),) + self.frame_shape[1:], self.dtype)
+    row_bytes = self.frame_bytes // self.frame_shape[0]
+    for i, row in enumerate(rows):
+      file.seek(self.offset + frame_num * self.frame_bytes + row * row_bytes)
+      file.readinto(small[i])
+    small = small[:, ::PLAYER_DOWNSAMPLE]
+    frame = np.repeat(np.repeat(small, PLAYER_DOWNSAMPLE, axis=0), PLAYER_DOWNSAMPLE, axis=1)
+    return frame[:self.frame_shape[0], :self.frame_shape[1]]
+
+  def run(self):
+    with open(self.filename, 'rb') as file:
+      while True:
+        with self.condition:
+          while not self.stopped and self.next_read() is None:
+            self.condition.wait()
+          if self.stopped:
+            return
+          frame_num, full = self.next_read()
+        if full:
+          self.cache.put(frame_num, self.read_frame(file, frame_num))
+        else:
+          self.cache.put(frame_num, self.read_downsampled_frame(file, frame_num), full=False)
+        if frame_num == self.position:
+          self.frame_ready.emit(frame_num)
+
 class PlayerDialog(QDialog):
   def __init__(self, project, filename, parent=None, scaling=True):
     super(PlayerDialog, self).__init__(parent)
@@ -377,29 +499,70 @@ class PlayerDialog(QDialog):
     self.setWindowTitle(os.path.basename(filename))
 
     self.scale = scaling
-    self.fp = np.load(filename, mmap_mode='r')
+    self.fp = file_io.open_stack(filename).frames
     if isinstance(scaling, bool) and scaling:
-        self.global_min = np.min(self.fp)
-        self.global_max = np.max(self.fp)
+        statistics = file_io.load_statistics(filename)
+        if statistics is not None:
+            self.global_min = statistics['min']
+            self.global_max = statistics['max']
+        else:
+            # estimate from a sample of frames rather than scanning the whole file before showing anything
+            sample = self.fp[::max(1, len(self.fp) // PLAYER_RANGE_SAMPLE_FRAMES)]
+            self.global_min = np.nanmin(sample)
+            self.global_max = np.nanmax(sample)
     if isinstance(scaling, tuple):
         self.global_min = scaling[0]
         self.global_max = scaling[1]
+    self.cache = FrameCache(self.fp[0].nbytes)
+    self.prefetcher = None
+    if isinstance(self.fp, np.memmap) and self.fp.flags.c_contiguous:
+        self.prefetcher = FramePrefetcher(filename, self.fp, self.cache, self)
+        self.prefetcher.frame_ready.connect(self.frame_ready)
+        self.prefetcher.start()
+    self.timer = QTimer(self)
+    self.timer.timeout.connect(self.play_tick)
     self.slider.setMaximum(len(self.fp)-1)
     self.show_frame(0)
 
   def show_frame(self, frame_num):
-    frame = self.fp[frame_num]
     self.label_frame.setText(str(frame_num) + ' / ' + str(len(self.fp)-1))
+    entry = self.cache.get(frame_num)
+    if self.prefetcher:
+        self.prefetcher.request(frame_num, self.timer.isActive() or self.slider.isSliderDown())
+    if entry is None:
+        if self.prefetcher and frame_num != 0:
+            # keep the last frame on screen until frame_ready
+            return
+        entry = (np.array(self.fp[frame_num]), True)
+        self.cache.put(frame_num, entry[0])
+    self.display(entry[0])
+
+  def display(self, frame):
     if hasattr(self, 'global_min') and hasattr(self, 'global_max'):
         self.view.show(frame, self.global_min, self.global_max)
     else:
         self.view.show(frame)
 
+  def frame_ready(self, frame_num):
+    entry = self.cache.get(frame_num)
+    if frame_num == self.slider.value() and entry is not None:
+        self.display(entry[0])
+
   def setup_ui(self):
     vbox = QVBoxLayout()
     self.view = MyGraphicsView(self.project)
     vbox.addWidget(self.view)
     hbox = QHBoxLayout()
+    self.play_button = QPushButton('Play')
+    self.play_button.setCheckable(True)
+    self.play_button.toggled.connect(self.play_toggled)
+    hbox.addWidget(self.play_button)
+    self.fps_sb = QSpinBox()
+    self.fps_sb.setRange(1, 1000)
+    self.fps_sb.setValue(30)
+    self.fps_sb.setSuffix(' fps')
+    self.fps_sb.valueChanged.connect(self.fps_changed)
+    hbox.addWidget(self.fps_sb)
     self.slider = QSlider(Qt.Horizontal)
     self.slider.valueChanged.connect(self.slider_moved)
     hbox.addWidget(self.slider)
@@ -410,3 +573,30 @@ class PlayerDialog(QDialog):
 
   def slider_moved(self, value):
     self.show_frame(value)
+
+  def play_toggled(self, playing):
+    self.play_button.setText('Pause' if playing else 'Play')
+    if playing:
+        self.fps_changed(self.fps_sb.value())
+    else:
+        self.timer.stop()
+        self.show_frame(self.slider.value())
+
+  def fps_changed(self, fps):
+    if not self.play_button.isChecked():
+        return
+    # the frame shown follows the clock, so frames still loading are skipped rather than slowing playback down
+    self.play_start = time.time()
+    self.play_start_frame = self.slider.value()
+    self.timer.start(max(1, int(1000 / fps)))
+
+  def play_tick(self):
+    elapsed_frames = int((time.time() - self.play_start) * self.fps_sb.value())
+    self.slider.setValue((self.play_start_frame + elapsed_frames) % len(self.fp))
+
+  def done(self, result):
+    self.timer.stop()
+    if self.prefetcher:
+        self.prefetcher.stop()
+        self.prefetcher = None
+    super(PlayerDialog, self).done(result)
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
+import json
 import os
+from multiprocessing import Pool, cpu_count
 
 import numpy as np
 import psutil
@@ -9,10 +11,555 @@ import qtutil
 from PyQt5.QtWidgets import QMessageBox
 
 
+# Default memory budget of one block read or written by a ChunkedStack
+CHUNK_BYTES = 256 * 1024 * 1024
+# Optional (width * height, frames) copy of a stack stored next to it so time courses are read sequentially
+PIXEL_MAJOR_SUFFIX = '_pixel_major.npy'
+# Summary statistics of a stack (min, max, mean trace and frame, NaN count, histogram) stored next to it
+STATISTICS_SUFFIX = '_stats.npz'
+STATISTICS_HISTOGRAM_BINS = 256
+# Top bits of a float32 kept while histogramming non-integer stacks (about 0.05% relative resolution)
+STATISTICS_FLOAT_BITS = 20
+# JSON descriptor of a virtual stack, the frame and pixel ranges of other stacks it reads from, stored in place of
+# its .npy until it is materialized
+VIRTUAL_SUFFIX = '_virtual.json'
+
+
 class UnknownFileFormatError(Exception):
   pass
 
+
+class ChunkedStack(object):
+    """A (frames, width, height) stack, usually a memory-mapped .npy, processed in blocks that fit a memory budget.
+    Iterate frame_blocks for per-frame work and pixel_blocks for per-pixel time course work instead of loading
+    the whole stack into memory"""
+    def __init__(self, frames, memory_budget=None, pixel_major=None):
+        self.frames = frames
+        self.memory_budget = memory_budget or CHUNK_BYTES
+        self.pixel_major = pixel_major
+
+    @property
+    def shape(self):
+        return self.frames.shape
+
+    @property
+    def dtype(self):
+        return self.frames.dtype
+
+    @property
+    def nbytes(self):
+        return self.frames.nbytes
+
+    @property
+    def num_pixels(self):
+        return int(np.prod(self.shape[1:]))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, key):
+        return self.frames[key]
+
+    def __setitem__(self, key, value):
+        self.frames[key] = value
+
+    def segment(self, start, stop):
+        """Stack of frames start:stop sharing the same file and memory budget"""
+        pixel_major = self.pixel_major[:, start:stop] if self.pixel_major is not None else None
+        if isinstance(self.frames, VirtualStack):
+            return ChunkedStack(self.frames.frame_range(start, stop), self.memory_budget, pixel_major)
+        return ChunkedStack(self.frames[start:stop], self.memory_budget, pixel_major)
+
+    def pixels(self):
+        """(frames, width * height) view of the stack"""
+        return np.reshape(self.frames, (len(self), self.num_pixels))
+
+    def frame_block_size(self, dtype=None):
+        itemsize = max(self.dtype.itemsize, np.dtype(dtype or self.dtype).itemsize)
+        return max(1, int(self.memory_budget // (self.num_pixels * itemsize)))
+
+    def pixel_block_size(self, dtype=None):
+        itemsize = max(self.dtype.itemsize, np.dtype(dtype or self.dtype).itemsize)
+        return max(1, int(self.memory_budget // (max(1, len(self)) * itemsize)))
+
+    def frame_ranges(self, dtype=None):
+        block_size = self.frame_block_size(dtype)
+        return [(start, min(start + block_size, len(self))) for start in range(0, len(self), block_size)]
+
+    def pixel_ranges(self, dtype=None):
+        block_size = self.pixel_block_size(dtype)
+        return [(start, min(start + block_size, self.num_pixels)) for start in range(0, self.num_pixels, block_size)]
+
+    def frame_blocks(self, dtype=None):
+        """Yield (start, stop, frames[start:stop]) as in-memory copies cast to dtype"""
+        for start, stop in self.frame_ranges(dtype):
+            yield start, stop, np.array(self.frames[start:stop], dtype=dtype or self.dtype)
+
+    def read_pixels(self, start, stop, dtype=None):
+        """(frames, stop - start) time courses of flattened pixels start:stop as an in-memory copy cast to dtype,
+        read sequentially from the pixel-major sidecar when the stack has one"""
+        if self.pixel_major is not None:
+            return np.array(self.pixel_major[start:stop], dtype=dtype or self.dtype).T
+        if isinstance(self.frames, VirtualStack):
+            return np.array(self.frames.read_pixels(start, stop), dtype=dtype or self.dtype)
+        return np.array(self.pixels()[:, start:stop], dtype=dtype or self.dtype)
+
+    def pixel_blocks(self, dtype=None):
+        """Yield (start, stop, block) where block is read_pixels(start, stop, dtype)"""
+        for start, stop in self.pixel_ranges(dtype):
+            yield start, stop, self.read_pixels(start, stop, dtype)
+
+    def write_frames(self, start, block):
+        self.frames[start:start + len(block)] = block
+
+    def write_pixels(self, start, block):
+        pixels = self.pixels()
+        pixels[:, start:start + block.shape[1]] = block
+
+    def flush(self):
+        if isinstance(self.frames, np.memmap):
+            self.frames.flush()
+
+class VirtualStack(object):
+    """Read-only (frames, width, height) stack made of frame ranges of .npy stacks, each cropped to the same
+    frame size. Sources are lists of {'path', 'frames': [start, stop], 'pixels': [[x0, x1], [y0, y1]]}. Indexing
+    reads only the frames asked for from the sources' memmaps"""
+    def __init__(self, sources):
+        self.sources = sources
+        self.views = []
+        for source in sources:
+            (x0, x1), (y0, y1) = source['pixels']
+            frames = np.load(source['path'], mmap_mode='r')
+            self.views.append(frames[source['frames'][0]:source['frames'][1], x0:x1, y0:y1])
+        if len(set(view.shape[1:] for view in self.views)) > 1:
+            raise ValueError('Sources of a virtual stack must have frames of the same size')
+        self.starts = np.cumsum([0] + [len(view) for view in self.views])
+        self.shape = (int(self.starts[-1]),) + self.views[0].shape[1:]
+        self.dtype = np.result_type(*[view.dtype for view in self.views])
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+    def frame_range(self, start, stop):
+        """Virtual stack of frames start:stop"""
+        return VirtualStack(slice_sources(self.sources, (start, stop)))
+
+    def read_frames(self, start, stop, pixel_key=()):
+        """Frames start:stop indexed by pixel_key, the part of an index after the frame axis. It is applied to each
+        source's memmap before the parts are joined, so only the pixels asked for are read"""
+        parts = []
+        for view, view_start in zip(self.views, self.starts):
+            first, last = max(start - view_start, 0), min(stop - view_start, len(view))
+            if first < last:
+                parts.append(view[(slice(first, last),) + pixel_key])
+        if not parts:
+            return np.empty((0,) + self.shape[1:], self.dtype)[(slice(None),) + pixel_key]
+        return np.concatenate(parts).astype(self.dtype, copy=False)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        frame_key, pixel_key = key[0], tuple(key[1:])
+        if isinstance(frame_key, (int, np.integer)):
+            frame_num = frame_key + len(self) if frame_key < 0 else frame_key
+            if not 0 <= frame_num < len(self):
+                raise IndexError('frame ' + str(frame_key) + ' out of range')
+            return self.read_frames(frame_num, frame_num + 1, pixel_key)[0]
+        if isinstance(frame_key, slice):
+            start, stop, step = frame_key.indices(len(self))
+            if step == 1:
+                return self.read_frames(start, max(start, stop), pixel_key)
+            frame_key = np.arange(start, stop, step)
+        frames = [self.read_frames(i, i + 1, pixel_key) for i in np.arange(len(self))[frame_key]]
+        if not frames:
+            return self.read_frames(0, 0, pixel_key)
+        return np.concatenate(frames)
+
+    def read_pixels(self, start, stop):
+        """(frames, stop - start) time courses of flattened pixels start:stop, reading only the rows of each frame
+        that hold them"""
+        height = self.shape[2]
+        first_row, last_row = start // height, (stop - 1) // height + 1
+        parts = []
+        for view in self.views:
+            rows = np.reshape(np.array(view[:, first_row:last_row]), (len(view), -1))
+            parts.append(rows[:, start - first_row * height:stop - first_row * height])
+        return np.concatenate(parts).astype(self.dtype, copy=False)
+
+def histogram_codes(block):
+    """Histogram codes of the values of a block, as StackStatistics keeps them, with their counts, the number of
+    NaNs and the (min, max) of the other values, or None if there are none. Only the codes the block uses are
+    returned"""
+    values = np.ravel(block)
+    nan_count = 0
+    if exact_histogram(block.dtype):
+        codes = values.astype(np.int64) - int(np.iinfo(block.dtype).min)
+    else:
+        values = values.astype(np.float32)
+        nan_count = int(np.count_nonzero(np.isnan(values)))
+        values = values[np.isfinite(values)]
+        codes = (values.view(np.uint32) >> (32 - STATISTICS_FLOAT_BITS)).astype(np.int64)
+    if not len(codes):
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), nan_count, None
+    low, high = int(codes.min()), int(codes.max())
+    if high - low > len(codes):
+        # values spread over far more codes than there are values, e.g. either side of 0
+        used, counts = np.unique(codes, return_counts=True)
+    else:
+        counts = np.bincount(codes - low)
+        used = np.flatnonzero(counts)
+        counts = counts[used]
+        used = used + low
+    return used, counts, nan_count, (np.min(values), np.max(values))
+
+def exact_histogram(dtype):
+    return np.dtype(dtype).kind in 'iu' and np.dtype(dtype).itemsize <= 2
+
+class BlockStatistics(object):
+    """Statistics of a block of frames start:start + len(block), made by a worker and added to the statistics of
+    the whole stack with StackStatistics.add_block. Only the histogram codes the block uses are kept, so it is
+    cheap to make and to send back from a worker process"""
+    def __init__(self, block, start=0):
+        self.start = start
+        self.frame_sum = np.sum(block, axis=0, dtype=np.float64)
+        self.frame_totals = np.sum(np.reshape(block, (len(block), -1)), axis=1, dtype=np.float64)
+        self.codes, self.counts, self.nan_count, self.range = histogram_codes(block)
+
+class StackStatistics(object):
+    """Summary statistics of a stack accumulated one block at a time, so they can be gathered by whatever pass
+    writes the stack. Blocks may be frames or pixel time courses and arrive in any order, and workers send back
+    BlockStatistics of their blocks. 8 and 16 bit integers are histogrammed exactly; other types by the top bits
+    of their float32 representation, which is rebinned over [min, max] once the pass is done"""
+    def __init__(self, frame_shape, dtype):
+        self.dtype = np.dtype(dtype)
+        self.exact = exact_histogram(dtype)
+        self.offset = -int(np.iinfo(dtype).min) if self.exact else 0
+        self.codes = np.zeros(2 ** (16 if self.exact else STATISTICS_FLOAT_BITS), dtype=np.int64)
+        self.frame_totals = np.zeros(0, dtype=np.float64)
+        self.frame_sum = np.zeros(frame_shape, dtype=np.float64)
+        self.next_frame = 0
+        self.nan_count = 0
+        self.min = None
+        self.max = None
+
+    def add_frame_totals(self, start, totals):
+        stop = start + len(totals)
+        if stop > len(self.frame_totals):
+            self.frame_totals = np.concatenate([self.frame_totals, np.zeros(stop - len(self.frame_totals))])
+        self.frame_totals[start:stop] += totals
+
+    def update(self, block, start=None):
+        """Add a (frames, width, height) block of frames start:start + len(block), by default following those
+        already seen"""
+        start = self.next_frame if start is None else start
+        self.next_frame = start + len(block)
+        self.frame_sum += np.sum(block, axis=0, dtype=np.float64)
+        self.add_frame_totals(start, np.sum(np.reshape(block, (len(block), -1)), axis=1, dtype=np.float64))
+        self.count(block)
+
+    def update_pixels(self, start, block):
+        """Add a (frames, pixels) block of the time courses of flattened pixels start:start + block.shape[1]"""
+        self.frame_sum.flat[start:start + block.shape[1]] += np.sum(block, axis=0, dtype=np.float64)
+        self.add_frame_totals(0, np.sum(block, axis=1, dtype=np.float64))
+        self.count(block)
+
+    def add_block(self, block_statistics):
+        """Add the BlockStatistics of a block gathered by a worker"""
+        self.frame_sum += block_statistics.frame_sum
+        self.add_frame_totals(block_statistics.start, block_statistics.frame_totals)
+        self.add_codes(block_statistics.codes, block_statistics.counts, block_statistics.nan_count,
+                       block_statistics.range)
+
+    def add_codes(self, codes, counts, nan_count, value_range):
+        self.codes[codes] += counts
+        self.nan_count += nan_count
+        if value_range is not None:
+            self.min = value_range[0] if self.min is None else min(self.min, value_range[0])
+            self.max = value_range[1] if self.max is None else max(self.max, value_range[1])
+
+    def count(self, block):
+        self.add_codes(*histogram_codes(np.asarray(block, self.dtype)))
+
+    def code_values(self, codes):
+        if self.exact:
+            return codes.astype(np.float64) - self.offset
+        # middle of the range of float32s sharing the same top bits
+        shift = 32 - STATISTICS_FLOAT_BITS
+        return ((codes.astype(np.uint32) << shift) | (1 << (shift - 1))).view(np.float32).astype(np.float64)
+
+    def save(self, filename):
+        """Write the statistics sidecar of the stack in filename"""
+        nonzero = np.flatnonzero(self.codes)
+        low = self.min if self.min is not None else 0
+        high = self.max if self.max is not None else 0
+        histogram, edges = np.histogram(np.clip(self.code_values(nonzero), low, high),
+                                        STATISTICS_HISTOGRAM_BINS, (low, high), weights=self.codes[nonzero])
+        path = statistics_path(filename)
+        np.savez(path, min=low, max=high,
+                 frame_means=self.frame_totals / max(1, self.frame_sum.size),
+                 mean_frame=self.frame_sum / max(1, len(self.frame_totals)),
+                 nan_count=self.nan_count, histogram=histogram.astype(np.int64), histogram_edges=edges)
+        return path
+
+def as_stack(frames, memory_budget=None):
+  """Wrap an in-memory or memory-mapped array as a ChunkedStack, passing ChunkedStacks through unchanged"""
+  if isinstance(frames, ChunkedStack):
+    return frames
+  return ChunkedStack(frames, memory_budget)
+
+def open_stack(filename, mode='r', memory_budget=None, segment=None):
+  """Memory-map a .npy stack as a ChunkedStack. Nothing is read until its blocks are"""
+  if not filename.endswith('.npy'):
+    raise UnknownFileFormatError()
+  if is_virtual(filename):
+    stack = ChunkedStack(open_virtual_stack(filename), memory_budget)
+    return stack.segment(segment[0], segment[1]) if segment else stack
+  pixel_major = open_pixel_major(filename) if mode == 'r' else None
+  stack = ChunkedStack(np.load(filename, mmap_mode=mode), memory_budget, pixel_major)
+  if segment:
+    stack = stack.segment(segment[0], segment[1])
+  return stack
+
+def virtual_path(filename):
+  return os.path.splitext(filename)[0] + VIRTUAL_SUFFIX
+
+def is_virtual(filename):
+  """Whether filename is a virtual stack that hasn't been materialized"""
+  return not os.path.isfile(filename) and os.path.isfile(virtual_path(filename))
+
+def open_virtual_stack(filename):
+  with open(virtual_path(filename)) as descriptor:
+    return VirtualStack(json.load(descriptor)['sources'])
+
+def stack_sources(filename):
+  """Sources, in the sense of VirtualStack, of the whole of a physical or virtual stack"""
+  if is_virtual(filename):
+    return open_virtual_stack(filename).sources
+  frames = np.load(filename, mmap_mode='r')
+  return [{'path': os.path.normpath(filename), 'frames': [0, len(frames)],
+           'pixels': [[0, frames.shape[1]], [0, frames.shape[2]]]}]
+
+def slice_sources(sources, frames=None, pixels=None):
+  """Sources of frames start:stop, cropped to [[x0, x1], [y0, y1]], of the stack made of sources. Frame and pixel
+  ranges are relative to that stack and are composed with the sources' own, so virtual stacks never refer to other
+  virtual stacks"""
+  total = sum(source['frames'][1] - source['frames'][0] for source in sources)
+  start, stop = frames if frames else (0, total)
+  sliced = []
+  offset = 0
+  for source in sources:
+    source_start, source_stop = source['frames']
+    first = max(start - offset, 0) + source_start
+    last = min(stop - offset, source_stop - source_start) + source_start
+    offset = offset + source_stop - source_start
+    if first >= last:
+      continue
+    (x0, x1), (y0, y1) = source['pixels']
+    if pixels:
+      (px0, px1), (py0, py1) = pixels
+      x0, x1, y0, y1 = x0 + px0, min(x0 + px1, x1), y0 + py0, min(y0 + py1, y1)
+    sliced.append({'path': source['path'], 'frames': [first, last], 'pixels': [[x0, x1], [y0, y1]]})
+  return sliced
+
+def save_virtual_stack(filename, sources):
+  """Register sources as the virtual stack filename, replacing any stack already there. Nothing is copied"""
+  VirtualStack(sources)
+  if os.path.isfile(filename):
+    os.remove(filename)
+  remove_pixel_major(filename)
+  remove_statistics(filename)
+  with open(virtual_path(filename), 'w') as descriptor:
+    json.dump({'sources': sources}, descriptor, indent=2)
+  return filename
+
+def materialize(filename, progress_callback=None, memory_budget=None):
+  """Write a virtual stack out to its .npy, with its statistics sidecar, and drop its descriptor. Its sources are
+  concatenated one after the other in sequential blocks. Physical stacks are left alone"""
+  if not is_virtual(filename):
+    return filename
+  virtual = open_virtual_stack(filename)
+  frames_out = create_stack(filename, virtual.shape, virtual.dtype, memory_budget)
+  statistics = StackStatistics(virtual.shape[1:], virtual.dtype)
+  concatenate(virtual.views, frames_out, progress_callback, statistics, memory_budget)
+  frames_out.flush()
+  del frames_out
+  statistics.save(filename)
+  os.remove(virtual_path(filename))
+  return filename
+
+def pixel_major_path(filename):
+  return os.path.splitext(filename)[0] + PIXEL_MAJOR_SUFFIX
+
+def open_pixel_major(filename):
+  """Memory-map the pixel-major sidecar of filename, or return None if it is missing or older than filename"""
+  path = pixel_major_path(filename)
+  if not os.path.isfile(path) or os.path.getmtime(path) < stack_mtime(filename):
+    return None
+  return np.load(path, mmap_mode='r')
+
+def remove_pixel_major(filename):
+  path = pixel_major_path(filename)
+  if os.path.isfile(path):
+    os.remove(path)
+
+def save_pixel_major(filename, progress_callback=None, memory_budget=None):
+  """Write the (width * height, frames) sidecar of the stack in filename in one sequential pass over its frames"""
+  stack = open_stack(filename, memory_budget=memory_budget)
+  path = pixel_major_path(filename)
+  if os.path.isfile(path):
+    os.remove(path)
+  pixel_major = np.lib.format.open_memmap(path, mode='w+', dtype=stack.dtype, shape=(stack.num_pixels, len(stack)))
+  for start, stop, block in stack.frame_blocks():
+    pixel_major[:, start:stop] = np.reshape(block, (stop - start, stack.num_pixels)).T
+    if progress_callback:
+      progress_callback(stop / len(stack))
+  pixel_major.flush()
+  return path
+
+def map_pixels_block(task):
+  """Worker of map_pixels: apply function to the time courses of pixels start:stop, read from the pixel-major copy
+  at in_path, and write the result into the same rows of the pixel-major copy at out_path"""
+  function, args, in_path, out_path, start, stop = task
+  pixel_major_in = np.load(in_path, mmap_mode='r')
+  pixel_major_out = np.load(out_path, mmap_mode='r+')
+  block = function(np.array(pixel_major_in[start:stop], dtype=np.float32).T, *args)
+  pixel_major_out[start:stop] = block.T
+  pixel_major_out.flush()
+  return stop - start
+
+def map_pixels(filename, output_path, function, args=(), progress_callback=None, processes=None,
+               memory_budget=None, copies=4):
+  """Write function(time courses, *args) of every pixel of the stack in filename into a float32 stack at
+  output_path, with its statistics sidecar. function takes and returns a float32 (frames, pixels) block and
+  holds up to copies of it. Pixel time courses are strided in a frame-major file, so every block read from or
+  written to it would touch the whole file. Instead blocks of rows are read from the stack's pixel-major sidecar,
+  written first if missing, and processed across a process pool into a pixel-major copy of the output. That is
+  transposed into output_path frame block by frame block. Sidecars written for this are removed again"""
+  memory_budget = memory_budget or CHUNK_BYTES
+  processes = processes or cpu_count()
+  progress_callback = progress_callback or (lambda x: None)
+  stack = open_stack(filename, memory_budget=memory_budget)
+  num_frames, num_pixels = len(stack), stack.num_pixels
+  in_path = pixel_major_path(filename)
+  written_in = stack.pixel_major is None
+  if written_in:
+    save_pixel_major(filename, lambda x: progress_callback(x / 3), memory_budget)
+  frames_out = create_stack(output_path, stack.shape, np.float32, memory_budget)
+  out_path = pixel_major_path(output_path)
+  np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32, shape=(num_pixels, num_frames)).flush()
+  # rows of the pixel-major copies are contiguous, so blocks only have to fit each worker's share of the budget
+  block_size = max(1, int(memory_budget // (processes * copies * max(1, num_frames) * 4)))
+  tasks = [(function, args, in_path, out_path, start, min(start + block_size, num_pixels))
+           for start in range(0, num_pixels, block_size)]
+  done = 0
+  with Pool(processes) as pool:
+    for processed in pool.imap_unordered(map_pixels_block, tasks):
+      done = done + processed
+      progress_callback(1 / 3 + done / (3 * num_pixels))
+  pixel_major_out = np.load(out_path, mmap_mode='r')
+  statistics = StackStatistics(stack.shape[1:], np.float32)
+  for start, stop in frames_out.frame_ranges():
+    block = np.reshape(np.array(pixel_major_out[:, start:stop]).T, (stop - start,) + stack.shape[1:])
+    frames_out.write_frames(start, block)
+    statistics.update(block, start)
+    progress_callback(2 / 3 + stop / (3 * num_frames))
+  frames_out.flush()
+  del frames_out, pixel_major_out, stack
+  os.remove(out_path)
+  if written_in:
+    remove_pixel_major(filename)
+  statistics.save(output_path)
+  return output_path
+
+def stack_mtime(filename):
+  return os.path.getmtime(virtual_path(filename) if is_virtual(filename) else filename)
+
+def statistics_path(filename):
+  return os.path.splitext(filename)[0] + STATISTICS_SUFFIX
+
+def load_statistics(filename):
+  """Statistics sidecar of filename as a dict of arrays, or None if it is missing or older than filename"""
+  path = statistics_path(filename)
+  if not os.path.isfile(path) or os.path.getmtime(path) < stack_mtime(filename):
+    return None
+  with np.load(path) as statistics:
+    return {key: statistics[key] for key in statistics.files}
+
+def remove_statistics(filename):
+  path = statistics_path(filename)
+  if os.path.isfile(path):
+    os.remove(path)
+
+def save_statistics(filename, progress_callback=None, memory_budget=None):
+  """Compute the statistics sidecar of a stack already on disk in one pass over its frames"""
+  stack = open_stack(filename, memory_budget=memory_budget)
+  statistics = StackStatistics(stack.shape[1:], stack.dtype)
+  for start, stop, block in stack.frame_blocks():
+    statistics.update(block)
+    if progress_callback:
+      progress_callback(stop / len(stack))
+  return statistics.save(filename)
+
+def write_stack(filename, frames, progress_callback=None, memory_budget=None):
+  """Write a (frames, width, height) array to a .npy block by block, saving its statistics sidecar from the same
+  pass"""
+  frames = as_stack(frames, memory_budget)
+  frames_out = create_stack(filename, frames.shape, frames.dtype, memory_budget)
+  statistics = StackStatistics(frames.shape[1:], frames.dtype)
+  for start, stop, block in frames.frame_blocks():
+    frames_out.write_frames(start, block)
+    statistics.update(block)
+    if progress_callback:
+      progress_callback(stop / len(frames))
+  frames_out.flush()
+  del frames_out
+  return statistics.save(filename)
+
+def concatenate(stacks, frames_out, callback=None, statistics=None, memory_budget=None):
+  """Copy stacks one after the other into frames_out (usually memory-mapped and preallocated to their total
+  length) in sequential blocks of frames, updating statistics, a StackStatistics, along the way"""
+  stacks = [as_stack(stack, memory_budget) for stack in stacks]
+  total = sum(len(stack) for stack in stacks)
+  offset = 0
+  for stack in stacks:
+    for start, stop, block in stack.frame_blocks(frames_out.dtype):
+      frames_out[offset + start:offset + stop] = block
+      if statistics:
+        statistics.update(block)
+      if callback:
+        callback((offset + stop) / total)
+    offset = offset + len(stack)
+  return frames_out
+
+def create_stack(filename, shape, dtype, memory_budget=None):
+  """Create a .npy of the given shape on disk, overwriting any existing file, and open it for writing"""
+  if os.path.isfile(filename):
+    os.remove(filename)
+  remove_pixel_major(filename)
+  remove_statistics(filename)
+  frames = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=tuple(shape))
+  return ChunkedStack(frames, memory_budget)
+
 def load_npy(filename, progress_callback=None, segment=None):
+  if is_virtual(filename):
+    frames = open_stack(filename, segment=segment)
+    loaded = np.empty(frames.shape, frames.dtype)
+    for start, stop, block in frames.frame_blocks():
+      loaded[start:stop] = block
+      if progress_callback:
+        progress_callback(stop / len(frames))
+    return loaded
   if segment:
       frames_mmap = np.load(filename, mmap_mode='r')
       frames_mmap = frames_mmap[segment[0]:segment[1]]
@@ -76,17 +623,22 @@ def save_file(path, data):
     #                     ' and available space is: ' + str(free))
     if os.path.isfile(path):
         os.remove(path)
+    remove_pixel_major(path)
+    remove_statistics(path)
     try:
         # if data.dtype == 'float64':
         #     qtutil.critical("FLOAT64")
         #     raise MemoryError("FLOAT64")
-        np.save(path, data)
+        if data.ndim == 3:
+            write_stack(path, data)
+        else:
+            np.save(path, data)
     except:
         qtutil.critical('Could not save ' + path +
                             '. This is likely due to running out of space on the drive')
 
 def load_file(filename, progress_callback=None, segment=None):
-  file_size = os.path.getsize(filename)
+  file_size = open_virtual_stack(filename).nbytes if is_virtual(filename) else os.path.getsize(filename)
   available = list(psutil.virtual_memory())[1]
   percent = list(psutil.virtual_memory())[2]
   # [total, available, percent, used, free, active, inactive, buffers, cached, shared] = list(psutil.virtual_memory())
@@ -110,7 +662,7 @@ def load_file(filename, progress_callback=None, segment=None):
   return frames
 
 def load_reference_frame_npy(filename, offset):
-  frames_mmap = np.load(filename, mmap_mode='c')
+  frames_mmap = open_virtual_stack(filename) if is_virtual(filename) else np.load(filename, mmap_mode='c')
   if frames_mmap is None:
     return None
   frame = np.array(frames_mmap[offset])
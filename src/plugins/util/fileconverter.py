@@ -1,44 +1,173 @@
 #!/usr/bin/env python3
 
+from multiprocessing import Pool, cpu_count
+
 import numpy as np
 import qtutil
 import tifffile as tiff
 
+from . import file_io
+
 class RawToNpyConvertError(Exception):
   def error_msg(self):
       qtutil.critical("Convert Error: 'number_of_frames % (length * width * number_of_channels) != 0'\n"
             "The number of total pixels does not divide into an integer number of frames of the expected shape.\n"
             "This could be due to dropped frames")
 
-def tif2npy(filename_from, filename_to, progress_callback):
+def contiguous_offset(page):
+  """File offset of the data of an uncompressed page stored in one piece, or None if it has to be decoded"""
+  contiguous = page.is_contiguous
+  if not contiguous:
+    return None
+  if contiguous is True:
+    # newer tifffile reports a flag and keeps the offsets separately
+    return page.dataoffsets[0]
+  return contiguous[0]
+
+def binned_shape(shape, scale_factor=1.0, temporal_bin=1):
+  """Shape of a (frames, width, height) stack after scaling its frames by scale_factor and averaging every
+  temporal_bin frames, a last shorter group included"""
+  num_frames, width, height = shape
+  return (-(-num_frames // temporal_bin), max(1, int(width * scale_factor)), max(1, int(height * scale_factor)))
+
+def binned_dtype(dtype, scale_factor=1.0, temporal_bin=1):
+  if scale_factor == 1.0 and temporal_bin == 1:
+    return np.dtype(dtype)
+  return np.dtype(np.float32)
+
+def area_weights(size_from, size_to):
+  """(size_to, size_from) matrix averaging each output pixel over the input pixels it covers in proportion to their
+  overlap. Shrinking by any factor is anti-aliased and whole factors reduce to plain binning"""
+  edges = np.arange(size_to + 1) * (size_from / float(size_to))
+  pixels = np.arange(size_from)
+  overlap = np.clip(np.minimum(edges[1:, None], pixels + 1) - np.maximum(edges[:-1, None], pixels), 0, None)
+  return (overlap / overlap.sum(axis=1)[:, None]).astype(np.float32)
+
+def bin_frames(frames, frame_shape, temporal_bin=1):
+  """Average every temporal_bin frames of a block, starting from its first, then resample each to frame_shape by
+  area averaging. Returns float32"""
+  frames = np.asarray(frames, dtype=np.float32)
+  if temporal_bin > 1:
+    starts = np.arange(0, len(frames), temporal_bin)
+    counts = np.diff(np.append(starts, len(frames)))
+    frames = (np.add.reduceat(frames, starts, axis=0, dtype=np.float64) / counts[:, None, None]).astype(np.float32)
+  if frames.shape[1:] != tuple(frame_shape):
+    frames = np.matmul(np.matmul(area_weights(frames.shape[1], frame_shape[0]), frames),
+                       area_weights(frames.shape[2], frame_shape[1]).T)
+  return frames
+
+def binned_ranges(num_frames, block_size, temporal_bin=1):
+  """Ranges of frames to convert block by block, each holding whole groups of temporal_bin frames"""
+  block_size = max(1, block_size // temporal_bin) * temporal_bin
+  return [(start, min(start + block_size, num_frames)) for start in range(0, num_frames, block_size)]
+
+def write_binned(frames_out, start, frames, scale_factor, temporal_bin):
+  """Write a block of frames starting at frame start of the source into frames_out, binned to its frame shape.
+  Returns the start in frames_out and the frames written"""
+  if scale_factor != 1.0 or temporal_bin != 1:
+    frames = bin_frames(frames, frames_out.shape[1:], temporal_bin)
+  start = start // temporal_bin
+  frames_out.write_frames(start, frames)
+  return start, frames
+
+# the tiff each pool worker decodes pages from, opened once for all of its blocks
+worker_tif = None
+
+def open_worker_tif(filename_from):
+  global worker_tif
+  worker_tif = tiff.TiffFile(filename_from)
+
+def tif_pages_block(task):
+  """Worker: write frames start:stop of the tiff, binned, into the memory-mapped stack at filename_to. They are
+  copied straight from the file when their offsets are known and otherwise decoded page by page from the worker's
+  open tiff. Returns the number of source frames and the statistics of the frames written"""
+  filename_to, dtype, offsets, scale_factor, temporal_bin, start, stop = task
+  frames_out = file_io.open_stack(filename_to, mode='r+')
+  if offsets is not None:
+    filename_from, offsets, frame_shape = offsets
+    data = np.memmap(filename_from, np.uint8, 'r')
+    frame_bytes = int(np.prod(frame_shape)) * dtype.itemsize
+    frames = np.empty((stop - start,) + tuple(frame_shape), dtype)
+    for i, offset in enumerate(offsets):
+      frames[i] = data[offset:offset + frame_bytes].view(dtype).reshape(frame_shape)
+  else:
+    frames = np.array([worker_tif.pages[i].asarray() for i in range(start, stop)])
+  start_out, frames = write_binned(frames_out, start, frames, scale_factor, temporal_bin)
+  frames_out.flush()
+  return stop - start, file_io.BlockStatistics(np.asarray(frames, frames_out.dtype), start_out)
+
+def tif2npy(filename_from, filename_to, progress_callback, processes=None, memory_budget=file_io.CHUNK_BYTES,
+            scale_factor=1.0, temporal_bin=1):
+  """Convert a tiff to a .npy, decoding blocks of pages across a process pool. Each block is binned by scale_factor
+  and temporal_bin and written straight into the memory-mapped output as it finishes, so the full resolution stack
+  is never stored, and its statistics are gathered in the same pass. ImageJ hyperstacks, stored as one page of
+  consecutive frames, are copied frame by frame rather than decoded. Compressed ones can only be decoded whole, so
+  they are loaded into memory, with a warning"""
   progress_callback(0.01)
   with tiff.TiffFile(filename_from) as tif:
-    if len(tif.pages[0].shape) == 2 or len(tif.pages[0].shape) == 3:
-        if len(tif.pages[0].shape) == 2:
-            w, h = tif.pages[0].shape
-            shape = len(tif.pages), w, h
-            image_j_tiff = False
-        else:
-            shape = tif.pages[0].shape
-            image_j_tiff = True
+    page = tif.pages[0]
+    if len(page.shape) == 2:
+        shape = (len(tif.pages),) + tuple(page.shape)
+        image_j_tiff = False
+    elif len(page.shape) == 3:
+        shape = tuple(page.shape)
+        image_j_tiff = True
     else:
         raise ConvertError()
-    progress_callback(0.01)
-    np.save(filename_to, np.empty(shape, tif.pages[0].dtype))
-    fp = np.load(filename_to, mmap_mode='r+')
-
+    dtype = np.dtype(page.dtype)
+    file_dtype = dtype.newbyteorder(tif.byteorder)
     if image_j_tiff:
-        pages = tif.pages[0].asarray()
-        for i, page in enumerate(pages):
-            progress_callback(i / float(shape[0] - 1))
-            fp[i] = page
+        offset = contiguous_offset(page)
+        frame_bytes = int(np.prod(shape[1:])) * dtype.itemsize
+        offsets = None if offset is None else [offset + i * frame_bytes for i in range(shape[0])]
     else:
-        for i, page in enumerate(tif.pages):
-          progress_callback(i / float(shape[0]-1))
-          fp[i] = page.asarray()
+        offsets = [contiguous_offset(p) for p in tif.pages]
+        offsets = None if None in offsets else offsets
+    if image_j_tiff and offsets is None:
+        qtutil.warning(filename_from + ' is a compressed ImageJ hyperstack, which can only be decoded whole. All '
+                       + str(int(np.prod(shape)) * dtype.itemsize // 2 ** 20) + ' MB of it will be loaded into '
+                       'memory before it is converted.')
+        frames = page.asarray()
+  progress_callback(0.01)
+  frames_out = file_io.create_stack(filename_to, binned_shape(shape, scale_factor, temporal_bin),
+                                    binned_dtype(dtype.newbyteorder('='), scale_factor, temporal_bin), memory_budget)
+  statistics = file_io.StackStatistics(frames_out.shape[1:], frames_out.dtype)
+  processes = processes or cpu_count()
+  # each worker holds a source block and up to three float32 copies of it
+  block_size = memory_budget // (processes * int(np.prod(shape[1:])) * (dtype.itemsize + 3 * 4))
+  ranges = binned_ranges(shape[0], block_size, temporal_bin)
+  done = 0
+  if image_j_tiff and offsets is None:
+    for start, stop in ranges:
+      start, block = write_binned(frames_out, start, frames[start:stop], scale_factor, temporal_bin)
+      statistics.update(block, start)
+      progress_callback(stop / float(shape[0]))
+  else:
+    tasks = [(filename_to, file_dtype, offsets and (filename_from, offsets[start:stop], shape[1:]), scale_factor,
+              temporal_bin, start, stop) for start, stop in ranges]
+    # pages that have to be decoded are read from one open tiff per worker rather than one per block
+    initializer = open_worker_tif if offsets is None else None
+    with Pool(processes, initializer, (filename_from,)) as pool:
+      for processed, block_statistics in pool.imap_unordered(tif_pages_block, tasks):
+        statistics.add_block(block_statistics)
+        done = done + processed
+        progress_callback(done / float(shape[0]))
+  frames_out.flush()
+  del frames_out
+  statistics.save(filename_to)
 
 def raw2npy(filename_from, filename_to, dtype, width, height, num_channels, channel, progress_callback,
-            ignore_shape_error=False):
+            ignore_shape_error=False, scale_factor=1.0, temporal_bin=1):
+    filenames_to = [None] * num_channels
+    filenames_to[channel - 1] = filename_to
+    raw2npy_channels(filename_from, filenames_to, dtype, width, height, num_channels, progress_callback,
+                     ignore_shape_error, scale_factor=scale_factor, temporal_bin=temporal_bin)
+
+def raw2npy_channels(filename_from, filenames_to, dtype, width, height, num_channels, progress_callback,
+                     ignore_shape_error=False, memory_budget=file_io.CHUNK_BYTES, scale_factor=1.0, temporal_bin=1):
+    """Deinterleave a raw of num_channels channels into one .npy per channel in a single sequential pass over
+    blocks of frames, each binned by scale_factor and temporal_bin before it is written. filenames_to holds the
+    output of each channel, None for channels that are skipped"""
     progress_callback(0.01)
     fp = np.memmap(filename_from, dtype, 'r')
     frame_size = width * height * num_channels
@@ -48,9 +177,18 @@ def raw2npy(filename_from, filename_to, dtype, width, height, num_channels, chan
     num_frames = int(len(fp) / frame_size)
     fp = np.memmap(filename_from, dtype, 'r',
       shape=(num_frames, width, height, num_channels))
-    np.save(filename_to, np.empty((num_frames, int(width), int(height)), dtype))
-    fp_to = np.load(filename_to, mmap_mode='r+')
-    for i, frame in enumerate(fp):
-      progress_callback(i / float(len(fp)-1))
-      fp_to[i] = frame[:, :, channel-1]
-
+    shape = binned_shape((num_frames, int(width), int(height)), scale_factor, temporal_bin)
+    dtype_to = binned_dtype(dtype, scale_factor, temporal_bin)
+    outputs = [(channel, file_io.create_stack(filename_to, shape, dtype_to),
+                file_io.StackStatistics(shape[1:], dtype_to))
+               for channel, filename_to in enumerate(filenames_to) if filename_to is not None]
+    # blocks of whole interleaved frames, so the raw is read front to back once
+    block_size = file_io.ChunkedStack(fp, memory_budget).frame_block_size(dtype_to)
+    for start, stop in binned_ranges(num_frames, block_size, temporal_bin):
+      block = np.array(fp[start:stop])
+      for channel, fp_to, statistics in outputs:
+        statistics.update(write_binned(fp_to, start, block[..., channel], scale_factor, temporal_bin)[1])
+      progress_callback(stop / float(num_frames))
+    for channel, fp_to, statistics in outputs:
+      fp_to.flush()
+      statistics.save(filenames_to[channel])
@@ -5,6 +5,7 @@ import qtutil
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 
+from . import file_io
 from . import project_functions as pfs
 from .mygraphicsview import MyGraphicsView
 from .custom_qt_items import ImageStackListView
@@ -16,6 +17,12 @@ class PrimaryFunctionMissing(Exception):
 
 
 class WidgetDefault(object):
+    # Plugins that only read stacks through file_io set this so virtual stacks aren't written out for them
+    reads_virtual_stacks = False
+    # Methods that run the plugin on its selected stacks. Virtual ones among them are written out when one is
+    # called, unless the plugin reads_virtual_stacks
+    run_methods = ('execute_primary_function',)
+
     class Labels(object):
         video_list_indices_label = 'video_list_indices'
         last_manips_to_display_label = 'last_manips_to_display'
@@ -52,6 +59,9 @@ class WidgetDefault(object):
         self.open_dialogs = []
         self.selected_videos = []
         self.shown_video_path = None
+        if not self.reads_virtual_stacks:
+            for name in self.run_methods:
+                setattr(self, name, self.materializing(getattr(self, name)))
 
         self.setup_ui()
         self.setup_signals()
@@ -66,6 +76,17 @@ class WidgetDefault(object):
                              self.Defaults.list_display_type, self.toolbutton_values)
         self.setup_whats_this()
 
+    def materializing(self, run):
+        """Wrap a run method so the stacks it runs on, the input paths it is given or else the selected ones, are
+        materialized first"""
+        @functools.wraps(run)
+        def materialized_run(*args, **kwargs):
+            input_paths = args[0] if args and isinstance(args[0], list) else None
+            for path in input_paths or self.selected_videos:
+                pfs.materialize(path)
+            return run(*args, **kwargs)
+        return materialized_run
+
     def video_triggered(self, index, scaling=False):
         pfs.video_triggered(self, index, scaling)
 
@@ -120,8 +141,9 @@ class WidgetDefault(object):
             self.project.files[:] = [f for f in self.project.files if os.path.normpath(f['path']) != norm_path]
         self.project.save()
         for path in self.selected_videos:
+            pfs.materialize_dependents(self.project, path)
             try:
-                os.remove(path)
+                os.remove(file_io.virtual_path(path) if file_io.is_virtual(path) else path)
             except:
                 qtutil.critical('Could not delete file ' + path)
                 return
@@ -215,6 +237,8 @@ class PluginDefault:
         self.widget_labels = widget_labels_class
 
     def run(self, input_paths=None):
+        if input_paths and not self.widget.reads_virtual_stacks:
+            input_paths = [pfs.materialize(path) for path in input_paths]
         return self.widget.execute_primary_function(input_paths)
 
     def get_input_paths(self):
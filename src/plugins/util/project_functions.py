@@ -16,9 +16,19 @@ from .custom_qt_items import CheckableComboBox, PlayerDialog
 from .file_io import load_reference_frame
 
 
-def save_project(video_path, project, frames, manip, file_type):
+def get_output_path(video_path, project, manip):
+    """Path save_project will register for the output of manip on video_path. Plugins that write their output
+    stack to disk themselves create it here and then call save_project with frames=None"""
     name_before, ext = os.path.splitext(os.path.basename(video_path))
-    file_before = [files for files in project.files if files['name'] == name_before]
+    name_after = file_io.get_name_after_no_overwrite(name_before, manip, project)
+    return str(os.path.normpath(os.path.join(project.path, name_after) + '.npy'))
+
+def save_project(video_path, project, frames, manip, file_type, source_project=None):
+    """Register the output of manip on video_path in project, saving frames unless they were already written to
+    get_output_path. Plugins writing their output themselves save its statistics sidecar from the same pass.
+    video_path may come from another source_project"""
+    name_before, ext = os.path.splitext(os.path.basename(video_path))
+    file_before = [files for files in (source_project or project).files if files['name'] == name_before]
     assert(len(file_before) == 1)
     file_before = file_before[0]
     # check if one with same name already exists and don't overwrite if it does
@@ -45,6 +55,10 @@ def save_project(video_path, project, frames, manip, file_type):
         callback_save(0)
         file_io.save_file(path, frames)
         callback_save(1)
+        if frames.ndim == 3 and file_io.load_statistics(path) is None:
+            save_statistics(path)
+    if pixel_major_enabled(project) and not file_io.is_virtual(path):
+        save_pixel_major(path)
     if not file_before['manipulations'] == []:
         project.files.append({
             'path': os.path.normpath(path),
@@ -66,6 +80,54 @@ def save_project(video_path, project, frames, manip, file_type):
     project.save()
     return path
 
+def pixel_major_enabled(project):
+    return constants.PIXEL_MAJOR_SIDECARS in project and project[constants.PIXEL_MAJOR_SIDECARS]
+
+def save_pixel_major(path):
+    progress = QProgressDialog('Writing pixel-major copy of ' + path, 'Abort', 0, 100)
+    progress.setAutoClose(True)
+    progress.setMinimumDuration(0)
+    def callback(x):
+        progress.setValue(x * 100)
+        QApplication.processEvents()
+    callback(0)
+    file_io.save_pixel_major(path, callback)
+    callback(1)
+
+def save_statistics(path):
+    progress = QProgressDialog('Computing summary statistics of ' + path, 'Abort', 0, 100)
+    progress.setAutoClose(True)
+    progress.setMinimumDuration(0)
+    def callback(x):
+        progress.setValue(x * 100)
+        QApplication.processEvents()
+    callback(0)
+    file_io.save_statistics(path, callback)
+    callback(1)
+
+def materialize(path):
+    """Write out the virtual stack at path, if it is one, so it can be read as a plain .npy"""
+    if not file_io.is_virtual(path):
+        return path
+    progress = QProgressDialog('Writing out virtual stack ' + path, 'Abort', 0, 100)
+    progress.setAutoClose(True)
+    progress.setMinimumDuration(0)
+    def callback(x):
+        progress.setValue(x * 100)
+        QApplication.processEvents()
+    callback(0)
+    file_io.materialize(path, callback)
+    callback(1)
+    return path
+
+def materialize_dependents(project, path):
+    """Materialize the virtual stacks of project that read from path, before path is deleted"""
+    norm_path = os.path.normpath(path)
+    for f in project.files:
+        if f['type'] == 'video' and file_io.is_virtual(f['path']) and \
+                norm_path in [os.path.normpath(source['path']) for source in file_io.stack_sources(f['path'])]:
+            materialize(f['path'])
+
 def change_origin(project, video_path, origin):
     file = [files for files in project.files if os.path.normpath(files['path']) == os.path.normpath(video_path)]
     assert(len(file) == 1)
@@ -74,6 +136,13 @@ def change_origin(project, video_path, origin):
     project.files[index_of_file]['origin'] = str(origin)
     project.save()
 
+def annotate_file(project, path, **attributes):
+    """Record attributes, such as the expression an output was computed with, in the project entry of path"""
+    file = [files for files in project.files if os.path.normpath(files['path']) == os.path.normpath(path)]
+    assert(len(file) == 1)
+    file[0].update(attributes)
+    project.save()
+
 # Always ensure all reference_frames come first in the list
 # def refresh_all_list(project, video_list, indices, last_manips_to_display=['All']):
 #     video_list.model().clear()
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+
+import csv
+import os
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool, cpu_count
+
+import imreg_dft as ird
+import numpy as np
+from scipy import ndimage
+
+from . import file_io
+
+try:
+    # imreg_dft also prefers pyfftw when it is installed
+    import pyfftw.interfaces.numpy_fft as fft
+    FFT_THREADS_ARGUMENT = 'threads'
+except ImportError:
+    try:
+        import scipy.fft as fft
+        FFT_THREADS_ARGUMENT = 'workers'
+    except ImportError:
+        import numpy.fft as fft
+        FFT_THREADS_ARGUMENT = None
+
+# Smallest frame side of the coarsest pyramid level
+PYRAMID_MIN_SIZE = 32
+# Complex and float64 temporaries held per frame of a batch, in float64 frames
+BATCH_COPIES = 16
+# Per-frame shifts of a motion corrected stack, stored next to it
+SHIFT_TRACE_SUFFIX = '_shifts.csv'
+SHIFT_TRACE_FIELDS = ['Frame', 'tvec-y', 'tvec-x', 'angle', 'scale', 'success']
+
+
+def fft2(frames, threads, inverse=False):
+    """(Inverse) 2D FFT of every frame of a batch, multithreaded"""
+    transform = fft.ifft2 if inverse else fft.fft2
+    if FFT_THREADS_ARGUMENT:
+        return transform(frames, axes=(-2, -1), **{FFT_THREADS_ARGUMENT: threads})
+    threads = max(1, min(threads, len(frames)))
+    with ThreadPoolExecutor(threads) as executor:
+        parts = executor.map(lambda part: transform(part, axes=(-2, -1)), np.array_split(frames, threads))
+        return np.concatenate(list(parts))
+
+def downsample(frames, factor):
+    """Average factor x factor blocks of pixels of the last two axes, dropping incomplete blocks at the edges"""
+    h, w = frames.shape[-2] // factor * factor, frames.shape[-1] // factor * factor
+    frames = frames[..., :h, :w]
+    blocks = np.reshape(frames, frames.shape[:-2] + (h // factor, factor, w // factor, factor))
+    return blocks.mean(axis=(-3, -1))
+
+def pyramid_levels(shape, levels):
+    """Number of levels, at most the requested, whose frames are still at least PYRAMID_MIN_SIZE on a side"""
+    while levels and min(shape) // 2 ** levels < PYRAMID_MIN_SIZE:
+        levels = levels - 1
+    return levels
+
+def border_values(frames, radius):
+    """Median of the pixels near the edges of each frame, exactly as imreg_dft's get_borderval takes it, so
+    backgrounds and therefore shifts match imreg_dft's. Like get_borderval, it takes the single row at index radius
+    rather than the whole top band"""
+    mask = np.zeros(frames.shape[-2:], dtype=bool)
+    mask[:, :radius] = True
+    mask[:, -radius:] = True
+    mask[radius, :] = True
+    mask[-radius:, :] = True
+    return np.median(frames[:, mask], axis=1)
+
+def wrap_angles(angles):
+    return (angles + 180.0) % 360.0 - 180.0
+
+def phase_correlation(f0, f1, threads):
+    """fftshifted magnitude of the normalized cross-power spectrum of spectrum f0 with each of the spectra f1"""
+    eps = np.abs(f1).max(axis=(-2, -1), keepdims=True) * 1e-15
+    cps = f0 * f1.conj()
+    cps /= np.abs(f0) * np.abs(f1) + eps
+    return np.fft.fftshift(np.abs(fft2(cps, threads, inverse=True)), axes=(-2, -1))
+
+def peaks(scps, mask, radius=2):
+    """Subpixel (Y, X) peaks of correlations scps: the maximum within mask refined by the centre of mass of its
+    neighbourhood, wrapping around the edges, and imreg_dft's success of each"""
+    n, h, w = scps.shape
+    shape = np.array([h, w])
+    offsets = np.arange(-radius, radius + 1)
+    def neighbourhoods(centres):
+        ys = (centres[:, 0, np.newaxis] + offsets) % h
+        xs = (centres[:, 1, np.newaxis] + offsets) % w
+        return scps[np.arange(n)[:, np.newaxis, np.newaxis], ys[:, :, np.newaxis], xs[:, np.newaxis, :]]
+    rough = np.argmax(np.reshape(scps * mask, (n, h * w)), axis=1)
+    rough = np.stack([rough // w, rough % w], axis=1)
+    around = neighbourhoods(rough)
+    total = around.sum(axis=(1, 2))[:, np.newaxis]
+    moments = np.stack([np.dot(around.sum(axis=2), offsets), np.dot(around.sum(axis=1), offsets)], axis=1)
+    offset = np.where(total > 0, moments / np.where(total > 0, total, 1), -radius)
+    coords = (rough + offset + 0.5) % shape - 0.5
+    nearest = np.round(coords).astype(int)
+    success = np.sqrt(neighbourhoods(nearest).sum(axis=(1, 2)) * scps[np.arange(n), nearest[:, 0], nearest[:, 1]])
+    return coords, success
+
+def logpolar_filter(shape):
+    """Radial filter suppressing the low frequencies before the log-polar transform, as in imreg_dft"""
+    yy = np.linspace(-np.pi / 2., np.pi / 2., shape[0])[:, np.newaxis]
+    xx = np.linspace(-np.pi / 2., np.pi / 2., shape[1])[np.newaxis, :]
+    rads = np.sqrt(yy ** 2 + xx ** 2)
+    filt = 1.0 - np.cos(rads) ** 2
+    filt[np.abs(rads) > np.pi / 2] = 1
+    return filt
+
+
+class Reference(object):
+    """A reference frame prepared once for registering many frames to it by phase correlation: its spectrum and,
+    for similarity, its log-polar magnitude spectrum. Shifts are the dicts imreg_dft's translation and similarity
+    return, tvec (Y, X) being how to translate a frame onto the reference, and without a pyramid they are the same
+    shifts. levels optionally adds a coarser pyramid level, which only narrows the search for the translation peak
+    that full resolution then refines. It is off by default, as a wrong coarse peak can't be recovered from"""
+    def __init__(self, reference_frame, levels=0, threads=None, memory_budget=None):
+        self.frame = np.array(reference_frame, dtype=np.float64)
+        self.shape = self.frame.shape
+        self.threads = threads or cpu_count()
+        self.memory_budget = memory_budget or file_io.CHUNK_BYTES
+        h, w = self.shape
+        self.spectrum = fft2(self.frame[np.newaxis], self.threads)[0]
+        # the spectrum of a frame rotated by 180 degrees is the conjugate of its own times this ramp
+        self.rotation_ramp = np.exp(2j * np.pi * (np.arange(h)[:, np.newaxis] / h + np.arange(w)[np.newaxis, :] / w))
+        self.peak_mask = ird.utils.get_apofield(self.shape, min(h, w) // 6)
+        levels = pyramid_levels(self.shape, levels)
+        self.factor = 2 ** levels
+        self.coarse = Reference(downsample(self.frame, self.factor), 0, threads, memory_budget) if levels else None
+        self.logpolar = None
+
+    def prepare_logpolar(self):
+        """Log-polar sampling coordinates and filters of the angle and scale estimation, and the reference's
+        log-polar spectrum. Only computed when similarity is first asked for"""
+        h, w = self.shape
+        size = max(self.shape)
+        log_base = np.exp(np.log(h * 1.1 / 2.0) / size)
+        theta = -np.linspace(0, np.pi, size, endpoint=False)[:, np.newaxis]
+        radius = np.power(log_base, np.arange(size, dtype=float))[np.newaxis, :]
+        y = radius * np.sin(theta) + h / 2.0
+        x = radius / (h / float(w)) * np.cos(theta) + w / 2.0
+        aporad = int(min(self.shape) * 0.12)
+        self.logpolar = {
+            'size': size,
+            'log_base': log_base,
+            'coordinates': np.array([y, x]),
+            'aporad': aporad,
+            'apofield': ird.utils.get_apofield(self.shape, aporad),
+            'filter': logpolar_filter(self.shape)
+        }
+        self.logpolar['spectrum'] = self.logpolar_spectra(self.frame[np.newaxis])[0]
+
+    def logpolar_spectra(self, frames):
+        """Spectra of the log-polar transformed, filtered magnitude spectra of apodized frames"""
+        params = self.logpolar
+        apofield = params['apofield']
+        backgrounds = border_values(frames, params['aporad'] // 2)[:, np.newaxis, np.newaxis]
+        apodized = frames * apofield + backgrounds * (1 - apofield)
+        magnitudes = np.abs(np.fft.fftshift(fft2(apodized, self.threads), axes=(-2, -1)) * params['filter'])
+        logpolar = np.empty((len(frames), params['size'], params['size']))
+        for i, magnitude in enumerate(magnitudes):
+            ndimage.map_coordinates(magnitude, params['coordinates'], output=logpolar[i], order=3, mode='constant',
+                                    cval=np.percentile(magnitude, 1))
+        return fft2(logpolar, self.threads)
+
+    def candidates(self, frames):
+        """(tvecs, successes) of frames as they are and rotated by 180 degrees. With a pyramid, the peak is only
+        searched for around the coarse level's estimate"""
+        spectra = fft2(frames, self.threads)
+        coarse = self.coarse.candidates(downsample(frames, self.factor)) if self.coarse else [None, None]
+        centre = np.array(self.shape) // 2
+        candidates = []
+        for rotated, coarse_candidate in zip((False, True), coarse):
+            scps = phase_correlation(self.spectrum, spectra.conj() * self.rotation_ramp if rotated else spectra,
+                                     self.threads)
+            mask = self.peak_mask
+            if coarse_candidate is not None:
+                mask = mask * self.window(coarse_candidate[0] * self.factor, self.factor + 2)
+            coords, success = peaks(scps, mask)
+            candidates.append((coords - centre, success))
+        return candidates
+
+    def window(self, tvecs, radius):
+        """Masks of the correlation peaks within radius of each tvec"""
+        h, w = self.shape
+        centres = tvecs + np.array(self.shape) // 2
+        dy = (np.arange(h)[np.newaxis, :] - centres[:, 0, np.newaxis] + h / 2.0) % h - h / 2.0
+        dx = (np.arange(w)[np.newaxis, :] - centres[:, 1, np.newaxis] + w / 2.0) % w - w / 2.0
+        return (np.abs(dy) <= radius)[:, :, np.newaxis] & (np.abs(dx) <= radius)[:, np.newaxis, :]
+
+    def translations(self, frames):
+        """Translation of each of a batch of frames, picking it or its 180 degree rotation like
+        imreg_dft's translation"""
+        (tvecs, successes), (rotated_tvecs, rotated_successes) = self.candidates(frames)
+        shifts = []
+        for i in range(len(frames)):
+            if rotated_successes[i] > successes[i]:
+                shifts.append(dict(tvec=rotated_tvecs[i], success=rotated_successes[i], angle=180))
+            else:
+                shifts.append(dict(tvec=tvecs[i], success=successes[i], angle=0))
+        return shifts
+
+    def similarities(self, frames):
+        """Scale, angle and translation of each of a batch of frames like imreg_dft's similarity. Scale and angle
+        are always estimated at full resolution"""
+        if self.logpolar is None:
+            self.prepare_logpolar()
+        params = self.logpolar
+        spectra = self.logpolar_spectra(frames)
+        coords, _ = peaks(phase_correlation(params['spectrum'], spectra, self.threads), 1)
+        arg_angles, arg_radii = (coords - params['size'] // 2).T
+        angles = -wrap_angles(np.rad2deg(-np.pi * arg_angles / params['size']))
+        scales = 1.0 / params['log_base'] ** arg_radii
+        for scale in scales:
+            if not 0.5 < scale < 2:
+                raise ValueError("Images are not compatible. Scale change %g too big to be true." % scale)
+        backgrounds = border_values(frames, 5)
+        transformed = np.array([ird.transform_img(frame, scale, angle, bgval=background, order=3)
+                                for frame, scale, angle, background in zip(frames, scales, angles, backgrounds)])
+        shifts = self.translations(transformed)
+        for shift, scale, angle in zip(shifts, scales, angles):
+            shift['angle'] = wrap_angles(angle + shift['angle'])
+            shift['scale'] = scale
+        return shifts
+
+    def register(self, frames, similarity=False, progress_callback=None):
+        """Shift of every frame of a stack onto the reference, in batches that fit the memory budget"""
+        frames = file_io.as_stack(frames)
+        register_batch = self.similarities if similarity else self.translations
+        batch_size = max(1, int(self.memory_budget // (BATCH_COPIES * 8 * frames.num_pixels)))
+        shifts = []
+        for start in range(0, len(frames), batch_size):
+            stop = min(start + batch_size, len(frames))
+            shifts = shifts + register_batch(np.array(frames[start:stop], dtype=np.float64))
+            if progress_callback:
+                progress_callback(stop / len(frames))
+        return shifts
+
+
+def prepare_frames(frames, kernel_size, crop_fraction):
+    """Subtract a kernel_size mean filter from each frame and zero a crop_fraction border, as the alignment plugin
+    does to the reference frame"""
+    kernel = np.ones((1, kernel_size, kernel_size)) / (kernel_size * kernel_size)
+    frames = frames - ndimage.convolve(frames, kernel, mode='constant', cval=0.0)
+    h, w = frames.shape[1:]
+    cropped_y = round(crop_fraction * h)
+    cropped_x = round(crop_fraction * w)
+    y = np.arange(h)[:, np.newaxis]
+    x = np.arange(w)[np.newaxis, :]
+    frames[:, (x < cropped_x) | (x > w - cropped_x) | (y < cropped_y) | (y > h - cropped_y)] = 0
+    return frames
+
+def shift_trace_path(filename):
+    return os.path.splitext(filename)[0] + SHIFT_TRACE_SUFFIX
+
+def save_shift_trace(filename, shifts):
+    """Write the per-frame shifts of the stack filename next to it"""
+    with open(shift_trace_path(filename), 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(SHIFT_TRACE_FIELDS)
+        for frame_no, shift in enumerate(shifts):
+            w.writerow([frame_no, shift['tvec'][0], shift['tvec'][1], shift['angle'], shift.get('scale', 1.0),
+                        shift['success']])
+
+# the stack, reference and settings each pool worker registers frames with, prepared once for all of its blocks
+motion_worker = None
+
+def init_motion_worker(video_path, reference_frame, similarity, levels, frames_per_shift, kernel_size,
+                       crop_fraction):
+    """Pool initializer: open the stack and prepare the reference once per worker"""
+    global motion_worker
+    motion_worker = dict(frames=file_io.open_stack(video_path),
+                         reference=Reference(reference_frame, levels, threads=1),
+                         similarity=similarity, frames_per_shift=frames_per_shift, kernel_size=kernel_size,
+                         crop_fraction=crop_fraction)
+
+def motion_shifts_block(task):
+    """Worker: shifts of frames start:stop of the worker's stack onto its reference, one per average of
+    frames_per_shift frames, repeated for each frame it averages"""
+    start, stop = task
+    frames_per_shift = motion_worker['frames_per_shift']
+    frames = np.array(motion_worker['frames'][start:stop], dtype=np.float64)
+    averages = np.array([np.mean(frames[i:i + frames_per_shift], axis=0)
+                         for i in range(0, len(frames), frames_per_shift)])
+    averages = prepare_frames(averages, motion_worker['kernel_size'], motion_worker['crop_fraction'])
+    reference = motion_worker['reference']
+    shifts = reference.similarities(averages) if motion_worker['similarity'] else reference.translations(averages)
+    return start, [shifts[i // frames_per_shift] for i in range(len(frames))]
+
+def is_translation(shift):
+    return shift['angle'] % 360 == 0 and shift.get('scale', 1.0) == 1.0
+
+def translate_frames(frames, tvecs, backgrounds):
+    """Translate each frame by its (Y, X) tvec with linear interpolation like imreg_dft's transform_img. The weights
+    are the same for every pixel of a frame, so each run of frames sharing a shift is interpolated along x and then
+    y from slices of the block padded with each frame's background"""
+    n, h, w = frames.shape
+    pad = int(np.ceil(np.abs(tvecs).max())) + 2
+    padded = np.empty((n, h + 2 * pad, w + 2 * pad))
+    padded[:] = backgrounds[:, np.newaxis, np.newaxis]
+    padded[:, pad:pad + h, pad:pad + w] = frames
+    translated = np.empty(frames.shape)
+    start = 0
+    for stop in range(1, n + 1):
+        if stop < n and np.array_equal(tvecs[stop], tvecs[start]):
+            continue
+        # pixel y, x reads from y - tvec[0], x - tvec[1]
+        y, x = np.floor(-tvecs[start]).astype(int) + pad
+        fy, fx = -tvecs[start] - np.floor(-tvecs[start])
+        rows = padded[start:stop, y:y + h + 1]
+        along_x = rows[:, :, x:x + w] * (1 - fx)
+        along_x += rows[:, :, x + 1:x + w + 1] * fx
+        out = translated[start:stop]
+        np.multiply(along_x[:, :h], 1 - fy, out=out)
+        out += along_x[:, 1:] * fy
+        start = stop
+    return translated
+
+def transform_frames(frames, shifts):
+    """frames each transformed by its shift like imreg_dft's transform_img: pure translations batched, anything
+    else by transform_img itself, which zooms, rotates and shifts in separate steps"""
+    frames = np.asarray(frames, dtype=np.float64)
+    backgrounds = border_values(frames, max(1, min(frames.shape[1:]) // 20))
+    translations = [i for i, shift in enumerate(shifts) if is_translation(shift)]
+    if len(translations) == len(frames):
+        return translate_frames(frames, np.array([shift['tvec'] for shift in shifts], dtype=np.float64), backgrounds)
+    transformed = np.empty(frames.shape)
+    if translations:
+        tvecs = np.array([shifts[i]['tvec'] for i in translations], dtype=np.float64)
+        transformed[translations] = translate_frames(frames[translations], tvecs, backgrounds[translations])
+    for i, shift in enumerate(shifts):
+        if not is_translation(shift):
+            transformed[i] = ird.transform_img(frames[i], shift.get('scale', 1.0), shift['angle'], shift['tvec'],
+                                               bgval=backgrounds[i], order=1)
+    return transformed
+
+def shift_frames_block(task):
+    """Worker: write frames start:stop of video_path, each transformed by its shift, into the memory-mapped stack
+    at output_path. Returns the number of frames and their statistics"""
+    video_path, output_path, shifts, start, stop = task
+    frames = file_io.open_stack(video_path)
+    output = file_io.open_stack(output_path, mode='r+')
+    block = transform_frames(frames[start:stop], shifts).astype(output.dtype)
+    output[start:stop] = block
+    output.flush()
+    return stop - start, file_io.BlockStatistics(block, start)
+
+def motion_shifts(video_path, reference_frame, similarity=False, levels=0, frames_per_shift=1, kernel_size=8,
+                  crop_fraction=0.2, progress_callback=None, processes=None, memory_budget=file_io.CHUNK_BYTES):
+    """Shift of every frame of video_path onto the prepared reference_frame, registering each average of
+    frames_per_shift frames, prepared like the reference, in batches across a process pool. Each worker prepares
+    the reference once and is only sent frame ranges"""
+    frames = file_io.open_stack(video_path)
+    processes = processes or cpu_count()
+    batch_size = max(1, int(memory_budget // (processes * BATCH_COPIES * 8 * frames.num_pixels)))
+    # blocks hold whole groups of averaged frames
+    batch_size = max(1, batch_size // frames_per_shift) * frames_per_shift
+    tasks = [(start, min(start + batch_size, len(frames))) for start in range(0, len(frames), batch_size)]
+    shifts = [None] * len(frames)
+    done = 0
+    with Pool(processes, init_motion_worker, (video_path, reference_frame, similarity, levels, frames_per_shift,
+                                               kernel_size, crop_fraction)) as pool:
+        for start, block_shifts in pool.imap_unordered(motion_shifts_block, tasks):
+            shifts[start:start + len(block_shifts)] = block_shifts
+            done = done + len(block_shifts)
+            if progress_callback:
+                progress_callback(done / len(frames))
+    return shifts
+
+def apply_shifts(video_path, output_path, shifts, progress_callback=None, processes=None,
+                 memory_budget=file_io.CHUNK_BYTES):
+    """Write every frame of video_path transformed by a shift into a float32 stack at output_path, so interpolated
+    values of integer stacks aren't truncated. shifts is one shift for all frames or one per frame, frames past its
+    end keeping the last. Frame blocks are spread across a process pool, each writing straight into the
+    memory-mapped output, and their statistics are added to the output's statistics sidecar"""
+    frames = file_io.open_stack(video_path)
+    processes = processes or cpu_count()
+    output = file_io.create_stack(output_path, frames.shape, np.float32)
+    del output
+    if isinstance(shifts, dict):
+        shifts = [shifts]
+    shifts = list(shifts[:len(frames)]) + [shifts[-1]] * (len(frames) - len(shifts))
+    # each worker holds a block, its padded copy and the transformed frames
+    ranges = file_io.ChunkedStack(frames.frames, memory_budget // (processes * 4)).frame_ranges(np.float64)
+    statistics = file_io.StackStatistics(frames.shape[1:], np.float32)
+    done = 0
+    with Pool(processes) as pool:
+        tasks = [(video_path, output_path, shifts[start:stop], start, stop) for start, stop in ranges]
+        for processed, block_statistics in pool.imap_unordered(shift_frames_block, tasks):
+            statistics.add_block(block_statistics)
+            done = done + processed
+            if progress_callback:
+                progress_callback(done / len(frames))
+    statistics.save(output_path)
+    return output_path
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# plugins are imported from src, as pipegui does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
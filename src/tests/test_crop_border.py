@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from plugins.crop_border import border_widths
+from plugins.crop_border import crop_border
+
+
+def crop_border_loop(frames, percentage):
+    """The plugin's original per-pixel implementation, the reference for crop_border"""
+    cropped_y, cropped_x = border_widths(frames.shape[1:], percentage)
+    for frame_no in range(len(frames)):
+        for y in range(len(frames[frame_no])):
+            for x in range(len(frames[frame_no][y])):
+                if (x < cropped_x or x > frames.shape[2] - cropped_x) or\
+                        (y < cropped_y or y > frames.shape[1] - cropped_y):
+                    frames[frame_no][y][x] = 0
+    return frames
+
+@pytest.mark.parametrize('shape, percentage', [((3, 40, 40), 0.25), ((2, 37, 52), 0.1), ((2, 20, 30), 0.0)])
+def test_crop_border_matches_loop(shape, percentage):
+    frames = np.random.RandomState(0).randint(1, 1000, shape).astype(np.uint16)
+    expected = crop_border_loop(frames.copy(), percentage)
+    np.testing.assert_array_equal(crop_border(frames, np.empty_like(frames), percentage), expected)
@@ -0,0 +1,61 @@
+import imreg_dft as ird
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from plugins.util import registration
+
+
+@pytest.fixture
+def reference_frame():
+    rng = np.random.RandomState(0)
+    return ndimage.gaussian_filter(rng.rand(128, 128), 1.5) * 1000
+
+def shifted_frames(reference_frame, tvecs):
+    """reference_frame cyclically shifted by each (Y, X) tvec"""
+    spectrum = np.fft.fft2(reference_frame)
+    return np.array([np.fft.ifft2(ndimage.fourier_shift(spectrum, tvec)).real for tvec in tvecs])
+
+def test_border_values_match_get_borderval(reference_frame):
+    frames = np.array([reference_frame, reference_frame[::-1]])
+    for radius in (1, 5, 6):
+        expected = [ird.utils.get_borderval(frame, radius) for frame in frames]
+        np.testing.assert_array_equal(registration.border_values(frames, radius), expected)
+
+def test_translations_match_ird(reference_frame):
+    tvecs = [(0, 0), (3.25, -7.5), (-12.4, 5.8), (0.6, 0.3)]
+    frames = shifted_frames(reference_frame, tvecs)
+    shifts = registration.Reference(reference_frame, threads=1).translations(frames)
+    for frame, tvec, shift in zip(frames, tvecs, shifts):
+        expected = ird.translation(reference_frame, frame)
+        np.testing.assert_allclose(expected['tvec'], np.negative(tvec), atol=0.5)
+        np.testing.assert_allclose(shift['tvec'], expected['tvec'], atol=1e-6)
+        assert shift['angle'] == expected['angle']
+        assert shift['success'] == pytest.approx(expected['success'])
+
+def test_similarities_match_ird(reference_frame):
+    frames = np.array([ird.transform_img(reference_frame, scale, angle, tvec)
+                       for scale, angle, tvec in [(1.0, 0.0, (2, -3)), (1.05, 4.0, (-1.5, 2.5)),
+                                                  (0.97, -6.0, (0, 0))]])
+    shifts = registration.Reference(reference_frame, threads=1).similarities(frames)
+    for frame, shift in zip(frames, shifts):
+        expected = ird.similarity(reference_frame, frame)
+        np.testing.assert_allclose(shift['tvec'], expected['tvec'], atol=1e-6)
+        assert shift['angle'] == pytest.approx(expected['angle'])
+        assert shift['scale'] == pytest.approx(expected['scale'])
+
+def test_pyramid_refines_translations_at_full_resolution(reference_frame):
+    frames = shifted_frames(reference_frame, [(3.25, -7.5), (-12.4, 5.8)])
+    full = registration.Reference(reference_frame, threads=1).translations(frames)
+    coarse = registration.Reference(reference_frame, levels=1, threads=1).translations(frames)
+    for full_shift, coarse_shift in zip(full, coarse):
+        np.testing.assert_allclose(coarse_shift['tvec'], full_shift['tvec'], atol=1e-6)
+
+def test_transform_frames_matches_transform_img(reference_frame):
+    shifts = [dict(tvec=(2.25, -3.5), angle=0.0), dict(tvec=(0.4, 1.7), angle=3.0, scale=1.0),
+              dict(tvec=(-1.3, 0.6), angle=-5.0, scale=1.04), dict(tvec=(-1.3, 0.6), angle=180)]
+    frames = np.array([reference_frame] * len(shifts))
+    transformed = registration.transform_frames(frames, shifts)
+    for frame, shift in zip(transformed, shifts):
+        expected = ird.transform_img(reference_frame, shift.get('scale', 1.0), shift['angle'], shift['tvec'])
+        np.testing.assert_allclose(frame, expected, atol=1e-6)